@@ -0,0 +1,68 @@
+'''
+Tests of :class:`whimsy.compare.Comparison`.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+import StringIO
+import unittest
+
+from whimsy.compare import Comparison
+from whimsy.result import TestSuiteResult, PASS, FAIL
+from whimsy.resultfile import ResultFileReader, ResultFileWriter
+
+shared_uid = 'tests:TestSuite:shared'
+
+class _Item(object):
+    def __init__(self, uid):
+        self.uid = uid
+        self.name = uid.split(':')[-1]
+        self.tags = ()
+
+def _results(*suites):
+    '''
+    Return a :class:`whimsy.resultfile.ResultFileReader` of a result file
+    holding a suite for each :code:`(uid, outcome, runtime)`.
+    '''
+    fstream = StringIO.StringIO()
+    writer = ResultFileWriter(fstream)
+    for (uid, outcome, runtime) in suites:
+        writer.write(TestSuiteResult([], item=_Item(uid), outcome=outcome,
+                                     runtime=runtime))
+    writer.close()
+    return ResultFileReader(fstream)
+
+class SharedUidTest(unittest.TestCase):
+    '''Suites sharing a uid are matched in the order they were written.'''
+
+    def test_newly_failing(self):
+        old = _results((shared_uid, PASS, 1), (shared_uid, PASS, 1))
+        new = _results((shared_uid, FAIL, 1), (shared_uid, PASS, 1))
+        comparison = Comparison(old, new)
+        self.assertEqual(comparison.newly_failing, [shared_uid + ' #1'])
+        self.assertTrue(comparison.regressed)
+
+    def test_runtime_regression(self):
+        old = _results((shared_uid, PASS, 1), (shared_uid, PASS, 2))
+        new = _results((shared_uid, PASS, 1), (shared_uid, PASS, 4))
+        comparison = Comparison(old, new)
+        self.assertEqual(comparison.runtime_regressions,
+                         [(shared_uid + ' #2', 2, 4)])
+
+    def test_removed(self):
+        old = _results((shared_uid, PASS, 1), (shared_uid, PASS, 1))
+        new = _results((shared_uid, PASS, 1))
+        comparison = Comparison(old, new)
+        self.assertEqual(comparison.removed, [shared_uid + ' #2'])
+        self.assertEqual(comparison.added, [])
+        self.assertFalse(comparison.regressed)
+
+    def test_unique_uid(self):
+        old = _results(('tests:TestSuite:alone', PASS, 1))
+        new = _results(('tests:TestSuite:alone', FAIL, 1))
+        comparison = Comparison(old, new)
+        self.assertEqual(comparison.newly_failing, ['tests:TestSuite:alone'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+'''
+Tests of :func:`whimsy.merge.merge_suites`.
+
+Run with::
+
+    python -m unittest discover tests
+'''
+import StringIO
+import unittest
+
+from whimsy.merge import merge_suites, LATEST, WORST
+from whimsy.result import TestSuiteResult, PASS, FAIL
+from whimsy.resultfile import ResultFileReader, ResultFileWriter
+
+shared_uid = 'tests:TestSuite:shared'
+
+class _Item(object):
+    def __init__(self, uid):
+        self.uid = uid
+        self.name = uid.split(':')[-1]
+        self.tags = ()
+
+def _results(*suites):
+    '''
+    Return a :class:`whimsy.resultfile.ResultFileReader` of a result file
+    holding a suite for each :code:`(uid, outcome)`.
+    '''
+    fstream = StringIO.StringIO()
+    writer = ResultFileWriter(fstream)
+    for (uid, outcome) in suites:
+        writer.write(TestSuiteResult([], item=_Item(uid), outcome=outcome))
+    writer.close()
+    return ResultFileReader(fstream)
+
+def _outcomes(suites):
+    return [(suite.uid, suite.outcome) for suite in suites]
+
+class SharedUidTest(unittest.TestCase):
+    '''Suites sharing a uid are each kept.'''
+
+    def test_single_input(self):
+        reader = _results((shared_uid, PASS), ('tests:TestSuite:alone', PASS),
+                          (shared_uid, FAIL))
+        self.assertEqual(_outcomes(merge_suites([reader])),
+                         [(shared_uid, PASS), ('tests:TestSuite:alone', PASS),
+                          (shared_uid, FAIL)])
+
+    def test_latest(self):
+        old = _results((shared_uid, FAIL), (shared_uid, FAIL))
+        new = _results((shared_uid, PASS))
+        self.assertEqual(_outcomes(merge_suites([old, new], LATEST)),
+                         [(shared_uid, PASS), (shared_uid, FAIL)])
+
+    def test_worst(self):
+        old = _results((shared_uid, PASS), (shared_uid, FAIL))
+        new = _results((shared_uid, FAIL), (shared_uid, PASS))
+        self.assertEqual(_outcomes(merge_suites([old, new], WORST)),
+                         [(shared_uid, FAIL), (shared_uid, FAIL)])
+
+if __name__ == '__main__':
+    unittest.main()
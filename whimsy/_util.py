@@ -3,6 +3,7 @@ Contains utility functions used throughout the testframework.
 '''
 import collections
 import difflib
+import gzip
 import helper
 import os
 import re
@@ -171,6 +172,44 @@ def _filter_file_inplace(fname, filters):
     _copy_file_keep_perms(tfname, fname)
 
 
+def bound_output_file(fname, limit, keep_full=False):
+    '''
+    Truncate the given output file so it only holds its first and last
+    `limit` bytes with a marker noting how much was removed in between.
+
+    :param keep_full: Before truncating, save a gzip compressed copy of the
+        full file next to it. (The same name with a '.gz' suffix.)
+
+    :returns: The number of bytes removed from the file.
+    '''
+    if limit < 0:
+        raise ValueError('Output limit must not be negative, got %d.' % limit)
+    size = os.path.getsize(fname)
+    removed = size - 2 * limit
+    if removed <= 0:
+        return 0
+
+    marker = '\n[whimsy: truncated %d bytes of output' % removed
+    if keep_full:
+        full_fname = fname + '.gz'
+        with open(fname, 'rb') as src, gzip.open(full_fname, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        marker += ', full output saved in %s' % full_fname
+    marker += ']\n'
+
+    # Write the head and tail into a tempfile in the same directory, then
+    # move it over the original so we never hold the middle in memory.
+    (fd, tfname) = tempfile.mkstemp(dir=os.path.dirname(fname))
+    with open(fname, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+        dst.write(src.read(limit))
+        dst.write(marker)
+        src.seek(-limit, os.SEEK_END)
+        shutil.copyfileobj(src, dst)
+    shutil.copymode(fname, tfname)
+    os.rename(tfname, fname)
+    return removed
+
+
 def diff_out_file(ref_file, out_file, ignore_regexes=tuple()):
     if not os.path.exists(ref_file):
         raise OSError("%s doesn't exist in reference directory"\
@@ -0,0 +1,239 @@
+'''
+Implements fetching of the artifacts tests use (gem5 binaries, test programs
+and gold standard files) from the work server, so work clients don't need to
+share the server's filesystem.
+
+The server keeps an :class:`ArtifactStore` which looks up files under its
+base, build and test directories by path and serves their content by its
+sha256 digest. A work client whose filesystem lacks a path asks the store for
+its digest and takes the content from its :class:`ArtifactCache`, only
+fetching it over the work connection if it isn't already cached. The cache is
+kept on disk between runs, content used least recently is removed once it
+grows past its size limit.
+
+Paths are resolved with :func:`resolve` (or :func:`fetch`), which return the
+path unchanged when the file exists or when not in a work client.
+'''
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from config import config
+from helper import mkdir_p
+
+chunk_size = 4 * 1024 * 1024
+'''Bytes of an artifact fetched at a time.'''
+
+fetcher = None
+'''
+In the process of a work client the :class:`ArtifactFetcher` used to fetch
+artifacts, None when not a work client.
+'''
+
+def fetch(path):
+    '''
+    Fetch the content of the given path on the server if it doesn't exist
+    here.
+
+    :returns: The path of the fetched content or None if the path exists
+        here, the server doesn't have it or we aren't a work client.
+    '''
+    if fetcher is None or os.path.exists(path):
+        return None
+    return fetcher.fetch(path)
+
+def resolve(path):
+    '''
+    Return a path to read the content of the given path from, fetching it from
+    the server if it doesn't exist here.
+    '''
+    fetched = fetch(path)
+    return path if fetched is None else fetched
+
+def _digest_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fstream:
+        while True:
+            data = fstream.read(chunk_size)
+            if not data:
+                return digest.hexdigest()
+            digest.update(data)
+
+class ArtifactStore(object):
+    '''
+    Serves the content of files on the server by digest.
+
+    :param roots: Directories files may be served from. If None, the base,
+        build and test directories of the config.
+    '''
+    def __init__(self, roots=None):
+        self._roots = roots
+        # Map path to (mtime, size, digest) of the file when last looked up.
+        self._digests = {}
+        # Map digest to the path it was last looked up as.
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    @property
+    def roots(self):
+        if self._roots is None:
+            self._roots = [root for root in (config.base_dir,
+                                             config.build_dir,
+                                             config.directory) if root]
+        return [os.path.realpath(root) for root in self._roots]
+
+    def _servable(self, path):
+        return any(path == root or path.startswith(root + os.sep)
+                   for root in self.roots)
+
+    def lookup(self, path):
+        '''
+        :returns: Tuple of :code:`(digest, size, mode)` of the file at the
+            given path or None if there is no such file we serve.
+        '''
+        path = os.path.realpath(path)
+        if not self._servable(path) or not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._digests.get(path)
+            if cached is not None and cached[:2] == (stat.st_mtime,
+                                                     stat.st_size):
+                digest = cached[2]
+            else:
+                # Many clients ask for the same binary at once, only hash it
+                # once.
+                digest = _digest_file(path)
+                self._digests[path] = (stat.st_mtime, stat.st_size, digest)
+            self._paths[digest] = path
+        return (digest, stat.st_size, stat.st_mode & 0o777)
+
+    def read(self, digest, offset, size):
+        '''
+        Return up to size bytes of the content with the given digest starting
+        at offset.
+        '''
+        with self._lock:
+            path = self._paths.get(digest)
+        if path is None:
+            raise IOError('No artifact with digest %s.' % digest)
+        with open(path, 'rb') as fstream:
+            fstream.seek(offset)
+            return fstream.read(size)
+
+class ArtifactCache(object):
+    '''
+    Cache of artifacts on disk named by their digest.
+
+    :param directory: Directory to keep the artifacts in. It may be shared by
+        the clients of a machine.
+    :param max_bytes: Size past which artifacts used least recently are
+        removed.
+    '''
+    min_age = 60.0
+    '''
+    Seconds since an artifact was last used before it may be removed, so those
+    used by running tests are kept.
+    '''
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        mkdir_p(directory)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def get(self, digest):
+        '''
+        :returns: The path of the cached artifact with the given digest or
+            None if it isn't cached.
+        '''
+        path = self.path(digest)
+        try:
+            # The modification time records when it was last used.
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def add(self, digest, mode, chunks):
+        '''
+        Add the artifact with the given digest whose content is given by the
+        iterable of chunks.
+
+        :returns: The path of the cached artifact.
+        '''
+        (fd, temp_path) = tempfile.mkstemp(dir=self.directory,
+                                           prefix='.fetching-')
+        try:
+            hashed = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as fstream:
+                for chunk in chunks:
+                    hashed.update(chunk)
+                    fstream.write(chunk)
+            if hashed.hexdigest() != digest:
+                raise IOError('Fetched artifact did not match digest %s, it'
+                              ' may have changed on the server.' % digest)
+            os.chmod(temp_path, mode)
+            # Other clients fetching the same artifact end up with the same
+            # content.
+            os.rename(temp_path, self.path(digest))
+        except:
+            os.remove(temp_path)
+            raise
+        self.evict()
+        return self.path(digest)
+
+    def evict(self):
+        '''Remove artifacts used least recently past our size limit.'''
+        artifacts = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            artifacts.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        now = time.time()
+        for (mtime, size, name) in sorted(artifacts):
+            if total <= self.max_bytes or now - mtime < self.min_age:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+
+class ArtifactFetcher(object):
+    '''
+    Fetches artifacts from a store into a cache.
+
+    :param store: An :class:`ArtifactStore` or a stand in for one on
+        the server.
+    :param cache: The :class:`ArtifactCache` to fetch into.
+    '''
+    def __init__(self, store, cache):
+        self.store = store
+        self.cache = cache
+
+    def fetch(self, path):
+        '''
+        :returns: The path of the cached content of the given path on the
+            server or None if the server doesn't have it.
+        '''
+        found = self.store.lookup(path)
+        if found is None:
+            return None
+        (digest, size, mode) = found
+        cached = self.cache.get(digest)
+        if cached is not None:
+            return cached
+        chunks = (self.store.read(digest, offset, chunk_size)
+                  for offset in xrange(0, size, chunk_size))
+        return self.cache.add(digest, mode, chunks)
@@ -0,0 +1,106 @@
+'''
+Compares the results of two runs for the ``compare`` command.
+
+Items are matched by uid using the summaries stored in the index of each
+``pickle`` result file (see :mod:`whimsy.resultfile`), so no results need to
+be deserialized to produce the comparison. The results of a uid shared by
+several items (such as the suites of testfunctions in the same file) are
+matched in the order they were written and told apart by a ``#n`` suffix.
+'''
+from result import PASS, XFAIL, FAIL, ERROR
+from resultfile import SUITE
+
+_passing = (PASS.name, XFAIL.name)
+_failing = (FAIL.name, ERROR.name)
+
+def _regressed(old, new, threshold):
+    # Nothing to compare against if the old run didn't record the value.
+    if not old or new is None:
+        return False
+    return new > old * (1 + threshold)
+
+def _label(uid, number, count):
+    '''Name the number-th of the count results of the given uid.'''
+    if count == 1:
+        return uid
+    return '%s #%d' % (uid, number + 1)
+
+class Comparison(object):
+    '''
+    The differences between an old and a new run.
+
+    :param runtime_threshold: Fraction a suite's runtime must grow by to be
+        reported as a regression.
+    :param memory_threshold: Fraction a suite's peak memory must grow by to be
+        reported as a regression.
+    :param min_runtime: Suites which took less than this many seconds in both
+        runs are not checked for runtime regressions, their timings are
+        mostly noise.
+
+    Items are named by their uid, suffixed with ``#n`` for the n-th result
+    of a uid several results share.
+
+    :var added: Items only in the new run.
+    :var removed: Items only in the old run.
+    :var newly_failing: Items which failed in the new run but not the old.
+    :var newly_passing: Items which passed in the new run but failed in the
+        old.
+    :var runtime_regressions: List of :code:`(item, old, new)` runtimes of
+        suites whose runtime regressed.
+    :var memory_regressions: List of :code:`(item, old, new)` peak resident
+        set sizes of suites whose memory use regressed.
+    '''
+    def __init__(self, old, new, runtime_threshold=0.2,
+                 memory_threshold=0.2, min_runtime=1.0):
+        old_summaries = old.summaries()
+        new_summaries = new.summaries()
+
+        self.added = []
+        self.removed = []
+        self.newly_failing = []
+        self.newly_passing = []
+        self.runtime_regressions = []
+        self.memory_regressions = []
+
+        for uid in sorted(set(old_summaries) | set(new_summaries)):
+            olds = old_summaries.get(uid, [])
+            news = new_summaries.get(uid, [])
+            count = max(len(olds), len(news))
+            for number in range(count):
+                item = _label(uid, number, count)
+                if number >= len(olds):
+                    self.added.append(item)
+                elif number >= len(news):
+                    self.removed.append(item)
+                else:
+                    self._compare(item, olds[number], news[number],
+                                  runtime_threshold, memory_threshold,
+                                  min_runtime)
+
+    def _compare(self, item, old_summary, new_summary, runtime_threshold,
+                 memory_threshold, min_runtime):
+        if new_summary.outcome in _failing \
+                and old_summary.outcome not in _failing:
+            self.newly_failing.append(item)
+        elif new_summary.outcome in _passing \
+                and old_summary.outcome in _failing:
+            self.newly_passing.append(item)
+
+        if new_summary.kind != SUITE:
+            return
+
+        if max(old_summary.runtime, new_summary.runtime) >= min_runtime \
+                and _regressed(old_summary.runtime, new_summary.runtime,
+                               runtime_threshold):
+            self.runtime_regressions.append(
+                    (item, old_summary.runtime, new_summary.runtime))
+        if _regressed(old_summary.maxrss, new_summary.maxrss,
+                      memory_threshold):
+            self.memory_regressions.append(
+                    (item, old_summary.maxrss, new_summary.maxrss))
+
+    @property
+    def regressed(self):
+        '''True if anything in the new run is worse than the old.'''
+        return bool(self.newly_failing or self.runtime_regressions
+                    or self.memory_regressions)
@@ -104,6 +104,12 @@ class _Config(object):
 
     def _parse_commandline_args(self, parser):
         args = parser.parse_args()
+        # -j isn't converted to an int until the post processors run, so
+        # argparse can't check --min-workers against it.
+        if getattr(args, 'adaptive', False) \
+                and args.min_workers > int(args.threads):
+            parser.error('--min-workers %d is more than -j %s'
+                         % (args.min_workers, args.threads))
 
         self._config_file_args = {}
 
@@ -163,6 +169,9 @@ def define_defaults(defaults):
                                                       os.pardir))
     defaults.result_path = os.path.join(os.getcwd(), '.testing-results')
     defaults.list_only_failed = False
+    defaults.server = False
+    defaults.trace_file = None
+    defaults.profile = []
 
 def define_constants(constants):
     '''
@@ -237,6 +246,16 @@ def define_post_processors(config):
     def fix_verbosity_hack(verbose):
         return (verbose[0].val,)
 
+    def set_default_history_db(history_db):
+        '''
+        Post-processor to place the history database in the result_path
+        unless one was given.
+        '''
+        if not history_db or history_db[0] is None:
+            result_path = config._lookup_val('result_path')[0]
+            history_db = (os.path.join(result_path, 'history.sqlite'),)
+        return history_db
+
     def threads_as_int(threads):
         if threads is not None:
             return (int(threads[0]),)
@@ -258,6 +277,7 @@ def define_post_processors(config):
     config._add_post_processor('build_dir', set_default_build_dir)
     config._add_post_processor('verbose', fix_verbosity_hack)
     config._add_post_processor('threads', threads_as_int)
+    config._add_post_processor('history_db', set_default_history_db)
     config._add_post_processor('credentials_file', parse_server_credentials)
 
 class Argument(object):
@@ -324,6 +344,35 @@ def define_common_args(config):
     '''
     global common_args
 
+    def non_negative_int(value):
+        try:
+            number = int(value)
+        except ValueError:
+            number = -1
+        if number < 0:
+            raise argparse.ArgumentTypeError(
+                    'expected a non-negative integer, got %r' % value)
+        return number
+
+    def positive_float(value):
+        try:
+            number = float(value)
+        except ValueError:
+            number = 0
+        if not number > 0:
+            raise argparse.ArgumentTypeError(
+                    'expected a positive number, got %r' % value)
+        return number
+
+    def priority(value):
+        (name, _, level) = value.rpartition('=')
+        try:
+            return (name, int(level))
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                    'expected NAME=PRIORITY with an integer priority, got %r'
+                    % value)
+
     # A list of common arguments/flags used across cli parsers.
     common_args = [
         Argument(
@@ -393,6 +442,186 @@ def define_common_args(config):
                 default=None,
                 help='File to parse for server information.'
         ),
+        Argument(
+            '--output-limit',
+            action='store',
+            type=non_negative_int,
+            default=None,
+            help='Only keep the first and last OUTPUT_LIMIT KB of the'
+                 ' output captured for each test.'
+        ),
+        Argument(
+            '--keep-full-output',
+            action='store_true',
+            default=False,
+            help='Save a gzip compressed copy of output truncated by'
+                 ' --output-limit.'
+        ),
+        Argument(
+            '--trace-file',
+            action='store',
+            default=None,
+            help='Write a Chrome trace event timeline of the run to the'
+                 ' given file.'
+        ),
+        Argument(
+            '--profile',
+            action='append',
+            default=[],
+            choices=('load', 'setup', 'test', 'log'),
+            help='Profile the given phase of the run with cProfile. May be'
+                 ' given multiple times.'
+        ),
+        Argument(
+            '--history-db',
+            action='store',
+            default=None,
+            help='SQLite database to store the results of every run in.'
+                 ' (Defaults to history.sqlite in the result path.)'
+        ),
+        Argument(
+            '--no-history',
+            action='store_true',
+            default=False,
+            help='Do not record results in the history database.'
+        ),
+        Argument(
+            '--keep-runs',
+            action='store',
+            type=non_negative_int,
+            default=None,
+            help='Archive the previous run left in the result path, keeping'
+                 ' compressed archives of the given number of previous runs.'
+                 ' (0 removes previous runs.) Only result paths created by'
+                 ' whimsy are touched.'
+        ),
+        Argument(
+            '--keep-failures-only',
+            action='store_true',
+            default=False,
+            help='Only archive the output of tests which failed.'
+        ),
+        Argument(
+            '--collect-tempdirs',
+            action='store_true',
+            default=False,
+            help='Remove temporary directories left behind by whimsy'
+                 ' processes of this host which are no longer running.'
+        ),
+        Argument(
+            '--junit-workers',
+            action='store',
+            type=int,
+            default=None,
+            help='Render the junit report with a pool of the given number of'
+                 ' processes.'
+        ),
+        Argument(
+            '--jsonl',
+            action='store',
+            default=None,
+            help='Stream an event for every item begun, ended and its outcome'
+                 ' to the given file as JSON Lines. Use fd:N to write to an'
+                 ' already open file descriptor.'
+        ),
+        Argument(
+            '--lease-timeout',
+            action='store',
+            type=positive_float,
+            default=30.0,
+            help='Seconds a client may go without a heartbeat before the'
+                 ' item it is running is given to another client.'
+        ),
+        Argument(
+            '--max-attempts',
+            action='store',
+            type=int,
+            default=3,
+            help='Number of times to give an item to a client before giving'
+                 ' up on it.'
+        ),
+        Argument(
+            '--priority',
+            action='append',
+            type=priority,
+            default=[],
+            help='NAME=PRIORITY, give the suites with the name, uid or tag'
+                 ' the priority when handing them out to workers. Higher'
+                 ' priorities are run first, the priorities of every match'
+                 ' are added. (e.g. --priority quick=5 --priority'
+                 ' quarantined=-5) May be given multiple times.'
+        ),
+        Argument(
+            '--adaptive',
+            action='store_true',
+            default=False,
+            help='Scale the number of local workers between --min-workers'
+                 ' and -j with the load average and free memory of the'
+                 ' machine.'
+        ),
+        Argument(
+            '--min-workers',
+            action='store',
+            type=int,
+            default=1,
+            help='The fewest local workers an --adaptive run keeps, at most -j.'
+        ),
+        Argument(
+            '--metrics-port',
+            action='store',
+            type=int,
+            default=None,
+            help='Serve metrics of the work server in the Prometheus text'
+                 ' format on the given port of localhost.'
+        ),
+        Argument(
+            '--priority-aging',
+            action='store',
+            type=float,
+            default=60.0,
+            help='Seconds of waiting each level of priority is worth, so'
+                 ' suites with a low priority are not starved.'
+        ),
+        Argument(
+            '--transport',
+            action='store',
+            default='wire',
+            choices=('wire', 'event', 'manager'),
+            help='Protocol the work server and its clients use. (event'
+                 ' serves the clients of the wire protocol from a single'
+                 ' thread for servers with many clients. manager hands out'
+                 ' very short suites faster to a few clients.)'
+        ),
+        Argument(
+            '--prefetch',
+            action='store',
+            type=non_negative_int,
+            default=1,
+            help='Number of items a client holds ahead of the one it runs.'
+                 ' (Not used by the manager transport.)'
+        ),
+        Argument(
+            '--artifact-cache',
+            action='store',
+            default=os.path.join(os.path.expanduser('~'), '.cache', 'whimsy',
+                                 'artifacts'),
+            help='Directory to cache artifacts fetched from the server in.'
+        ),
+        Argument(
+            '--artifact-cache-size',
+            action='store',
+            type=int,
+            default=10240,
+            help='Megabytes of artifacts to keep cached before removing those'
+                 ' used least recently.'
+        ),
+        Argument(
+            '--targets',
+            action='append',
+            default=[],
+            help='A gem5 binary (e.g. X86/gem5.opt) this client can run, may'
+                 ' be given multiple times. (Defaults to any binary.)'
+        ),
     ]
 
     # NOTE: There is a limitation which arises due to this format. If you have
@@ -452,6 +681,34 @@ class RunParser(ArgParser):
         common_args.threads.add_to(parser)
         common_args.list_only_failed.add_to(parser)
         common_args.credentials_file.add_to(parser)
+        common_args.output_limit.add_to(parser)
+        common_args.keep_full_output.add_to(parser)
+        common_args.trace_file.add_to(parser)
+        common_args.profile.add_to(parser)
+        common_args.history_db.add_to(parser)
+        common_args.no_history.add_to(parser)
+        common_args.keep_runs.add_to(parser)
+        common_args.keep_failures_only.add_to(parser)
+        common_args.collect_tempdirs.add_to(parser)
+        common_args.junit_workers.add_to(parser)
+        common_args.jsonl.add_to(parser)
+        common_args.lease_timeout.add_to(parser)
+        common_args.max_attempts.add_to(parser)
+        common_args.priority.add_to(parser)
+        common_args.priority_aging.add_to(parser)
+        common_args.metrics_port.add_to(parser)
+        common_args.adaptive.add_to(parser)
+        common_args.min_workers.add_to(parser)
+        common_args.transport.add_to(parser)
+        common_args.prefetch.add_to(parser)
+
+        Argument(
+            '--server',
+            action='store_true',
+            default=False,
+            help='Run the tests on the workers of a whimsy serve daemon given'
+                 ' by the credentials file rather than our own.'
+        ).add_to(parser)
 
         # Modify the help statement for the tags common_arg
         mytags = common_args.tags.copy()
@@ -497,6 +754,7 @@ class ListParser(ArgParser):
         ).add_to(parser)
 
         common_args.directory.add_to(parser)
+        common_args.list_only_failed.add_to(parser)
         mytags = common_args.tags.copy()
         mytags.kwargs['help'] = ('Only list items marked with one of the'
                                  ' given tags.')
@@ -518,6 +776,165 @@ class RerunParser(ArgParser):
         common_args.fail_fast.add_to(parser)
         common_args.threads.add_to(parser)
         common_args.list_only_failed.add_to(parser)
+        common_args.output_limit.add_to(parser)
+        common_args.keep_full_output.add_to(parser)
+        common_args.trace_file.add_to(parser)
+        common_args.profile.add_to(parser)
+        common_args.lease_timeout.add_to(parser)
+        common_args.max_attempts.add_to(parser)
+        common_args.priority.add_to(parser)
+        common_args.priority_aging.add_to(parser)
+        common_args.metrics_port.add_to(parser)
+        common_args.adaptive.add_to(parser)
+        common_args.min_workers.add_to(parser)
+        common_args.transport.add_to(parser)
+        common_args.prefetch.add_to(parser)
+
+class HistoryParser(ArgParser):
+    '''
+    Parser for the \'history\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'history',
+            help='''Query results of previous runs.'''
+        )
+        super(HistoryParser, self).__init__(parser)
+
+        Argument(
+            '--slowest',
+            action='store',
+            type=int,
+            default=None,
+            help='List the given number of suites with the longest mean'
+                 ' runtime.'
+        ).add_to(parser)
+        Argument(
+            '--first-failure',
+            action='store',
+            default=None,
+            help='Show the first run of the current streak of failures of'
+                 ' the item with the given uid.'
+        ).add_to(parser)
+        Argument(
+            '--pass-rate',
+            action='store_true',
+            default=False,
+            help='List the pass rate of suites and test cases with each'
+                 ' tag.'
+        ).add_to(parser)
+        Argument(
+            '--runs',
+            action='store',
+            type=int,
+            default=20,
+            help='Number of most recent runs to query over.'
+        ).add_to(parser)
+
+        common_args.history_db.add_to(parser)
+
+class CompareParser(ArgParser):
+    '''
+    Parser for the \'compare\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'compare',
+            help='''Report the differences between the results of two runs.'''
+        )
+        super(CompareParser, self).__init__(parser)
+
+        Argument(
+            'old',
+            help='Result directory or result file of the old run.'
+        ).add_to(parser)
+        Argument(
+            'new',
+            help='Result directory or result file of the new run.'
+        ).add_to(parser)
+        Argument(
+            '--runtime-threshold',
+            action='store',
+            type=float,
+            default=20.0,
+            help='Percent a suite\'s runtime must grow by to be reported as'
+                 ' a regression.'
+        ).add_to(parser)
+        Argument(
+            '--memory-threshold',
+            action='store',
+            type=float,
+            default=20.0,
+            help='Percent a suite\'s peak memory must grow by to be reported'
+                 ' as a regression.'
+        ).add_to(parser)
+        Argument(
+            '--min-runtime',
+            action='store',
+            type=float,
+            default=1.0,
+            help='Ignore runtime changes of suites which took less than this'
+                 ' many seconds in both runs.'
+        ).add_to(parser)
+
+class MergeParser(ArgParser):
+    '''
+    Parser for the \'merge\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'merge',
+            help='''Merge the results of several runs into one.'''
+        )
+        super(MergeParser, self).__init__(parser)
+
+        Argument(
+            'inputs',
+            nargs='+',
+            help='Result directories or result files to merge, oldest first.'
+        ).add_to(parser)
+        Argument(
+            '--output',
+            action='store',
+            required=True,
+            help='Directory to write the merged result file and junit report'
+                 ' to.'
+        ).add_to(parser)
+        Argument(
+            '--policy',
+            action='store',
+            choices=('latest', 'worst'),
+            default='latest',
+            help='Which result of a suite in more than one input to keep.'
+                 ' Either the one given last, or the one with the worst'
+                 ' outcome.'
+        ).add_to(parser)
+
+class ReportParser(ArgParser):
+    '''
+    Parser for the \'report\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'report',
+            help='''Generate a static HTML report of a run.'''
+        )
+        super(ReportParser, self).__init__(parser)
+
+        Argument(
+            'results',
+            nargs='?',
+            default=None,
+            help='Result directory or result file to report on. (Defaults to'
+                 ' the result path.)'
+        ).add_to(parser)
+        Argument(
+            '--output',
+            action='store',
+            default=None,
+            help='Directory to write the report to. (Defaults to report in'
+                 ' the result path.)'
+        ).add_to(parser)
 
 class ClientParser(ArgParser):
     '''
@@ -532,12 +949,49 @@ class ClientParser(ArgParser):
         super(ClientParser, self).__init__(parser)
 
         common_args.credentials_file.add_to(parser)
+        common_args.transport.add_to(parser)
+        common_args.prefetch.add_to(parser)
+        common_args.build_dir.add_to(parser)
+        common_args.targets.add_to(parser)
+        common_args.artifact_cache.add_to(parser)
+        common_args.artifact_cache_size.add_to(parser)
+
+        mytags = common_args.tags.copy()
+        mytags.kwargs['help'] = ('Only run suites marked with one of the given'
+                                 ' tags.')
+        mytags.add_to(parser)
 
         arg = common_args.threads.copy()
         arg.kwargs['help'] = ('The number of helper instances to spawn on'
                               ' this client.')
         arg.add_to(parser)
 
+class ServeParser(ArgParser):
+    '''
+    Parser for the \'serve\' command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'serve',
+            help='''Keep a work server running for runs given --server.'''
+        )
+
+        super(ServeParser, self).__init__(parser)
+
+        common_args.credentials_file.add_to(parser)
+        common_args.transport.add_to(parser)
+        common_args.lease_timeout.add_to(parser)
+        common_args.max_attempts.add_to(parser)
+        common_args.priority_aging.add_to(parser)
+        common_args.metrics_port.add_to(parser)
+        common_args.prefetch.add_to(parser)
+        common_args.build_dir.add_to(parser)
+
+        arg = common_args.threads.copy()
+        arg.kwargs['help'] = ('The number of workers to start on this'
+                              ' machine.')
+        arg.add_to(parser)
+
 config = _Config()
 define_constants(config.constants)
 
@@ -566,7 +1020,12 @@ def initialize_config():
     runparser = RunParser(baseparser.subparser)
     listparser = ListParser(baseparser.subparser)
     rerunparser = RerunParser(baseparser.subparser)
+    historyparser = HistoryParser(baseparser.subparser)
+    compareparser = CompareParser(baseparser.subparser)
+    mergeparser = MergeParser(baseparser.subparser)
+    reportparser = ReportParser(baseparser.subparser)
     clientparser = ClientParser(baseparser.subparser)
+    serveparser = ServeParser(baseparser.subparser)
 
     # Initialize the config by parsing args and running callbacks.
     config._init(baseparser)
@@ -1,10 +1,11 @@
 import os
-import tempfile
 
+from .. import artifacts
 from ..fixture import Fixture
 from ..config import config, constants
 from ..helper import log_call, cacheresult, joinpath, absdirpath
 from ..logger import log
+from ..retention import mkdtemp
 
 
 class VariableFixture(Fixture):
@@ -22,7 +23,9 @@ class TempdirFixture(Fixture):
         self.path = None
 
     def setup(self):
-        self.path = tempfile.mkdtemp()
+        # Mark the directory with our pid so it can be collected once we
+        # exit. (See whimsy.retention.collect_tempdirs.)
+        self.path = mkdtemp()
 
 
 class SConsFixture(Fixture):
@@ -92,16 +95,33 @@ class SConsTarget(Fixture):
         return self
 
 class Gem5Fixture(SConsTarget):
-    def __init__(self, isa, optimization):
+    def __init__(self, isa, optimization, cores=1, memory=0):
+        '''
+        :param cores: The number of cores a client needs to run tests using
+            the binary.
+
+        :param memory: The megabytes of memory a client needs to run tests
+            using the binary.
+        '''
         target = joinpath(isa.upper(), 'gem5.%s' % optimization)
         super(Gem5Fixture, self).__init__(target)
         self.name = constants.gem5_binary_fixture_name
         self.path = self.target
+        # The name of the binary relative to the build directory, which is
+        # the same on every client.
+        self.build_target = target
         self.isa = isa
         self.optimization = optimization
+        self.cores = cores
+        self.memory = memory
 
     def setup(self):
-        if config.skip_build:
+        # Clients without the build directory run the binary of the server.
+        fetched = artifacts.fetch(self.target)
+        if fetched is not None:
+            log.debug('Fetched %s from the server' % self.target)
+            self.path = fetched
+        elif config.skip_build:
             log.debug('Skipping build of %s' % self.target)
         else:
             super(Gem5Fixture, self).setup()
@@ -161,9 +181,13 @@ class TestProgram(MakeTarget):
         self.recompile = recompile
 
     def setup(self):
-        # Check if the program exists if it does then only compile if
-        # recompile was given.
-        if self.recompile:
+        # Clients without the program take it from the server. Otherwise check
+        # if the program exists if it does then only compile if recompile was
+        # given.
+        fetched = artifacts.fetch(self.path)
+        if fetched is not None:
+            self.path = fetched
+        elif self.recompile:
             super(MakeTarget, self).setup()
         elif not os.path.exists(self.path):
             super(MakeTarget, self).setup()
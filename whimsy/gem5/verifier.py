@@ -3,6 +3,7 @@ Built in test cases that verify particular details about a gem5 run.
 '''
 import re
 
+from .. import artifacts
 from .. import test
 from ..config import constants
 from .._util import diff_out_file
@@ -42,7 +43,7 @@ class MatchGoldStandard(Verifier):
         tempdir = fixtures[constants.tempdir_fixture_name].path
         self.test_filename = joinpath(tempdir, self.test_filename)
 
-        diff = diff_out_file(self.standard_filename,
+        diff = diff_out_file(artifacts.resolve(self.standard_filename),
                                    self.test_filename,
                                    self.ignore_regex)
         if diff is not None:
@@ -6,6 +6,10 @@ Helper classes for writing tests with this test library.
     `subprocess.check_call()` but will pipe output to the
     log at a low verbosity level.
 
+* :func:`resource_accounting`
+    A context manager which totals the resources used by processes started
+    with :func:`log_call` inside of it.
+
 * :func:`cacheresult`
     A function decorator which will cache results for a function given the
     same arguments. (A poor man's python3 `lru_cache`.)
@@ -22,11 +26,14 @@ Helper classes for writing tests with this test library.
 * :func:`mkdir_p`
     Same thing as mkdir -p
 '''
+import contextlib
 import errno
 import subprocess
+import sys
 import tempfile
 import os
-from threading import Thread
+import threading
+from threading import Event
 from collections import MutableSet
 
 # We will export CalledProcessError
@@ -37,6 +44,8 @@ from subprocess import CalledProcessError
 from collections import OrderedDict
 
 import logger
+from reactor import reactor
+from timeline import timeline
 __all__ = [
         'log_call',
         'CalledProcessError',
@@ -79,33 +88,175 @@ def log_call(command, *popenargs, **kwargs):
 
     kwargs['stdout'] = subprocess.PIPE
     kwargs['stderr'] = subprocess.PIPE
-    p = subprocess.Popen(command, *popenargs, **kwargs)
-
-    def log_output(log_level, pipe, redirects=tuple()):
-        # Read iteractively, don't allow input to fill the pipe.
-        for line in iter(pipe.readline, ''):
-            for r in redirects:
-                r.write(line)
-            line = line.rstrip()
-            logger.log.log(log_level, line)
-
-    stdout_thread = Thread(target=log_output,
-                           args=(logger.TRACE, p.stdout, stdout_redirect))
-    stdout_thread.setDaemon(True)
-    stderr_thread = Thread(target=log_output,
-                           args=(logger.TRACE, p.stderr, stderr_redirect))
-    stderr_thread.setDaemon(True)
-
-    stdout_thread.start()
-    stderr_thread.start()
-
-    retval = p.wait()
-    stdout_thread.join()
-    stderr_thread.join()
+
+    with timeline.span(cmdstr, 'subprocess'):
+        p = subprocess.Popen(command, *popenargs, **kwargs)
+
+        # Let the shared reactor read from our pipes so we don't need to
+        # spawn threads for every call.
+        readers = (_PipeReader(p.stdout, logger.TRACE, stdout_redirect),
+                   _PipeReader(p.stderr, logger.TRACE, stderr_redirect))
+        for reader in readers:
+            reactor.register(reader.pipe.fileno(), reader.feed)
+
+        (retval, rusage) = _wait_rusage(p)
+        try:
+            readers[0].wait()
+        finally:
+            # Close the other pipe even if writing out the first failed.
+            readers[1].wait()
+
+    if rusage is not None:
+        for usage in _active_usages():
+            usage.add_rusage(rusage)
     # Return the return exit code of the process.
     if retval != 0:
         raise CalledProcessError(retval, cmdstr)
 
+def _wait_rusage(p):
+    '''
+    Wait for the given Popen process to exit.
+
+    :returns: A tuple of the returncode of the process and the
+        :code:`resource.struct_rusage` it used. (None if unavailable.)
+    '''
+    if not hasattr(os, 'wait4'):
+        return (p.wait(), None)
+    while True:
+        try:
+            (_, status, rusage) = os.wait4(p.pid, 0)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                # Someone else reaped the process already.
+                return (p.wait(), None)
+            raise
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        # Popen would otherwise try to reap the process again.
+        p.returncode = returncode
+        return (returncode, rusage)
+
+class ResourceUsage(object):
+    '''
+    Totals of the resources used by child processes.
+
+    :var utime: User CPU time in seconds.
+    :var stime: System CPU time in seconds.
+    :var maxrss: The largest maximum resident set size (KB) of any process.
+    :var inblock: Filesystem blocks read.
+    :var oublock: Filesystem blocks written.
+    :var nvcsw: Voluntary context switches.
+    :var nivcsw: Involuntary context switches.
+    :var processes: Number of processes included in the totals.
+    '''
+    summed = ('utime', 'stime', 'inblock', 'oublock', 'nvcsw', 'nivcsw',
+              'processes')
+
+    def __init__(self):
+        for attr in self.summed:
+            setattr(self, attr, 0)
+        self.maxrss = 0
+
+    def add_rusage(self, rusage):
+        '''Add the given :code:`resource.struct_rusage` of a process.'''
+        self.utime += rusage.ru_utime
+        self.stime += rusage.ru_stime
+        self.inblock += rusage.ru_inblock
+        self.oublock += rusage.ru_oublock
+        self.nvcsw += rusage.ru_nvcsw
+        self.nivcsw += rusage.ru_nivcsw
+        self.processes += 1
+        self.maxrss = max(self.maxrss, rusage.ru_maxrss)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%s' % (attr, getattr(self, attr))
+                                     for attr in self.summed + ('maxrss',)))
+
+# Usages which log_call results are currently being added to, kept per
+# thread so tests run on other threads aren't charged for each other's
+# processes.
+_accounting = threading.local()
+
+def _active_usages():
+    if not hasattr(_accounting, 'usages'):
+        _accounting.usages = []
+    return _accounting.usages
+
+@contextlib.contextmanager
+def resource_accounting():
+    '''
+    Total the resources used by processes started with :func:`log_call`
+    by this thread while inside of this context manager. These can be
+    nested.
+
+    >>> with resource_accounting() as usage:
+    >>>     log_call(['gem5.opt', 'config.py'])
+    >>> print usage.maxrss
+    '''
+    usage = ResourceUsage()
+    _active_usages().append(usage)
+    try:
+        yield usage
+    finally:
+        _active_usages().remove(usage)
+
+class _PipeReader(object):
+    '''
+    Receives chunks of output from a subprocess pipe through the
+    :data:`whimsy.reactor.reactor` and writes them into redirect streams.
+    The chunks are only split into lines when they will actually be logged.
+    '''
+    def __init__(self, pipe, log_level, redirects=tuple()):
+        self.pipe = pipe
+        self.log_level = log_level
+        self.redirects = redirects
+        self._partial_line = ''
+        self._finished = Event()
+        # The exc_info of the first failure writing out a chunk.
+        self._error = None
+
+    def feed(self, data):
+        '''Handle a chunk of data read from the pipe, an empty chunk is EOF.'''
+        try:
+            if self._error is None:
+                self._write(data)
+        except Exception:
+            # Keep draining the pipe so the process doesn't block writing to
+            # it, wait() raises the error.
+            self._error = sys.exc_info()
+        finally:
+            if not data:
+                self._finished.set()
+
+    def _write(self, data):
+        for r in self.redirects:
+            r.write(data)
+
+        if logger.log.isEnabledFor(self.log_level):
+            lines = (self._partial_line + data).split('\n')
+            self._partial_line = lines.pop()
+            for line in lines:
+                logger.log.log(self.log_level, line.rstrip())
+            if not data and self._partial_line:
+                logger.log.log(self.log_level, self._partial_line.rstrip())
+
+    def wait(self):
+        '''
+        Wait until the pipe has been completely read and close it.
+
+        :raises: The error raised writing out the output, if any.
+        '''
+        self._finished.wait()
+        self.pipe.close()
+        if self._error is not None:
+            (error_type, error, traceback) = self._error
+            raise error_type, error, traceback
+
 
 # lru_cache stuff (Introduced in python 3.2+)
 # Renamed and modified to cacheresult
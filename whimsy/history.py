@@ -0,0 +1,217 @@
+'''
+Implements a SQLite backed store of the results of every run. Where the
+``pickle`` result file only holds the most recent run, the history database
+keeps the outcome, runtime, reason and resource usage of every test and suite
+along with the id of the run they were a part of. Items are not unique by uid
+within a run (the suites of testfunctions in the same file share one) so each
+result gets a row of its own.
+
+The :class:`HistoryLogger` is a :class:`whimsy.result.ResultLogger` which adds
+results to the database as they are reported. :class:`ResultHistory` exposes
+queries over the stored runs, these are used by the ``history`` command.
+'''
+import hashlib
+import socket
+import sqlite3
+import sys
+import time
+
+from result import ResultLogger, TestCaseResult, TestSuiteResult, \
+        PASS, XFAIL, FAIL, ERROR
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    finished REAL,
+    hostname TEXT,
+    command TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    result_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    uid TEXT NOT NULL,
+    name TEXT,
+    kind TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    runtime REAL,
+    reason_hash TEXT,
+    utime REAL,
+    stime REAL,
+    maxrss INTEGER,
+    inblock INTEGER,
+    oublock INTEGER,
+    nvcsw INTEGER,
+    nivcsw INTEGER
+);
+CREATE TABLE IF NOT EXISTS tags (
+    result_id INTEGER NOT NULL REFERENCES results(result_id),
+    tag TEXT NOT NULL,
+    PRIMARY KEY (result_id, tag)
+);
+CREATE INDEX IF NOT EXISTS results_by_uid ON results (uid, run_id);
+CREATE INDEX IF NOT EXISTS results_by_kind ON results (kind, run_id);
+CREATE INDEX IF NOT EXISTS results_by_run ON results (run_id);
+CREATE INDEX IF NOT EXISTS tags_by_tag ON tags (tag);
+'''
+
+SUITE = 'suite'
+CASE = 'case'
+
+_passing = (PASS.name, XFAIL.name)
+_failing = (FAIL.name, ERROR.name)
+
+# Restricts a query to the results of the last N runs.
+_last_runs = ('run_id IN (SELECT run_id FROM runs'
+              ' ORDER BY run_id DESC LIMIT ?)')
+
+class ResultHistory(object):
+    '''
+    Wraps a connection to the history database and exposes queries over the
+    stored results.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(schema)
+
+    def start_run(self, command=None):
+        '''Create a new run returning its run_id.'''
+        cursor = self.connection.execute(
+                'INSERT INTO runs (started, hostname, command)'
+                ' VALUES (?, ?, ?)',
+                (time.time(), socket.gethostname(), command))
+        self.connection.commit()
+        return cursor.lastrowid
+
+    def finish_run(self, run_id):
+        self.connection.execute(
+                'UPDATE runs SET finished = ? WHERE run_id = ?',
+                (time.time(), run_id))
+        self.connection.commit()
+
+    def add_result(self, run_id, result):
+        '''Add the given :class:`whimsy.result.TestResult` to the run.'''
+        if isinstance(result, TestSuiteResult):
+            kind = SUITE
+        else:
+            kind = CASE
+
+        reason = getattr(result, 'reason', None)
+        reason_hash = None
+        if reason is not None:
+            reason_hash = hashlib.sha1(str(reason)).hexdigest()
+
+        usage = result.resource_usage
+        if usage is None:
+            usage_values = (None,) * 7
+        else:
+            usage_values = (usage.utime, usage.stime, usage.maxrss,
+                            usage.inblock, usage.oublock, usage.nvcsw,
+                            usage.nivcsw)
+
+        cursor = self.connection.execute(
+                'INSERT INTO results (run_id, uid, name, kind, outcome,'
+                ' runtime, reason_hash, utime, stime, maxrss, inblock,'
+                ' oublock, nvcsw, nivcsw)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, result.uid, result.name, kind, result.outcome.name,
+                 result.runtime, reason_hash) + usage_values)
+        self.connection.executemany(
+                'INSERT INTO tags VALUES (?, ?)',
+                ((cursor.lastrowid, tag) for tag in set(result.tags)))
+
+    def commit(self):
+        self.connection.commit()
+
+    def slowest_suites(self, runs=20, limit=10):
+        '''
+        Return the suites with the largest mean runtime over the last `runs`
+        runs.
+
+        :returns: List of :code:`(uid, mean runtime, max runtime, runs)`
+        '''
+        return self.connection.execute(
+                'SELECT uid, AVG(runtime), MAX(runtime),'
+                ' COUNT(DISTINCT run_id)'
+                ' FROM results WHERE kind = ? AND ' + _last_runs +
+                ' GROUP BY uid ORDER BY AVG(runtime) DESC LIMIT ?',
+                (SUITE, runs, limit)).fetchall()
+
+    def mean_runtimes(self, runs=20):
+        '''
+        Return a dictionary mapping suite uid to its mean runtime over the
+        last `runs` runs.
+        '''
+        return dict(self.connection.execute(
+                'SELECT uid, AVG(runtime) FROM results'
+                ' WHERE kind = ? AND ' + _last_runs + ' GROUP BY uid',
+                (SUITE, runs)))
+
+    def first_failure(self, uid):
+        '''
+        Return the first run of the current streak of failures of the given
+        uid. (The first failing run after the last run it passed in.)
+
+        :returns: A tuple :code:`(run_id, started)` or None if the item has
+            not failed since it last passed.
+        '''
+        (last_pass,) = self.connection.execute(
+                'SELECT MAX(run_id) FROM results WHERE uid = ?'
+                ' AND outcome IN (?, ?)', (uid,) + _passing).fetchone()
+        return self.connection.execute(
+                'SELECT runs.run_id, runs.started FROM results'
+                ' JOIN runs USING (run_id)'
+                ' WHERE uid = ? AND outcome IN (?, ?) AND run_id > ?'
+                ' ORDER BY run_id LIMIT 1',
+                (uid,) + _failing + (last_pass or 0,)).fetchone()
+
+    def pass_rate_by_tag(self, runs=20):
+        '''
+        Return the fraction of suites and test cases with each tag which
+        passed over the last `runs` runs. (Tags given to
+        :func:`whimsy.test.testfunction` are on test cases rather than
+        their suite.)
+
+        :returns: List of :code:`(tag, pass rate, count)`
+        '''
+        return self.connection.execute(
+                'SELECT tag, AVG(outcome IN (?, ?)), COUNT(*)'
+                ' FROM results JOIN tags USING (result_id)'
+                ' WHERE results.' + _last_runs +
+                ' GROUP BY tag ORDER BY tag',
+                _passing + (runs,)).fetchall()
+
+
+class HistoryLogger(ResultLogger):
+    '''
+    Logger which adds each test case and suite result to
+    a :class:`ResultHistory` under a new run. Results are committed as each
+    suite completes.
+    '''
+    def __init__(self, history):
+        self.history = history
+        self.run_id = None
+
+    def begin_testing(self):
+        self.run_id = self.history.start_run(' '.join(sys.argv))
+
+    def set_outcome(self, item, **kwargs):
+        self.delegate_instance(self.set_outcome, item, **kwargs)
+
+    def _set_outcome_testcase(self, item, **kwargs):
+        self.history.add_result(self.run_id,
+                                TestCaseResult(item=item, **kwargs))
+
+    def _set_outcome_testsuite(self, item, **kwargs):
+        self.history.add_result(self.run_id,
+                                TestSuiteResult([], item=item, **kwargs))
+        self.history.commit()
+
+    def insert_results(self, internal_results):
+        for result in internal_results.results:
+            self.history.add_result(self.run_id, result)
+        self.history.commit()
+
+    def end_testing(self):
+        self.history.finish_run(self.run_id)
@@ -72,7 +72,9 @@ from fixture import Fixture
 from helper import OrderedSet, absdirpath, OrderedDict
 from logger import log
 from suite import TestSuite, SuiteList, TestList
+from profiler import profiler
 from test import TestCase
+from timeline import timeline
 from uid import path_from_uid
 
 # Will match filenames that either begin or end with 'test' or tests and use
@@ -334,14 +336,16 @@ class TestLoader(object):
                 if __debug__:
                     _assert_files_in_same_dir(directory)
                 for f in directory:
-                    self.load_file(f)
+                    with timeline.span(f, 'load'), profiler.profile('load'):
+                        self.load_file(f)
 
     def load_dir(self, directory):
         for dir_ in self.discover_files(directory):
             if __debug__:
                 _assert_files_in_same_dir(dir_)
             for f in dir_:
-                self.load_file(f)
+                with timeline.span(f, 'load'), profiler.profile('load'):
+                    self.load_file(f)
             break
 
     @staticmethod
@@ -15,18 +15,39 @@ There are three commands which this program handles:
     run.
 
 * list  - List tests with various querying options.
+
+* history - Query the results of previous runs stored in the history database.
+
+* compare - Report the differences between the results of two runs.
+
+* merge - Merge the results of several runs into one result file and junit
+    report.
+
+* report - Generate a static HTML report of a run.
 '''
+import os
+
 import logger
+import merge
+import progress
 import query
+import report
 import result
 
 import config
+from compare import Comparison
+from history import HistoryLogger, ResultHistory
 from test import TestCase
 from helper import joinpath, mkdir_p
+from retention import RetentionManager, claim_result_path
+from resultfile import ResultFileReader, SUITE, open_results, \
+        result_file_path
 from loader import TestLoader
 from logger import log
-from runner import Runner, WorkClient
+from profiler import profiler
+from runner import Runner, WorkClient, WorkDaemon
 from terminal import separator
+from timeline import timeline
 
 # TODO: Standardize separator usage.
 # Probably make it the caller responsiblity to place separators and internal
@@ -43,10 +64,23 @@ def load_tests():
     testloader.load_root(config.config.directory)
     return testloader
 
+def open_jsonl(dest):
+    '''
+    Open the destination given to the --jsonl flag, either a path or fd:N for
+    an open file descriptor.
+    '''
+    if dest.startswith('fd:'):
+        return os.fdopen(int(dest[len('fd:'):]), 'w')
+    return open(dest, 'w')
+
 def dorun():
     '''
     Handle the `run` command.
     '''
+    if config.config.trace_file:
+        timeline.enable()
+    profiler.enable(config.config.profile)
+
     loader = load_tests()
 
     if config.config.tags:
@@ -57,14 +91,40 @@ def dorun():
         suites = loader.suites
 
     # Create directory to save junit and internal results in.
-    mkdir_p(config.config.result_path)
+    claim_result_path(config.config.result_path)
 
-    with open(joinpath(config.config.result_path, 'pickle'), 'w') as result_file,\
+    # Move the previous run out of our way and archive it in the background.
+    retention = RetentionManager(config.config.result_path,
+                                 config.config.keep_runs,
+                                 config.config.keep_failures_only,
+                                 preserve=(config.config.history_db,),
+                                 collect=config.config.collect_tempdirs)
+    retention.stage()
+    retention.start()
+
+    with open(joinpath(config.config.result_path, 'pickle'), 'wb') as result_file,\
          open(joinpath(config.config.result_path, 'junit.xml'), 'w') as junit_f:
 
-        junit_logger = result.JUnitLogger(junit_f, result_file)
+        internal_logger = result.InternalLogger(result_file)
+        junit_logger = result.StreamingJUnitLogger(
+                junit_f, config.config.junit_workers)
         console_logger = result.ConsoleLogger()
-        loggers = (junit_logger, console_logger)
+        loggers = [internal_logger, junit_logger, console_logger]
+        history = None
+        if not config.config.no_history:
+            history = ResultHistory(config.config.history_db)
+            loggers.append(HistoryLogger(history))
+        jsonl_f = None
+        if config.config.jsonl:
+            jsonl_f = open_jsonl(config.config.jsonl)
+            loggers.append(result.JSONLinesLogger(jsonl_f))
+        if progress.interactive():
+            expected_runtimes = {}
+            if history is not None:
+                expected_runtimes = history.mean_runtimes()
+            loggers.insert(0, progress.ProgressLogger(suites,
+                                                      expected_runtimes,
+                                                      config.config.threads or 1))
 
         log.display(separator())
         log.bold('Running Tests')
@@ -82,33 +142,54 @@ def dorun():
             testrunner = Runner(suites, loggers)
             results = testrunner.run()
 
+        if jsonl_f is not None:
+            jsonl_f.close()
+
+    retention.join()
+
+    profiler.dump(config.config.result_path)
+    if config.config.trace_file:
+        timeline.dump(config.config.trace_file)
+
 def dorerun():
     '''
     Handle the `rerun` command.
     '''
-    # Load previous results
+    if config.config.trace_file:
+        timeline.enable()
+    profiler.enable(config.config.profile)
+
+    # Load previous results, only the uids of failed suites.
     # TODO Catch bad file path error or load error.
-    with open(joinpath(config.config.result_path, 'pickle'), 'r') as old_fstream:
-        old_formatter = result.InternalLogger.load(old_fstream)
+    with open(joinpath(config.config.result_path, 'pickle'), 'rb') as old_fstream:
+        reader = ResultFileReader(old_fstream)
+        failed_uids = [suite.uid for suite in reader.with_outcome(
+                SUITE, result.Outcome.FAIL, result.Outcome.ERROR)]
 
     # Load tests
     loader = load_tests()
 
     # Get the self contained suites which hold tests that fail and run each.
-    reruns = []
-    for suite in old_formatter.suites:
-        if suite.outcome in (result.Outcome.FAIL, result.Outcome.ERROR):
-            suite = loader.get_uid(suite.uid)
-            reruns.append(suite)
+    reruns = [loader.get_uid(uid) for uid in failed_uids]
 
     # Run only the suites we need to rerun.
     testrunner = Runner(reruns)
     testrunner.run()
 
+    profiler.dump(config.config.result_path)
+    if config.config.trace_file:
+        timeline.dump(config.config.trace_file)
+
 def dolist():
     '''
     Handle the `list` command.
     '''
+    if config.config.list_only_failed:
+        with open(joinpath(config.config.result_path, 'pickle'), 'rb') \
+                as result_file:
+            query.list_failed(ResultFileReader(result_file))
+        return
+
     loader = load_tests()
     if config.config.tags:
         query.list_tests_with_tags(loader, config.config.tags)
@@ -121,6 +202,69 @@ def dolist():
     if config.config.all_tags:
         query.list_tags(loader)
 
+def dohistory():
+    '''
+    Handle the `history` command.
+    '''
+    history = ResultHistory(config.config.history_db)
+    if config.config.slowest:
+        query.list_slowest_suites(history, config.config.runs,
+                                  config.config.slowest)
+    if config.config.first_failure:
+        query.show_first_failure(history, config.config.first_failure)
+    if config.config.pass_rate:
+        query.list_pass_rates(history, config.config.runs)
+
+def docompare():
+    '''
+    Handle the `compare` command.
+    '''
+    old = open_results(config.config.old)
+    new = open_results(config.config.new)
+    comparison = Comparison(old, new,
+                            config.config.runtime_threshold / 100.0,
+                            config.config.memory_threshold / 100.0,
+                            config.config.min_runtime)
+    query.show_comparison(comparison)
+
+def domerge():
+    '''
+    Handle the `merge` command.
+    '''
+    output = config.config.output
+    result_fname = joinpath(output, 'pickle')
+    inputs = [result_file_path(path) for path in config.config.inputs]
+    if os.path.realpath(result_fname) in map(os.path.realpath, inputs):
+        log.bold('Cannot write the merged results over one of the inputs.')
+        return
+
+    readers = [open_results(path) for path in inputs]
+    mkdir_p(output)
+    with open(result_fname, 'wb') as result_file,\
+         open(joinpath(output, 'junit.xml'), 'w') as junit_f:
+        count = merge.write_merged(
+                merge.merge_suites(readers, config.config.policy),
+                result_file,
+                result.StreamingJUnitLogger(junit_f))
+
+    log.bold('Merged %d suites from %d result files into %s'
+             % (count, len(readers), output))
+
+def doreport():
+    '''
+    Handle the `report` command.
+    '''
+    results = config.config.results
+    if results is None:
+        results = config.config.result_path
+    output = config.config.output
+    if output is None:
+        output = joinpath(config.config.result_path, 'report')
+
+    count = report.generate(open_results(results), output)
+    log.bold('Wrote a report of %d tests to %s'
+             % (count, joinpath(output, 'index.html')))
+
 def doclient():
     '''
     Handle the `client` command.
@@ -147,6 +291,15 @@ def doclient():
 
     # TODO: Spawn other clents based on the number of threads given.
 
+def doserve():
+    '''
+    Handle the `serve` command.
+    '''
+    daemon = WorkDaemon(*config.config.credentials,
+                        threads=config.config.threads or 1)
+    log.bold('Serving runs given --server, interrupt to stop.')
+    daemon.serve()
+
 def main():
     # Start logging verbosity at its minimum
     logger.set_logging_verbosity(0)
@@ -0,0 +1,90 @@
+'''
+Merges the results of several runs (for instance shards of a run split across
+machines, or repeated runs) into a single deduplicated result set for the
+``merge`` command.
+
+Results are merged by suite. Suites are matched across inputs by uid and,
+for the suites of a uid several share (such as the suites of testfunctions
+in the same file), the order they were written in. When more than one input
+holds a suite the winner is picked by a conflict policy using the summaries
+in the indexes (see :mod:`whimsy.resultfile`), so only the winning result of
+each suite is loaded and it is written out before the next is read. The
+indexes of the inputs are held in memory.
+
+Conflict policies:
+
+* latest - The result from the input given last wins.
+* worst  - The result with the most severe outcome wins, ties go to the input
+  given last.
+'''
+from result import Outcome
+from resultfile import ResultFileWriter, SUITE
+
+LATEST = 'latest'
+WORST = 'worst'
+policies = (LATEST, WORST)
+
+# Outcomes are enumerated in order of severity.
+_severity = dict((outcome.name, severity)
+                 for (severity, outcome) in enumerate(Outcome.enums))
+
+def merge_suites(readers, policy=LATEST):
+    '''
+    Yield the winning suite result of each suite in the given readers, in the
+    order the suites first appear in the inputs.
+
+    :param readers: :class:`whimsy.resultfile.ResultFileReader` of each input
+        in the order they were given.
+    :param policy: One of :data:`policies`
+    '''
+    if policy == LATEST:
+        def rank(key, number):
+            return number
+    elif policy == WORST:
+        def rank(key, number):
+            summary = readers[number].summary(*key)
+            return (_severity[summary.outcome], number)
+    else:
+        raise ValueError('Unknown conflict policy %s' % policy)
+
+    keys = [reader.keys(SUITE) for reader in readers]
+    winners = {}
+    for (number, reader_keys) in enumerate(keys):
+        for key in reader_keys:
+            winner = winners.get(key)
+            if winner is None or rank(key, number) > rank(key, winner):
+                winners[key] = number
+
+    for reader_keys in keys:
+        for key in reader_keys:
+            winner = winners.pop(key, None)
+            if winner is not None:
+                yield readers[winner].get(*key)
+
+def write_merged(suites, result_fstream, junit_logger):
+    '''
+    Write the given suite results to a new result file and junit report.
+
+    :param suites: Iterable of :class:`whimsy.result.TestSuiteResult`
+    :param junit_logger: :class:`whimsy.result.StreamingJUnitLogger` to add
+        the suites to.
+
+    :returns: The number of suites written.
+    '''
+    writer = ResultFileWriter(result_fstream)
+    junit_logger.begin_testing()
+
+    count = 0
+    runtime = 0
+    for suite in suites:
+        # Keep the order the InternalLogger writes in, test cases first.
+        for testcase in suite.test_case_results:
+            writer.write(testcase)
+        writer.write(suite)
+        junit_logger.write_suite(suite)
+        count += 1
+        runtime += suite.runtime
+
+    writer.close()
+    junit_logger.end_testing(runtime=runtime)
+    return count
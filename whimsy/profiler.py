@@ -0,0 +1,134 @@
+'''
+Opt-in cProfile hooks around the phases of a run. Phases are enabled with the
+``--profile`` flag and are one of:
+
+* load  - Loading test files.
+* setup - Fixture setup.
+* test  - The body of each test case.
+* log   - Result logger callbacks.
+
+Phases that happen for a specific test (setup and test) write a profile named
+after the phase into that test's output directory, adding to the one already
+written there during the run. Other phases are collected into a single
+profile for the process. At the end of the run :meth:`dump` writes the
+process profiles into the result directory along with a ``profile.prof``
+which aggregates every profile written during the run. Workers of parallel
+runs write theirs as ``<phase>.<worker>.prof`` when they go idle, every so
+often while they are kept busy and when they exit, so the aggregate holds
+what they had written by the end of the run.
+
+The files can be inspected with :mod:`pstats` or tools such as snakeviz.
+'''
+import contextlib
+import cProfile
+import glob
+import os
+import pstats
+import time
+
+from helper import joinpath
+
+phases = ('load', 'setup', 'test', 'log')
+
+class Profiler(object):
+    '''
+    Enables cProfile around phases of the run which have been enabled.
+    '''
+    aggregate_name = 'profile.prof'
+
+    def __init__(self):
+        self.phases = set()
+        self._process_profiles = {}
+        self._active = False
+        self._started = None
+
+    def enable(self, phases):
+        '''Start profiling the given iterable of phases.'''
+        self.phases.update(phases)
+        if self._started is None:
+            self._started = time.time()
+
+    @contextlib.contextmanager
+    def profile(self, phase, outdir=None):
+        '''
+        Profile the body of the with statement if the phase is enabled.
+
+        :param outdir: If given, the body is profiled on its own and written
+            to `<outdir>/<phase>.prof`. Otherwise it is added into the
+            profile for the whole process.
+        '''
+        # cProfile can only have a single profiler enabled at once, so an
+        # inner phase is included in the outer phase's profile.
+        if phase not in self.phases or self._active:
+            yield
+            return
+
+        if outdir is None:
+            prof = self._process_profiles.setdefault(phase,
+                                                     cProfile.Profile())
+        else:
+            prof = cProfile.Profile()
+
+        self._active = True
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            self._active = False
+            if outdir is not None:
+                self._dump_into(prof, joinpath(outdir, phase + '.prof'))
+
+    def _dump_into(self, prof, fname):
+        '''
+        Write the profile to fname, adding in the profile already there if it
+        was written during this run.
+        '''
+        stats = pstats.Stats(prof)
+        if self._written_this_run(fname):
+            stats.add(fname)
+        stats.dump_stats(fname)
+
+    def _written_this_run(self, fname):
+        return os.path.exists(fname) \
+                and os.path.getmtime(fname) >= self._started
+
+    def dump(self, result_path, process=None):
+        '''
+        Write our process profiles into the result_path and aggregate them
+        with every per-test profile written since we were enabled.
+
+        :param process: The name of a worker process. Its profiles are named
+            after it and left for the main process to aggregate.
+        '''
+        if not self.phases:
+            return
+
+        for phase, prof in self._process_profiles.items():
+            if process is None:
+                fname = joinpath(result_path, phase + '.prof')
+            else:
+                fname = joinpath(result_path,
+                                 '%s.%s.prof' % (phase, process))
+            prof.dump_stats(fname)
+        if process is not None:
+            return
+
+        aggregate = None
+        profiles = glob.glob(joinpath(result_path, '*.prof'))
+        profiles.extend(glob.glob(joinpath(result_path, '*', '*.prof')))
+        for fname in profiles:
+            # Ignore old aggregates and profiles left over from past runs.
+            if os.path.basename(fname) == self.aggregate_name \
+                    or not self._written_this_run(fname):
+                continue
+            if aggregate is None:
+                aggregate = pstats.Stats(fname)
+            else:
+                aggregate.add(fname)
+
+        if aggregate is not None:
+            aggregate.dump_stats(joinpath(result_path, self.aggregate_name))
+
+profiler = Profiler()
+'''The profiler shared by everything in this process.'''
@@ -0,0 +1,215 @@
+'''
+Implements the :class:`ProgressLogger` which keeps a live status line at the
+bottom of an interactive terminal while tests run. The line shows the number
+of suites completed, throughput, an estimate of the time remaining and what
+each worker is running.
+
+The line is redrawn by its own thread every
+:attr:`ProgressLogger.refresh_interval` seconds rather than on every event so
+the cost of keeping it up to date doesn't grow with the number of workers.
+Records logged to the console clear the line first so it never gets mixed
+into other output.
+
+The estimate uses the mean runtime of each remaining suite in previous runs
+(see :meth:`whimsy.history.ResultHistory.mean_runtimes`). Suites without any
+history are assumed to take the mean of those with it, or if there is no
+history at all, the mean of the suites completed so far.
+'''
+import collections
+import os
+import threading
+import time
+
+import logger
+import terminal
+from result import ResultLogger
+from suite import TestSuite
+from test import TestCase
+
+def interactive():
+    '''Return True if the console logger is writing to a terminal.'''
+    return os.isatty(logger.saved_stdout.fileno())
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class _ClearStatusFilter(object):
+    '''
+    Logging filter which clears the status line before a record is written.
+    '''
+    def __init__(self, progress_logger):
+        self.progress_logger = progress_logger
+
+    def filter(self, record):
+        self.progress_logger.clear()
+        return True
+
+class ProgressLogger(ResultLogger):
+    '''
+    Logger which displays the progress of the run in a status line.
+
+    :param suites: The suites which will be run.
+    :param expected_runtimes: Dictionary mapping suite uid to its expected
+        runtime in seconds.
+    :param workers: Number of workers running suites at once.
+    '''
+    refresh_interval = 0.5
+    local_worker = 'local'
+    default_width = 80
+
+    clear_line = '\r\x1b[K'
+
+    def __init__(self, suites, expected_runtimes=None, workers=1):
+        self.total = len(suites)
+        self.workers = max(workers, 1)
+        self.completed = 0
+        self._remaining = collections.Counter(suite.uid for suite in suites)
+
+        if expected_runtimes is None:
+            expected_runtimes = {}
+        self._expected = expected_runtimes
+        known = [expected_runtimes[uid] for uid in self._remaining
+                 if expected_runtimes.get(uid) is not None]
+        self._default_runtime = None
+        if known:
+            self._default_runtime = sum(known) / len(known)
+
+        # Map worker to [suite, testcase or None, time suite began]
+        self._running = {}
+        # Short numbers to refer to workers by, in order of appearance.
+        self._worker_numbers = {}
+
+        self._lock = threading.Lock()
+        self._drawn = False
+        self._fd = None
+        self._started = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._filter = _ClearStatusFilter(self)
+
+    def begin_testing(self):
+        self._started = time.time()
+        # Write to a copy of the terminal's fd so the line isn't captured when
+        # stdout is redirected to test output files.
+        self._fd = os.dup(logger.saved_stdout.fileno())
+        logger.stdout_logger.addFilter(self._filter)
+
+        self._thread = threading.Thread(target=self._refresh)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def begin(self, item, worker=None, **kwargs):
+        if worker is None:
+            worker = self.local_worker
+        with self._lock:
+            if isinstance(item, TestSuite):
+                self._worker_numbers.setdefault(worker,
+                                                len(self._worker_numbers) + 1)
+                self._running[worker] = [item, None, time.time()]
+            elif isinstance(item, TestCase) and worker in self._running:
+                self._running[worker][1] = item
+
+    def end(self, item, worker=None, **kwargs):
+        if worker is None:
+            worker = self.local_worker
+        with self._lock:
+            if isinstance(item, TestSuite):
+                self._running.pop(worker, None)
+            elif isinstance(item, TestCase) and worker in self._running:
+                self._running[worker][1] = None
+
+    def set_outcome(self, item, **kwargs):
+        if isinstance(item, TestSuite):
+            self._complete(item.uid)
+
+    def insert_results(self, internal_results):
+        for suite in internal_results.suites:
+            self._complete(suite.uid)
+
+    def _complete(self, uid):
+        with self._lock:
+            self.completed += 1
+            if self._remaining[uid] > 0:
+                self._remaining[uid] -= 1
+
+    def end_testing(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.clear()
+        logger.stdout_logger.removeFilter(self._filter)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _refresh(self):
+        while not self._stop.wait(self.refresh_interval):
+            self._draw()
+
+    def clear(self):
+        '''Clear the status line if it is drawn.'''
+        with self._lock:
+            if self._drawn:
+                os.write(self._fd, self.clear_line)
+                self._drawn = False
+
+    def _draw(self):
+        try:
+            (width, _) = terminal.terminal_size()
+        except IOError:
+            width = 0
+        if not width:
+            width = self.default_width
+
+        with self._lock:
+            line = self._status_line(time.time())
+            os.write(self._fd, self.clear_line + line[:max(width - 1, 0)])
+            self._drawn = True
+
+    def _estimate_remaining(self, now, elapsed):
+        '''
+        Return the estimated seconds of work remaining or None if we have
+        nothing to base an estimate on.
+        '''
+        default = self._default_runtime
+        if default is None:
+            if not self.completed:
+                return None
+            default = elapsed * self.workers / self.completed
+
+        work = 0.0
+        for (uid, count) in self._remaining.iteritems():
+            expected = self._expected.get(uid)
+            work += count * (default if expected is None else expected)
+
+        # Remove the time already spent on running suites.
+        for (suite, _, began) in self._running.itervalues():
+            expected = self._expected.get(suite.uid)
+            if expected is None:
+                expected = default
+            work -= min(now - began, expected)
+
+        return max(work, 0.0) / self.workers
+
+    def _status_line(self, now):
+        elapsed = now - self._started
+        throughput = self.completed * 60.0 / elapsed if elapsed else 0.0
+        remaining = self._estimate_remaining(now, elapsed)
+        if remaining is None:
+            eta = '?'
+        else:
+            eta = _format_duration(remaining)
+
+        running = []
+        for (worker, (suite, testcase, _)) in sorted(
+                self._running.iteritems(),
+                key=lambda entry: self._worker_numbers[entry[0]]):
+            name = suite.name
+            if testcase is not None:
+                name += '/' + testcase.name
+            running.append('#%d %s' % (self._worker_numbers[worker], name))
+
+        return '[%d/%d suites | %.1f/min | %d running | ETA %s] %s' % (
+                self.completed, self.total, throughput, len(running), eta,
+                '  '.join(running))
@@ -2,7 +2,11 @@
 File which implements querying and display logic for metadata about loaded
 items.
 '''
+import time
+
 from logger import log
+from result import Outcome
+from resultfile import SUITE, CASE
 from terminal import separator
 
 def list_fixtures(loader):
@@ -33,6 +37,76 @@ def list_tags(loader):
     for tag in loader.tags:
         log.display(tag)
 
+def list_failed(reader):
+    '''
+    List the uids of the suites and tests which failed in the given
+    :class:`whimsy.resultfile.ResultFileReader`.
+    '''
+    for (kind, title) in ((SUITE, 'TestSuites'), (CASE, 'TestCases')):
+        log.display(separator())
+        log.display('Listing failed %s.' % title)
+        log.display(separator())
+        for result in reader.with_outcome(kind, Outcome.FAIL, Outcome.ERROR):
+            log.display(result.uid)
+
+def list_slowest_suites(history, runs, limit):
+    log.display(separator())
+    log.display('Slowest TestSuites over the last %d runs.' % runs)
+    log.display(separator())
+    for (uid, mean, maximum, count) in history.slowest_suites(runs, limit):
+        log.display('%10.2fs mean %10.2fs max %4d runs  %s'
+                    % (mean, maximum, count, uid))
+
+def show_first_failure(history, uid):
+    log.display(separator())
+    first_failure = history.first_failure(uid)
+    if first_failure is None:
+        log.display("'%s' has not failed since it last passed." % uid)
+    else:
+        (run_id, started) = first_failure
+        log.display("'%s' has been failing since run %d started at %s."
+                    % (uid, run_id, time.ctime(started)))
+
+def list_pass_rates(history, runs):
+    log.display(separator())
+    log.display('Pass rate of TestSuites and TestCases by tag over the last %d'
+                ' runs.' % runs)
+    log.display(separator())
+    for (tag, rate, count) in history.pass_rate_by_tag(runs):
+        log.display('%6.1f%% of %5d  %s' % (rate * 100, count, tag))
+
+def show_comparison(comparison):
+    '''Display a :class:`whimsy.compare.Comparison` of two runs.'''
+    for (title, uids) in (('Newly failing', comparison.newly_failing),
+                          ('Newly passing', comparison.newly_passing),
+                          ('Added', comparison.added),
+                          ('Removed', comparison.removed)):
+        log.display(separator())
+        log.display('%s items (%d).' % (title, len(uids)))
+        log.display(separator())
+        for uid in uids:
+            log.display(uid)
+
+    log.display(separator())
+    log.display('TestSuites with runtime regressions (%d).'
+                % len(comparison.runtime_regressions))
+    log.display(separator())
+    for (uid, old, new) in comparison.runtime_regressions:
+        log.display('%10.2fs -> %10.2fs  %s' % (old, new, uid))
+
+    log.display(separator())
+    log.display('TestSuites with peak memory regressions (%d).'
+                % len(comparison.memory_regressions))
+    log.display(separator())
+    for (uid, old, new) in comparison.memory_regressions:
+        log.display('%8d KB -> %8d KB  %s' % (old, new, uid))
+
+    log.display(separator())
+    if comparison.regressed:
+        log.display('The new run regressed.')
+    else:
+        log.display('No regressions in the new run.')
+
 def list_tests_with_tags(loader, tags):
     log.display('Listing tests based on tags.')
     for tag in tags:
@@ -0,0 +1,114 @@
+'''
+Implements a single shared reactor which multiplexes reads from any number of
+pipes on one thread. :func:`whimsy.helper.log_call` registers the stdout and
+stderr pipes of every subprocess it starts with the :data:`reactor` rather
+than spawning reader threads for each of them.
+
+The reactor uses epoll where it is available and falls back to poll. Data is
+read in chunks of up to :attr:`PipeReactor.chunk_size` bytes and handed to the
+callback registered for the pipe, on end of file the callback is given an
+empty string and the pipe is unregistered.
+
+.. note:: Callbacks are executed on the reactor thread so they should not
+    block, doing so will stall every other registered pipe.
+'''
+import errno
+import os
+import select
+import threading
+import traceback
+
+import logger
+
+class PipeReactor(object):
+    '''
+    Reads from registered file descriptors on a single daemon thread, calling
+    their callbacks with each chunk of data read.
+
+    The thread is started lazily on the first :meth:`register` and is
+    restarted if we find ourselves in a forked child process.
+    '''
+    chunk_size = 64 * 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def register(self, fd, callback):
+        '''
+        Start reading from the given file descriptor.
+
+        :param callback: Called on the reactor thread with each chunk read
+            from `fd`. Called a final time with an empty string once `fd`
+            reaches end of file.
+        '''
+        with self._lock:
+            self._start_if_needed()
+            self._pending.append((fd, callback))
+            os.write(self._wakeup_w, '\0')
+
+    def _start_if_needed(self):
+        # A forked child will not have our thread, so we need to start a new
+        # one dropping any pipes the parent was reading.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = []
+        self._callbacks = {}
+        (self._wakeup_r, self._wakeup_w) = os.pipe()
+
+        thread = threading.Thread(target=self._loop,
+                                  args=(self._wakeup_r, self._callbacks))
+        thread.setDaemon(True)
+        thread.start()
+
+    @staticmethod
+    def _new_poller():
+        if hasattr(select, 'epoll'):
+            return (select.epoll(), select.EPOLLIN | select.EPOLLHUP, -1)
+        return (select.poll(), select.POLLIN | select.POLLHUP, None)
+
+    def _loop(self, wakeup_r, callbacks):
+        (poller, mask, timeout) = self._new_poller()
+        poller.register(wakeup_r, mask)
+
+        while True:
+            try:
+                events = poller.poll(timeout)
+            except (select.error, IOError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for (fd, _) in events:
+                if fd == wakeup_r:
+                    os.read(wakeup_r, self.chunk_size)
+                    with self._lock:
+                        pending = self._pending
+                        self._pending = []
+                    for (new_fd, callback) in pending:
+                        callbacks[new_fd] = callback
+                        poller.register(new_fd, mask)
+                    continue
+
+                try:
+                    data = os.read(fd, self.chunk_size)
+                except OSError as e:
+                    if e.errno in (errno.EINTR, errno.EAGAIN):
+                        continue
+                    data = ''
+
+                if not data:
+                    poller.unregister(fd)
+                    callback = callbacks.pop(fd)
+                else:
+                    callback = callbacks[fd]
+
+                try:
+                    callback(data)
+                except Exception:
+                    logger.log.warn('Exception in pipe reactor callback:\n%s'
+                                    % traceback.format_exc())
+
+reactor = PipeReactor()
+'''The reactor shared by everything in this process.'''
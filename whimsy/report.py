@@ -0,0 +1,304 @@
+'''
+Generates a static HTML report from a result file for the ``report`` command.
+
+The report is a directory holding:
+
+* ``index.html`` - A single page with a table of every test case which can be
+  filtered by outcome, tag, ISA, optimization and name.
+* ``logs/`` - A fragment per test case with its stdout and stderr.
+
+JUnit viewers tend to choke on large runs since the ``junit.xml`` embeds the
+output of every test. To keep the index small and fast to open the results
+are embedded as compact arrays with repeated strings (suites and tags) stored
+once, the page only renders the rows of the current page of the table, and
+the logs are only loaded (in an iframe) when a row is expanded.
+
+A test case is shown with the tags of its suite along with its own. Its ISA
+and optimization are taken from its own tags, or else from those of its suite
+(see :func:`whimsy.gem5.suite.gem5_verify_config`).
+'''
+import json
+import os
+import re
+from xml.sax.saxutils import escape
+
+from config import constants
+from helper import joinpath, mkdir_p
+from result import Outcome
+from resultfile import SUITE
+
+# Number of log fragments placed in each directory under logs/.
+logs_per_dir = 1000
+
+# Terminal escape sequences (colors) and other control characters.
+_control_chars = re.compile('\x1b(\\[[0-9;]*[A-Za-z]|\\(B)'
+                            '|[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+_index_template = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Whimsy Report</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+table { border-collapse: collapse; width: 100%; }
+th, td { text-align: left; padding: 2px 6px; border-bottom: 1px solid #ddd; }
+tr.item { cursor: pointer; }
+tr.item:hover { background: #f4f4f4; }
+.PASS { color: #080; } .XFAIL, .SKIP { color: #088; }
+.FAIL, .ERROR { color: #c00; font-weight: bold; }
+iframe { width: 100%; height: 30em; border: 1px solid #ccc; }
+#controls > * { margin-right: 1em; }
+</style>
+</head>
+<body>
+<h1>Whimsy Report</h1>
+<p id="summary"></p>
+<div id="controls">
+<select id="outcome"><option value="">All outcomes</option></select>
+<select id="tag"><option value="">All tags</option></select>
+<select id="isa"><option value="">All ISAs</option></select>
+<select id="opt"><option value="">All optimizations</option></select>
+<input id="search" type="search" placeholder="Filter names">
+<button id="prev">&lt;</button><span id="page"></span><button id="next">&gt;</button>
+</div>
+<table>
+<thead><tr><th>Suite</th><th>Test</th><th>Outcome</th><th>ISA</th>
+<th>Optimization</th><th>Runtime (s)</th></tr></thead>
+<tbody id="rows"></tbody>
+</table>
+<script>
+var data = {{data}};
+var pageSize = 200;
+var page = 0;
+var matches = [];
+
+function $(id) { return document.getElementById(id); }
+
+function fill(select, values) {
+  values.forEach(function(value, idx) {
+    var option = document.createElement('option');
+    option.value = idx;
+    option.textContent = value;
+    select.appendChild(option);
+  });
+}
+
+function selected(id) {
+  var value = $(id).value;
+  return value === '' ? -1 : parseInt(value);
+}
+
+function filter() {
+  var outcome = selected('outcome'), tag = selected('tag'),
+      isa = selected('isa'), opt = selected('opt'),
+      search = $('search').value.toLowerCase();
+  matches = [];
+  data.rows.forEach(function(row, idx) {
+    var suite = data.suites[row[0]];
+    if (outcome >= 0 && row[2] != outcome) return;
+    if (isa >= 0 && row[5] != isa) return;
+    if (opt >= 0 && row[6] != opt) return;
+    if (tag >= 0 && suite[1].indexOf(tag) < 0 && row[4].indexOf(tag) < 0)
+      return;
+    if (search && (row[1] + ' ' + suite[0]).toLowerCase()
+        .indexOf(search) < 0) return;
+    matches.push(idx);
+  });
+  page = 0;
+  render();
+}
+
+function cell(tr, text, cls) {
+  var td = document.createElement('td');
+  td.textContent = text;
+  if (cls) td.className = cls;
+  tr.appendChild(td);
+}
+
+function toggleLog(tr, idx) {
+  var next = tr.nextSibling;
+  if (next && next.className == 'log') {
+    next.parentNode.removeChild(next);
+    return;
+  }
+  var logRow = document.createElement('tr');
+  logRow.className = 'log';
+  var td = document.createElement('td');
+  td.colSpan = 6;
+  var frame = document.createElement('iframe');
+  frame.src = 'logs/' + Math.floor(idx / data.logsPerDir) + '/' + idx +
+      '.html';
+  td.appendChild(frame);
+  logRow.appendChild(td);
+  tr.parentNode.insertBefore(logRow, next);
+}
+
+function render() {
+  var pages = Math.max(1, Math.ceil(matches.length / pageSize));
+  var tbody = $('rows');
+  tbody.innerHTML = '';
+  matches.slice(page * pageSize, (page + 1) * pageSize).forEach(
+      function(idx) {
+    var row = data.rows[idx];
+    var suite = data.suites[row[0]];
+    var outcome = data.outcomes[row[2]];
+    var tr = document.createElement('tr');
+    tr.className = 'item';
+    cell(tr, suite[0]);
+    cell(tr, row[1]);
+    cell(tr, outcome, outcome);
+    cell(tr, row[5] >= 0 ? data.tags[row[5]] : '');
+    cell(tr, row[6] >= 0 ? data.tags[row[6]] : '');
+    cell(tr, row[3].toFixed(2));
+    tr.onclick = function() { toggleLog(tr, idx); };
+    tbody.appendChild(tr);
+  });
+  $('page').textContent = ' ' + (page + 1) + ' / ' + pages + ' (' +
+      matches.length + ' tests) ';
+}
+
+fill($('outcome'), data.outcomes);
+fill($('tag'), data.tags);
+[['isa', data.isas], ['opt', data.opts]].forEach(function(pair) {
+  pair[1].forEach(function(tagIdx) {
+    var option = document.createElement('option');
+    option.value = tagIdx;
+    option.textContent = data.tags[tagIdx];
+    $(pair[0]).appendChild(option);
+  });
+});
+['outcome', 'tag', 'isa', 'opt'].forEach(function(id) {
+  $(id).onchange = filter;
+});
+$('search').oninput = filter;
+$('prev').onclick = function() { if (page > 0) { page--; render(); } };
+$('next').onclick = function() {
+  if ((page + 1) * pageSize < matches.length) { page++; render(); }
+};
+$('summary').textContent = data.summary;
+filter();
+</script>
+</body>
+</html>
+'''
+
+_log_template_start = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>%(name)s</title>
+<style>pre { white-space: pre-wrap; } .reason { color: #c00; }</style>
+</head>
+<body>
+'''
+_log_template_end = '''</body>
+</html>
+'''
+
+class _StringTable(object):
+    '''Assigns each distinct string an index in a list.'''
+    def __init__(self):
+        self.strings = []
+        self._indexes = {}
+
+    def index(self, string):
+        if string not in self._indexes:
+            self._indexes[string] = len(self.strings)
+            self.strings.append(string)
+        return self._indexes[string]
+
+def _write_output(fstream, title, fname):
+    if fname is None or not os.path.exists(fname) \
+            or not os.path.getsize(fname):
+        return
+    fstream.write('<h3>%s</h3>\n<pre>' % title)
+    with open(fname, 'r') as output:
+        for line in output:
+            fstream.write(escape(_control_chars.sub('', line)))
+    fstream.write('</pre>\n')
+
+def write_log(path, testcase):
+    '''Write the log fragment of the given test case result to path.'''
+    with open(path, 'w') as fstream:
+        fstream.write(_log_template_start % dict(name=escape(testcase.name)))
+        if testcase.reason is not None:
+            fstream.write('<h3>Reason</h3>\n<pre class="reason">%s</pre>\n'
+                          % escape(str(testcase.reason)))
+        # NOTE: The runner stores stdout in what it names fstderr_name and
+        # vice versa, so go by the file's name rather than the attribute.
+        for fname in sorted((testcase.fstdout_name, testcase.fstderr_name)):
+            if fname is not None:
+                _write_output(fstream, os.path.basename(fname), fname)
+        fstream.write(_log_template_end)
+
+def generate(reader, output):
+    '''
+    Generate a report of the results in the given
+    :class:`whimsy.resultfile.ResultFileReader` into the output directory.
+
+    :returns: The number of test cases in the report.
+    '''
+    tags = _StringTable()
+    isas = set()
+    opts = set()
+    outcomes = [outcome.name for outcome in Outcome.enums]
+    outcome_index = dict((name, idx) for (idx, name) in enumerate(outcomes))
+    suites = []
+    rows = []
+
+    def classify(item_tags):
+        '''
+        :returns: Tuple of the indexes of the tags and of the ISA and
+            optimization among them (-1 if there is none).
+        '''
+        tag_indexes = [tags.index(tag) for tag in item_tags]
+        isa = opt = -1
+        for tag in item_tags:
+            if tag in constants.supported_isas:
+                isa = tags.index(tag)
+                isas.add(isa)
+            elif tag in constants.supported_optimizations:
+                opt = tags.index(tag)
+                opts.add(opt)
+        return (tag_indexes, isa, opt)
+
+    mkdir_p(joinpath(output, 'logs'))
+    for suite in reader.of_kind(SUITE):
+        (suite_tags, suite_isa, suite_opt) = classify(suite.tags)
+        suite_idx = len(suites)
+        suites.append((suite.name, suite_tags))
+
+        for testcase in suite.test_case_results:
+            idx = len(rows)
+            logdir = joinpath(output, 'logs', str(idx // logs_per_dir))
+            if idx % logs_per_dir == 0:
+                mkdir_p(logdir)
+            write_log(joinpath(logdir, '%d.html' % idx), testcase)
+            (case_tags, isa, opt) = classify(testcase.tags)
+            rows.append((suite_idx, testcase.name,
+                         outcome_index[testcase.outcome.name],
+                         round(testcase.runtime or 0, 3), case_tags,
+                         suite_isa if isa < 0 else isa,
+                         suite_opt if opt < 0 else opt))
+
+    tally = dict.fromkeys(outcomes, 0)
+    for row in rows:
+        tally[outcomes[row[2]]] += 1
+    summary = ', '.join('%d %s' % (tally[name], name)
+                        for name in outcomes if tally[name])
+
+    data = json.dumps(dict(suites=suites,
+                           rows=rows,
+                           tags=tags.strings,
+                           isas=sorted(isas),
+                           opts=sorted(opts),
+                           outcomes=outcomes,
+                           logsPerDir=logs_per_dir,
+                           summary=summary),
+                      separators=(',', ':'))
+    # Don't let a name close the script element early.
+    data = data.replace('</', '<\\/')
+
+    with open(joinpath(output, 'index.html'), 'w') as index:
+        index.write(_index_template.replace('{{data}}', data))
+
+    return len(rows)
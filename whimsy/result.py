@@ -3,8 +3,16 @@ Module which contains streaming result loggers. The main goal of these loggers
 is to support large amounts of results and not create large standing pools of
 strings.
 '''
+import collections
+import json
+import multiprocessing
+import os
 import pickle
-from xml.sax.saxutils import escape as xml_escape
+import re
+import shutil
+import tempfile
+import time
+from xml.sax.saxutils import escape as xml_escape, quoteattr
 from string import maketrans
 
 import terminal
@@ -13,6 +21,7 @@ from helper import joinpath
 from test import TestCase
 from suite import TestSuite
 from logger import log
+from resultfile import ResultFileReader, ResultFileWriter
 from _util import Timer, Enum
 
 class InvalidResultException(Exception):
@@ -102,10 +111,12 @@ class ResultLogger(object):
         This is garunteed to be called before any results are added.
         '''
 
-    def begin(self, item):
+    def begin(self, item, **kwargs):
         '''
         Signal the beginning of the given item.
         :param item: The test item which is about to begin running
+        :param worker: Id of the worker running the item. Only given when the
+            item is run by a worker of a parallel run.
         '''
 
     def set_outcome(self, item, outcome, **kwargs):
@@ -124,13 +135,18 @@ class ResultLogger(object):
 
         :param ff_skipped: Indicates that the test was skipped due to
             a fail_fast condition.
+
+        :param runtime: Wall time in seconds the item took to run.
+        :param resource_usage: :class:`whimsy.helper.ResourceUsage` of child
+            processes the item ran.
         '''
 
-    def end(self, item):
+    def end(self, item, **kwargs):
         '''
         Signal the end of the current item.
 
         :param item: The test item which is finished running
+        :param worker: See :meth:`begin`
         '''
 
     def end_testing(self):
@@ -167,7 +183,7 @@ class ConsoleLogger(ResultLogger):
         self.timer.start()
         self._started = True
 
-    def begin(self, item):
+    def begin(self, item, **kwargs):
         self.delegate_instance(self.begin, item)
     def _begin_testsuite(self, test_suite):
         log.info('Starting TestSuite: %s' % test_suite.name)
@@ -229,11 +245,19 @@ class ConsoleLogger(ResultLogger):
             self.outcome_count[result.outcome] += 1
 
 class TestResult(object):
-    def __init__(self, item, outcome, runtime=0):
+    '''
+    :var runtime: Wall time in seconds the item took to run.
+    :var resource_usage: A :class:`whimsy.helper.ResourceUsage` of the
+        processes the item started through :func:`whimsy.helper.log_call`.
+    :var tags: Sorted tuple of the tags the item was marked with.
+    '''
+    def __init__(self, item, outcome, runtime=0, resource_usage=None):
         self.name = item.name
         self.uid = item.uid
+        self.tags = tuple(sorted(item.tags))
         self.outcome = outcome
         self.runtime = runtime
+        self.resource_usage = resource_usage
 
 class TestCaseResult(TestResult):
     def __init__(self, fstdout_name=None, fstderr_name=None, reason=None,
@@ -253,7 +277,9 @@ class TestSuiteResult(TestResult):
 class InternalLogger(ResultLogger):
     '''
     An internal logger which writes streaming pickle items on completion of
-    TestSuite items.
+    TestSuite items. On :meth:`end_testing` an index is written so the file
+    can be read with random access by
+    a :class:`whimsy.resultfile.ResultFileReader`.
 
     This logger also offers some metadata methods to and can load back out
     previous results.
@@ -263,6 +289,7 @@ class InternalLogger(ResultLogger):
     def __init__(self, filestream):
         self.timer = Timer()
         self.filestream = filestream
+        self._writer = ResultFileWriter(filestream)
 
         # Dictionaries mapping uid->result
         self.test_case_results = {}
@@ -271,7 +298,25 @@ class InternalLogger(ResultLogger):
         self.results = []
 
     def _write(self, obj):
-        pickle.dump(obj, self.filestream)
+        self._writer.write(obj)
+
+    def __getstate__(self):
+        # The workers of a parallel run send their logger back to the server,
+        # leave out the file and the index of what we wrote to it.
+        state = self.__dict__.copy()
+        for attr in ('filestream', '_writer', 'test_case_results',
+                     'test_suite_results'):
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.filestream = None
+        self._writer = None
+        self.test_case_results = dict((result.uid, result)
+                                      for result in self.testcases)
+        self.test_suite_results = dict((result.uid, result)
+                                       for result in self.suites)
 
     def begin_testing(self):
         self.timer.start()
@@ -298,20 +343,18 @@ class InternalLogger(ResultLogger):
 
     def end_testing(self):
         self.timer.stop()
+        self._writer.close()
 
     @staticmethod
     def load(filestream):
-        '''Load results out of a dumped file replacing our own results.'''
-        loaded_results = []
-        try:
-            while True:
-                item = pickle.load(filestream)
-                loaded_results.append(item)
-        except EOFError:
-            pass
+        '''
+        Load all results out of a dumped file into a new InternalLogger.
 
+        .. note:: Prefer a :class:`whimsy.resultfile.ResultFileReader` to only
+            load the results which are needed.
+        '''
         new_logger = InternalLogger(filestream)
-        new_logger.results = loaded_results
+        new_logger.results = list(ResultFileReader(filestream))
         return new_logger
 
     @property
@@ -330,6 +373,8 @@ class InternalLogger(ResultLogger):
                 yield result
 
     def insert_results(self, internal_results):
+        for result in internal_results.results:
+            self._write(result)
         self.results.extend(internal_results.results)
 
 class JUnitLogger(InternalLogger):
@@ -360,6 +405,261 @@ class JUnitLogger(InternalLogger):
         JUnitFormatter(self).dump(self._junit_fstream)
 
 
+class StreamingJUnitLogger(ResultLogger):
+    '''
+    Logger which writes each ``<testsuite>`` element to the junit_fstream as
+    soon as its suite ends rather than collecting every result until the end
+    of testing. Only results of suites which are still running are kept in
+    memory and a crash will leave all previously completed suites in the
+    file.
+
+    Space is reserved in the ``<testsuites>`` opening tag for its attributes,
+    on :meth:`end_testing` the totals are written into that space. Should they
+    not fit the file is rewritten with them.
+
+    Most of the time spent rendering goes to escaping the output of tests. If
+    given `workers` each suite is rendered into a temporary file by a pool of
+    processes as soon as it completes, the fragments are copied into the
+    junit_fstream in the order the suites completed.
+
+    :param junit_fstream: Seekable file stream to write junit formatted
+        results to.
+    :param workers: Number of processes to render suites with, if None
+        suites are rendered by this process.
+    '''
+    # Enough room for the totals of any reasonably sized run.
+    reserved_space = 128
+
+    def __init__(self, junit_fstream, workers=None):
+        self.timer = Timer()
+        self._fstream = junit_fstream
+        self._formatter = JUnitFormatter()
+        self._tally = dict.fromkeys((PASS, SKIP, FAIL, ERROR), 0)
+        self._suite_idx = 0
+        self._attr_offset = None
+
+        # Map uid to a deque of the TestCaseResults of suites which have not
+        # finished yet. Test cases can share a uid (e.g. a function given
+        # more than one testfunction decorator), each takes the next result.
+        self._pending = collections.defaultdict(collections.deque)
+
+        self._pool = None
+        if workers is not None and workers > 1:
+            self._pool = multiprocessing.Pool(workers)
+        # (AsyncResult, fragment file name) of suites being rendered in
+        # order.
+        self._rendering = collections.deque()
+
+    def begin_testing(self):
+        self.timer.start()
+        self._fstream.write(self._formatter.xml_header)
+        self._fstream.write('<testsuites')
+        self._attr_offset = self._fstream.tell()
+        self._fstream.write(' ' * self.reserved_space + '>\n')
+        self._fstream.flush()
+
+    def set_outcome(self, item, **kwargs):
+        self.delegate_instance(self.set_outcome, item, **kwargs)
+
+    def _set_outcome_testcase(self, item, **kwargs):
+        self._pending[item.uid].append(TestCaseResult(item=item, **kwargs))
+
+    def _set_outcome_testsuite(self, item, **kwargs):
+        suite_results = []
+        for tc in item:
+            pending = self._pending.get(tc.uid)
+            if pending:
+                suite_results.append(pending.popleft())
+                if not pending:
+                    del self._pending[tc.uid]
+        self.write_suite(TestSuiteResult(suite_results, item=item,
+                                          **kwargs))
+
+    def insert_results(self, internal_results):
+        for suite in internal_results.suites:
+            self.write_suite(suite)
+
+    def write_suite(self, suite):
+        '''Write the given :class:`TestSuiteResult` to the junit_fstream.'''
+        for outcome, count in \
+                self._formatter.tally(suite.test_case_results).items():
+            self._tally[outcome] += count
+
+        if self._pool is None:
+            self._formatter.dump_testsuite(self._fstream, suite,
+                                           self._suite_idx)
+            self._fstream.flush()
+        else:
+            (fd, fname) = tempfile.mkstemp(prefix='junit-fragment-')
+            os.close(fd)
+            self._rendering.append((self._pool.apply_async(
+                    _render_testsuite, (suite, self._suite_idx, fname)),
+                                    fname))
+            self._copy_fragments(wait=False)
+        self._suite_idx += 1
+
+    def _copy_fragments(self, wait):
+        '''
+        Copy rendered fragments into the junit_fstream in order.
+
+        :param wait: Wait for all fragments to be rendered rather than only
+            copying those which are ready.
+        '''
+        while self._rendering:
+            (async_result, fname) = self._rendering[0]
+            if not wait and not async_result.ready():
+                break
+            self._rendering.popleft()
+            try:
+                # Re-raise any exception from rendering.
+                async_result.get()
+                with open(fname, 'r') as fragment:
+                    shutil.copyfileobj(fragment, self._fstream)
+            finally:
+                os.remove(fname)
+        self._fstream.flush()
+
+    def end_testing(self, runtime=None):
+        '''
+        Close the ``<testsuites>`` element and fill in its totals.
+
+        :param runtime: Total time to report, defaults to the time since
+            :meth:`begin_testing`.
+        '''
+        self.timer.stop()
+        if runtime is None:
+            runtime = self.timer.runtime()
+        if self._pool is not None:
+            self._copy_fragments(wait=True)
+            self._pool.close()
+            self._pool.join()
+        self._fstream.write(
+                self._formatter.generic_closing.format(tag='testsuites'))
+
+        attributes = self._formatter.testsuites_attributes.format(
+                tests=self._tally[PASS],
+                errors=self._tally[ERROR],
+                failures=self._tally[FAIL],
+                time=runtime)
+        if len(attributes) > self.reserved_space:
+            self._rewrite_header(attributes)
+            return
+        end = self._fstream.tell()
+        self._fstream.seek(self._attr_offset)
+        self._fstream.write(attributes)
+        self._fstream.seek(end)
+        self._fstream.flush()
+
+    def _rewrite_header(self, attributes):
+        '''
+        Rewrite the file of the junit_fstream with the given attributes of the
+        ``<testsuites>`` element in place of the space reserved for them.
+        '''
+        self._fstream.flush()
+        fname = getattr(self._fstream, 'name', None)
+        if not isinstance(fname, basestring) or not os.path.isfile(fname):
+            raise IOError('The totals of the junit results need %d bytes but'
+                          ' only %d were reserved.'
+                          % (len(attributes), self.reserved_space))
+        (fd, tfname) = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(fname)))
+        with open(fname, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            dst.write(src.read(self._attr_offset))
+            dst.write(attributes)
+            src.seek(self._attr_offset + self.reserved_space)
+            shutil.copyfileobj(src, dst)
+        shutil.copymode(fname, tfname)
+        os.rename(tfname, fname)
+
+
+def _render_testsuite(suite, idx, fname):
+    '''
+    Render the given suite into the file fname for the pool of
+    a :class:`StreamingJUnitLogger`.
+
+    .. note:: This must be exposed at the module level in order to be
+        reachable by the multiprocessing module.
+    '''
+    with open(fname, 'w') as fragment:
+        JUnitFormatter().dump_testsuite(fragment, suite, idx)
+
+class JSONLinesLogger(ResultLogger):
+    '''
+    Logger which writes an event for the start and end of testing and every
+    begin, end and outcome of an item as a single line JSON object. Each line
+    is flushed as it is written so the stream can be followed while tests are
+    running.
+
+    Every event has an ``event`` name and a ``time`` stamp, events for items
+    also have the ``uid``, ``name``, ``kind`` (suite or case) and ``worker``
+    of the item. Outcome events add the ``outcome``, ``reason``,
+    ``runtime`` and for test cases the ``fstdout_name`` and ``fstderr_name``
+    of the test's output.
+
+    :param fstream: File stream to write events to.
+    '''
+    def __init__(self, fstream):
+        self._fstream = fstream
+
+    def _write(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        self._fstream.write(json.dumps(fields, separators=(',', ':')))
+        self._fstream.write('\n')
+        self._fstream.flush()
+
+    @staticmethod
+    def _reason(reason):
+        return None if reason is None else str(reason)
+
+    @staticmethod
+    def _item_fields(item, worker):
+        kind = 'suite' if isinstance(item, TestSuite) else 'case'
+        return dict(uid=item.uid, name=item.name, kind=kind, worker=worker)
+
+    def begin_testing(self):
+        self._write('begin_testing')
+
+    def begin(self, item, worker=None, **kwargs):
+        self._write('begin', **self._item_fields(item, worker))
+
+    def set_outcome(self, item, outcome, reason=None, runtime=None,
+                    fstdout_name=None, fstderr_name=None, worker=None,
+                    **kwargs):
+        fields = self._item_fields(item, worker)
+        self._write('set_outcome',
+                    outcome=outcome.name,
+                    reason=self._reason(reason),
+                    runtime=runtime,
+                    fstdout_name=fstdout_name,
+                    fstderr_name=fstderr_name,
+                    **fields)
+
+    def end(self, item, worker=None, **kwargs):
+        self._write('end', **self._item_fields(item, worker))
+
+    def insert_results(self, internal_results):
+        worker = getattr(internal_results, 'worker', None)
+        for result in internal_results.results:
+            if isinstance(result, TestSuiteResult):
+                kind = 'suite'
+            else:
+                kind = 'case'
+            self._write('set_outcome',
+                        uid=result.uid,
+                        name=result.name,
+                        kind=kind,
+                        worker=worker,
+                        outcome=result.outcome.name,
+                        reason=self._reason(getattr(result, 'reason', None)),
+                        runtime=result.runtime,
+                        fstdout_name=getattr(result, 'fstdout_name', None),
+                        fstderr_name=getattr(result, 'fstderr_name', None))
+
+    def end_testing(self):
+        self._write('end_testing')
+
+
 class JUnitFormatter(object):
     '''
     Formats TestResults into the JUnit XML format.
@@ -370,38 +670,66 @@ class JUnitFormatter(object):
     xml_header = '<?xml version="1.0" encoding="UTF-8"?>\n'
     passing_results = {PASS, XFAIL}
     # Testcase stuff
-    testcase_opening = ('<testcase name="{name}" classname="{classname}"'
+    testcase_opening = ('<testcase name={name} classname={classname}'
                         ' status="{status}" time="{time}">\n')
     # Indicates test skipped
     skipped_tag = '<skipped/>'
-    error_tag = '<error message="{message}"></error>\n'
-    fail_tag = '<failure message="{message}"></error>\n'
+    error_tag = '<error message={message}></error>\n'
+    fail_tag = '<failure message={message}></failure>\n'
     system_out_opening = '<system-out>'
     system_err_opening = '<system-err>'
 
     # Testsuite stuff
-    testsuite_opening = ('<testsuite name="{name}" tests="{numtests}"'
+    testsuite_opening = ('<testsuite name={name} tests="{numtests}"'
                          ' errors="{errors}" failures="{failures}"'
-                         ' skipped="{skipped}" id={suitenum}'
+                         ' skipped="{skipped}" id="{suitenum}"'
                          ' time="{time}">\n'
                          )
     # Testsuites stuff
-    testsuites_opening = ('<testsuites errors="{errors}" failures="{failures}"'
-                          ' tests="{tests}"' # total number of sucessful tests.
-                          ' time="{time}">\n')
+    testsuites_attributes = (' errors="{errors}" failures="{failures}"'
+                             ' tests="{tests}"' # total number of sucessful
+                                                # tests.
+                             ' time="{time}"')
+    testsuites_opening = '<testsuites' + testsuites_attributes + '>\n'
     # Generic closing tag for any opening tag.
     generic_closing = '</{tag}>\n'
 
+    # Control characters (e.g. terminal colors) are not allowed in XML.
+    invalid_xml_chars = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
 
-    def __init__(self, internal_results, translate_names=True):
-        self.results = internal_results.results
-        self.runtime = internal_results.timer.runtime()
+    def __init__(self, internal_results=None, translate_names=True):
+        '''
+        :param internal_results: :class:`InternalLogger` to format with
+            :meth:`dump`. Not required to format individual suites.
+        '''
+        if internal_results is not None:
+            self.results = internal_results.results
+            self.runtime = internal_results.timer.runtime()
 
         if translate_names:
             self.name_table = maketrans('/.', '.-')
         else:
             self.name_table = maketrans('', '')
 
+    def tally(self, testcases):
+        '''
+        Return a dictionary of the number of the given testcase results with
+        each outcome, passing outcomes are all counted as PASS.
+        '''
+        outcome_tally = dict.fromkeys((PASS, SKIP, FAIL, ERROR), 0)
+        for testcase in testcases:
+            if testcase.outcome in self.passing_results:
+                outcome_tally[PASS] += 1
+            else:
+                outcome_tally[testcase.outcome] += 1
+        return outcome_tally
+
+    def _escape(self, string):
+        return xml_escape(self.invalid_xml_chars.sub('', string))
+
+    def _quoteattr(self, string):
+        return quoteattr(self.invalid_xml_chars.sub('', str(string)))
+
     def dump_testcase(self, fstream, testcase):
 
         tag = ''
@@ -415,51 +743,51 @@ class JUnitFormatter(object):
         elif testcase.outcome == FAIL:
             outcome = SKIP
             status = 'failed'
-            tag = self.fail_tag.format(message=testcase.reason)
+            tag = self.fail_tag.format(
+                    message=self._quoteattr(testcase.reason))
         elif testcase.outcome == ERROR:
             outcome = SKIP
             status = 'errored'
-            tag = self.error_tag.format(message=testcase.reason)
+            tag = self.error_tag.format(
+                    message=self._quoteattr(testcase.reason))
         elif __debug__:
             raise AssertionError('Unknown test state')
 
         fstream.write(self.testcase_opening.format(
-                name=testcase.name,
-                classname=testcase.name,
+                name=self._quoteattr(testcase.name),
+                classname=self._quoteattr(testcase.name),
                 time=testcase.runtime,
                 status=status))
 
         fstream.write(tag)
 
         # Write out systemout and systemerr from their containing files.
-        if testcase.fstdout_name is not None:
+        # (Results merged from other machines may not have them here.)
+        if testcase.fstdout_name is not None \
+                and os.path.exists(testcase.fstdout_name):
             fstream.write(self.system_out_opening)
             with open(testcase.fstdout_name, 'r') as testout_stdout:
                 for line in testout_stdout:
-                    fstream.write(xml_escape(line))
+                    fstream.write(self._escape(line))
             fstream.write(self.generic_closing.format(tag='system-out'))
 
-        if testcase.fstderr_name is not None:
+        if testcase.fstderr_name is not None \
+                and os.path.exists(testcase.fstderr_name):
             fstream.write(self.system_err_opening)
             with open(testcase.fstderr_name, 'r') as testout_stderr:
                 for line in testout_stderr:
-                    fstream.write(xml_escape(line))
+                    fstream.write(self._escape(line))
             fstream.write(self.generic_closing.format(tag='system-err'))
 
         fstream.write(self.generic_closing.format(tag='testcase'))
 
     def dump_testsuite(self, fstream, suite, idx):
         # Tally results first.
-        outcome_tally = dict.fromkeys((PASS, SKIP, FAIL, ERROR), 0)
-        for testcase in suite.test_case_results:
-            if testcase.outcome in self.passing_results:
-                outcome_tally[PASS] += 1
-            else:
-                outcome_tally[testcase.outcome] += 1
+        outcome_tally = self.tally(suite.test_case_results)
 
         fstream.write(
                 self.testsuite_opening.format(
-                    name=suite.name,
+                    name=self._quoteattr(suite.name),
                     numtests=outcome_tally[PASS],
                     errors=outcome_tally[ERROR],
                     failures=outcome_tally[FAIL],
@@ -476,14 +804,10 @@ class JUnitFormatter(object):
         idx = 0
 
         # First tally results.
-        outcome_tally = dict.fromkeys((PASS, SKIP, FAIL, ERROR), 0)
-        for item in self.results:
-            if isinstance(item, TestCaseResult):
-                if item.outcome in self.passing_results:
-                    outcome_tally[PASS] += 1
-                else:
-                    outcome_tally[item.outcome] += 1
+        outcome_tally = self.tally(item for item in self.results
+                                   if isinstance(item, TestCaseResult))
 
+        dumpfile.write(self.xml_header)
         dumpfile.write(self.testsuites_opening.format(
             tests=outcome_tally[PASS],
             errors=outcome_tally[ERROR],
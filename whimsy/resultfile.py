@@ -0,0 +1,266 @@
+'''
+Implements the container format of the ``pickle`` result file written by the
+:class:`whimsy.result.InternalLogger`.
+
+The file is a sequence of pickled :class:`whimsy.result.TestResult` objects
+followed by a footer index. The index maps each uid to the offsets and
+:class:`Summary` of its results and each kind (suite or case) and outcome to
+the offsets of the matching results, so readers can seek directly to the
+results they need rather than deserializing the entire file::
+
+    [result] [result] ... [pickled index] [index offset] [magic]
+
+The index offset is an 8 byte little endian integer. Files without the
+trailing magic (written before this format existed, or by a run which never
+finished) are still readable, the :class:`ResultFileReader` builds the index by
+scanning them once.
+
+A uid may have more than one result in a file, the suites of testfunctions in
+the same file share a uid. The results of a uid are numbered by the order
+they were written in, see :meth:`ResultFileReader.get`.
+'''
+import os
+import pickle
+import struct
+
+from config import constants
+from helper import joinpath
+
+magic = 'WHIMSYIX'
+_footer = struct.Struct('<Q8s')
+
+SUITE = 'suite'
+CASE = 'case'
+
+def result_kind(result):
+    '''Return :data:`SUITE` or :data:`CASE` for the given result.'''
+    # NOTE: We can't import the result module since it uses us.
+    if hasattr(result, 'test_case_results'):
+        return SUITE
+    return CASE
+
+class Summary(object):
+    '''
+    The fields of a result which are kept in the index so results can be
+    compared without loading them.
+    '''
+    __slots__ = ('kind', 'outcome', 'runtime', 'maxrss')
+
+    def __init__(self, result):
+        self.kind = result_kind(result)
+        self.outcome = result.outcome.name
+        self.runtime = getattr(result, 'runtime', None)
+        usage = getattr(result, 'resource_usage', None)
+        self.maxrss = None if usage is None else usage.maxrss
+
+    def __getstate__(self):
+        return (self.kind, self.outcome, self.runtime, self.maxrss)
+
+    def __setstate__(self, state):
+        (self.kind, self.outcome, self.runtime, self.maxrss) = state
+
+
+def result_file_path(path):
+    '''
+    Return the path of the result file for the given path, either a result
+    file itself or a result directory containing a ``pickle`` result file.
+    '''
+    if os.path.isdir(path):
+        return joinpath(path, 'pickle')
+    return path
+
+def open_results(path):
+    '''
+    Open a :class:`ResultFileReader` for the given path.
+
+    :param path: See :func:`result_file_path`
+    '''
+    return ResultFileReader(open(result_file_path(path), 'rb'))
+
+class _Index(object):
+    '''
+    The footer index of a result file.
+
+    :var uids: Dictionary mapping uid to a list of the offsets of its
+        results in file order.
+    :var outcomes: Dictionary mapping :code:`(kind, outcome name)` to a list
+        of offsets of results of that kind and outcome.
+    :var summaries: Dictionary mapping uid to a list of the :class:`Summary`
+        of each of its results, in the same order as its offsets.
+    '''
+    version = 1
+
+    def __init__(self):
+        self.uids = {}
+        self.outcomes = {}
+        self.summaries = {}
+
+    def add(self, offset, result):
+        self.uids.setdefault(result.uid, []).append(offset)
+        key = (result_kind(result), result.outcome.name)
+        self.outcomes.setdefault(key, []).append(offset)
+        self.summaries.setdefault(result.uid, []).append(Summary(result))
+
+    def __getstate__(self):
+        return (self.version, self.uids, self.outcomes, self.summaries)
+
+    def __setstate__(self, state):
+        (_, self.uids, self.outcomes, self.summaries) = state
+
+
+class ResultFileWriter(object):
+    '''
+    Writes results to a file stream keeping an index of their offsets.
+    :meth:`close` must be called to write the index.
+    '''
+    def __init__(self, fstream, protocol=constants.pickle_protocol):
+        self.fstream = fstream
+        self.protocol = protocol
+        self.index = _Index()
+
+    def write(self, result):
+        self.index.add(self.fstream.tell(), result)
+        pickle.dump(result, self.fstream, self.protocol)
+
+    def close(self):
+        '''Write the footer index. (The file stream is not closed.)'''
+        offset = self.fstream.tell()
+        pickle.dump(self.index, self.fstream, self.protocol)
+        self.fstream.write(_footer.pack(offset, magic))
+        self.fstream.flush()
+
+
+class ResultFileReader(object):
+    '''
+    Provides random access to the results in a result file.
+
+    :param fstream: A seekable file stream opened for reading.
+    '''
+    def __init__(self, fstream):
+        self.fstream = fstream
+        self.index = self._read_index()
+
+    def _read_index(self):
+        self.fstream.seek(0, 2)
+        size = self.fstream.tell()
+        if size >= _footer.size:
+            self.fstream.seek(size - _footer.size)
+            (offset, file_magic) = _footer.unpack(
+                    self.fstream.read(_footer.size))
+            if file_magic == magic:
+                self.fstream.seek(offset)
+                self._end = offset
+                return pickle.load(self.fstream)
+        return self._scan()
+
+    def _scan(self):
+        '''Build the index of a file without one by reading every result.'''
+        index = _Index()
+        self.fstream.seek(0)
+        while True:
+            offset = self.fstream.tell()
+            try:
+                result = pickle.load(self.fstream)
+            except (EOFError, pickle.UnpicklingError):
+                # An unfinished run may have been interrupted mid-write.
+                break
+            index.add(offset, result)
+        self._end = offset
+        return index
+
+    def _load(self, offset):
+        self.fstream.seek(offset)
+        return pickle.load(self.fstream)
+
+    def get(self, uid, number=0):
+        '''
+        Return the result with the given uid, or None if there is none.
+
+        :param number: Which of the results sharing the uid to return,
+            numbered in the order they were written.
+        '''
+        offsets = self.index.uids.get(uid, ())
+        if number < len(offsets):
+            return self._load(offsets[number])
+
+    def get_all(self, uid):
+        '''Return a list of every result with the given uid in file order.'''
+        return [self._load(offset) for offset in self.index.uids.get(uid, ())]
+
+    def count(self, uid):
+        '''Return the number of results with the given uid.'''
+        return len(self.index.uids.get(uid, ()))
+
+    def __contains__(self, uid):
+        return uid in self.index.uids
+
+    def uids(self):
+        return self.index.uids.keys()
+
+    def summary(self, uid, number=0):
+        '''
+        Return the :class:`Summary` of the result with the given uid. (See
+        :meth:`get` for number.)
+        '''
+        return self.index.summaries[uid][number]
+
+    def summaries(self):
+        '''
+        Return the dictionary mapping each uid to the list of the
+        :class:`Summary` of each of its results.
+        '''
+        return self.index.summaries
+
+    def suite_uids(self):
+        '''
+        Return a sorted list of the uids of all suite results. (A uid is only
+        listed once even if several suites share it.)
+        '''
+        return sorted(uid for (uid, summaries) in self.index.summaries.items()
+                      if summaries[0].kind == SUITE)
+
+    def keys(self, kind):
+        '''
+        Return a list of :code:`(uid, number)` of every result of the given
+        kind in file order, number tells apart the results sharing a uid (see
+        :meth:`get`). Only the index is read.
+        '''
+        entries = []
+        for (uid, summaries) in self.index.summaries.items():
+            if summaries[0].kind == kind:
+                entries.extend((offset, uid, number) for (number, offset)
+                               in enumerate(self.index.uids[uid]))
+        return [(uid, number) for (_, uid, number) in sorted(entries)]
+
+    def of_kind(self, kind):
+        '''
+        Iterate over every result of the given kind (:data:`SUITE` or
+        :data:`CASE`) in file order.
+        '''
+        offsets = []
+        for ((result_kind, _), kind_offsets) in self.index.outcomes.items():
+            if result_kind == kind:
+                offsets.extend(kind_offsets)
+        for offset in sorted(offsets):
+            yield self._load(offset)
+
+    def with_outcome(self, kind, *outcomes):
+        '''
+        Iterate over the results of the given kind (:data:`SUITE` or
+        :data:`CASE`) with any of the given outcomes, in file order.
+        '''
+        offsets = []
+        for outcome in outcomes:
+            offsets.extend(self.index.outcomes.get((kind, outcome.name), ()))
+        for offset in sorted(offsets):
+            yield self._load(offset)
+
+    def __iter__(self):
+        '''Iterate over all results in file order.'''
+        offset = 0
+        while offset < self._end:
+            # Seek each time so random access is allowed between yields.
+            self.fstream.seek(offset)
+            result = pickle.load(self.fstream)
+            offset = self.fstream.tell()
+            yield result
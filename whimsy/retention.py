@@ -0,0 +1,254 @@
+'''
+Implements retention of the artifacts of previous runs in the result path
+and garbage collection of orphaned temporary directories.
+
+Every run writes its result files and a directory of output per test into
+the result path, overwriting those of the previous run and leaving behind
+those of tests which are no longer run. When asked to keep previous runs, at
+the start of a run the :class:`RetentionManager` moves everything the
+previous run left in the result path (other than the history database) into
+a staging directory. This is only a rename so the run can start right away.
+Then, on a background thread, the staged artifacts are compressed into
+a per-run archive in ``archive/`` and archives beyond the number of runs to
+keep are removed.
+
+If only failures are kept the archive holds just the result files and the
+output of the tests which failed or errored.
+
+Both this and the collection of temporary directories left behind by dead
+whimsy processes are opt-in, and only ever touch what whimsy created. A result
+path is only staged if it holds the marker written by :func:`claim_result_path`
+when whimsy created it, and a temporary directory is only removed if it holds
+the marker written by :func:`mkdtemp` naming a process of this host and boot
+which is no longer running.
+'''
+import errno
+import glob
+import os
+import shutil
+import socket
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
+
+from helper import joinpath, mkdir_p
+from logger import log
+from result import Outcome
+from resultfile import CASE, ResultFileReader
+
+archive_dir_name = 'archive'
+staged_prefix = '.staged-'
+archive_suffix = '.tar.gz'
+
+# Files which are placed in the archive even when only keeping failures.
+_result_files = ('pickle', 'junit.xml')
+
+# Marks a result path created by whimsy.
+result_marker = '.whimsy-results'
+# Names the process which created a temporary directory.
+tempdir_marker = '.whimsy-owner'
+
+def _boot_id():
+    '''Return the id of the current boot, or '' if it is not known.'''
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as boot_id:
+            return boot_id.read().strip()
+    except (IOError, OSError):
+        return ''
+
+def _owner():
+    return (socket.gethostname(), _boot_id(), os.getpid())
+
+def mkdtemp():
+    '''
+    Create a temporary directory marked with the process creating it so
+    :func:`collect_tempdirs` can tell once the process is gone.
+
+    :returns: The path of the directory.
+    '''
+    path = tempfile.mkdtemp(prefix='whimsy-%d-' % os.getpid())
+    with open(joinpath(path, tempdir_marker), 'w') as marker:
+        marker.write('%s\n%s\n%d\n' % _owner())
+    return path
+
+def _read_owner(path):
+    '''Return the owner in the marker of the tempdir, or None if unmarked.'''
+    try:
+        with open(joinpath(path, tempdir_marker)) as marker:
+            (hostname, boot_id, pid) = marker.read().split('\n')[:3]
+        return (hostname, boot_id, int(pid))
+    except (IOError, OSError, ValueError):
+        return None
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def collect_tempdirs(tempdir=None):
+    '''
+    Remove temporary directories created by :func:`mkdtemp` in processes on
+    this host which are no longer running. Directories of other hosts or
+    boots (e.g. in a /tmp shared with containers) are left alone since their
+    pids mean nothing here.
+
+    :returns: The number of directories removed.
+    '''
+    if tempdir is None:
+        tempdir = tempfile.gettempdir()
+
+    (hostname, boot_id, _) = _owner()
+    removed = 0
+    for path in glob.glob(joinpath(tempdir, 'whimsy-*-*')):
+        owner = _read_owner(path)
+        if owner is None or owner[:2] != (hostname, boot_id):
+            continue
+        if not _pid_alive(owner[2]):
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+def claim_result_path(result_path):
+    '''
+    Create the result path, marking it as whimsy's if it did not exist or was
+    empty. Only a marked result path has previous runs staged out of it.
+    '''
+    mkdir_p(result_path)
+    if not os.listdir(result_path):
+        open(joinpath(result_path, result_marker), 'w').close()
+
+class RetentionManager(object):
+    '''
+    Archives the artifacts of previous runs left in the result path.
+
+    :param result_path: The result path of the run.
+    :param keep_runs: Number of archives of previous runs to keep, or None
+        to leave previous runs alone.
+    :param failures_only: Only archive the output of failed tests.
+    :param preserve: Paths in the result path which are left in place.
+    :param collect: Also collect orphaned tempdirs (see
+        :func:`collect_tempdirs`).
+    '''
+    def __init__(self, result_path, keep_runs, failures_only=False,
+                 preserve=(), collect=False):
+        self.result_path = result_path
+        self.archive_dir = joinpath(result_path, archive_dir_name)
+        self.keep_runs = keep_runs
+        self.failures_only = failures_only
+        self.preserve = set(os.path.abspath(path) for path in preserve)
+        self.collect = collect
+        self._thread = None
+
+    def _retaining(self):
+        return (self.keep_runs is not None and
+                os.path.exists(joinpath(self.result_path, result_marker)))
+
+    def _run_artifacts(self):
+        for name in os.listdir(self.result_path):
+            path = joinpath(self.result_path, name)
+            if (name in (archive_dir_name, result_marker)
+                    or name.startswith(staged_prefix)):
+                continue
+            # The history database (and its journal) stay in place.
+            if any(os.path.abspath(path).startswith(preserved)
+                   for preserved in self.preserve):
+                continue
+            yield name
+
+    def stage(self):
+        '''
+        Move the artifacts of the previous run out of the way into a staging
+        directory named after the time the previous run finished.
+        '''
+        if self.keep_runs is None:
+            return
+        if not self._retaining():
+            log.warn('Not keeping previous runs since %s was not created by'
+                     ' whimsy.' % self.result_path)
+            return
+        artifacts = list(self._run_artifacts())
+        if not artifacts:
+            return
+
+        pickle = joinpath(self.result_path, 'pickle')
+        if os.path.exists(pickle):
+            finished = os.path.getmtime(pickle)
+        else:
+            finished = time.time()
+        staged = joinpath(self.result_path, staged_prefix
+                          + time.strftime('%Y%m%d-%H%M%S',
+                                          time.localtime(finished)))
+        if os.path.exists(staged):
+            staged += '-%d' % os.getpid()
+        os.mkdir(staged)
+
+        for name in artifacts:
+            os.rename(joinpath(self.result_path, name), joinpath(staged, name))
+
+    def start(self):
+        '''Start archiving staged runs and collecting tempdirs.'''
+        if not (self._retaining() or self.collect):
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def join(self):
+        '''Wait for the background work to complete.'''
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        try:
+            if self._retaining():
+                # Also pick up runs staged by a run that exited before it
+                # finished archiving them.
+                for staged in sorted(glob.glob(joinpath(self.result_path,
+                                                        staged_prefix + '*'))):
+                    self._archive(staged)
+                self._prune()
+            if self.collect:
+                collect_tempdirs()
+        except Exception:
+            log.warn('Failed to archive previous runs:\n%s'
+                     % traceback.format_exc())
+
+    def _archived_names(self, staged):
+        '''Return the names in the staged run which should be archived.'''
+        names = os.listdir(staged)
+        if not self.failures_only or 'pickle' not in names:
+            return names
+
+        with open(joinpath(staged, 'pickle'), 'rb') as fstream:
+            reader = ResultFileReader(fstream)
+            failed = set()
+            for testcase in reader.with_outcome(CASE, Outcome.FAIL,
+                                                Outcome.ERROR):
+                for fname in (testcase.fstdout_name, testcase.fstderr_name):
+                    if fname is not None:
+                        failed.add(os.path.basename(os.path.dirname(fname)))
+        return [name for name in names
+                if name in _result_files or name in failed]
+
+    def _archive(self, staged):
+        if self.keep_runs > 0:
+            mkdir_p(self.archive_dir)
+            run_name = os.path.basename(staged)[len(staged_prefix):]
+            archive = joinpath(self.archive_dir, run_name + archive_suffix)
+            # Write to a temporary name so a partial archive is never kept.
+            with tarfile.open(archive + '.tmp', 'w:gz') as tar:
+                for name in self._archived_names(staged):
+                    tar.add(joinpath(staged, name),
+                            arcname=joinpath(run_name, name))
+            os.rename(archive + '.tmp', archive)
+        shutil.rmtree(staged)
+
+    def _prune(self):
+        archives = sorted(glob.glob(joinpath(self.archive_dir,
+                                             '*' + archive_suffix)))
+        for archive in archives[:max(len(archives) - self.keep_runs, 0)]:
+            os.remove(archive)
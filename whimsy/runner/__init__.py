@@ -1,2 +1,2 @@
 from runner import *
-from parallel import WorkClient
+from parallel import WorkClient, WorkDaemon
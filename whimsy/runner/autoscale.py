@@ -0,0 +1,170 @@
+'''
+Scales the number of local workers of a parallel run with the load of the
+machine (the ``--adaptive`` flag).
+
+Build hosts are shared, so a fixed ``-j`` is too low when the machine is idle
+and too high when others (e.g. SCons) are using it. A run with ``--adaptive``
+starts ``--min-workers`` local workers and a :class:`WorkerScaler` decides
+every :attr:`WorkerScaler.interval` seconds whether to start another, up to
+``-j``, or retire one, down to ``--min-workers``:
+
+- The cores we may use are those of the machine, limited by the CPU quota of
+  our cgroup if it has one.
+- The free memory is the memory available on the machine, limited by the
+  headroom left under the memory limit of our cgroup if it has one.
+- A worker is added while the load average leaves
+  :attr:`WorkerScaler.idle_to_add` cores idle and there is twice
+  :attr:`WorkerScaler.worker_memory` free.
+- A worker is retired once the load average is more than
+  :attr:`WorkerScaler.overload_to_retire` above the cores or there is less
+  than :attr:`WorkerScaler.worker_memory` free.
+
+The gap between the thresholds to add and retire and the
+:attr:`WorkerScaler.cooldown` after each change (the load average takes
+a while to reflect a change) keep the count from thrashing. Retired workers
+finish the item they are running first.
+'''
+import multiprocessing
+import os
+import time
+
+def _read(path):
+    try:
+        with open(path) as fstream:
+            return fstream.read().strip()
+    except (IOError, OSError):
+        return None
+
+def _cgroup_paths(controller):
+    '''
+    Return the candidate directories of our cgroup for the given controller,
+    those of cgroup v2 first.
+    '''
+    paths = []
+    cgroups = _read('/proc/self/cgroup') or ''
+    for line in cgroups.splitlines():
+        (_, controllers, path) = line.split(':', 2)
+        if controllers == '':
+            paths.append(os.path.join('/sys/fs/cgroup', path.lstrip('/')))
+        elif controller in controllers.split(','):
+            paths.append(os.path.join('/sys/fs/cgroup', controller,
+                                      path.lstrip('/')))
+    paths.extend(['/sys/fs/cgroup', os.path.join('/sys/fs/cgroup',
+                                                 controller)])
+    return paths
+
+def cpu_quota():
+    '''
+    Return the number of cores the CPU quota of our cgroup allows, or None if
+    it has none.
+    '''
+    for path in _cgroup_paths('cpu'):
+        limit = _read(os.path.join(path, 'cpu.max'))
+        if limit is not None:
+            (quota, period) = limit.split()
+            if quota == 'max':
+                return None
+            return float(quota) / float(period)
+        quota = _read(os.path.join(path, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(path, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None:
+            if int(quota) < 0:
+                return None
+            return float(quota) / float(period)
+    return None
+
+def usable_cpus():
+    '''Return the number of cores we may use.'''
+    cpus = float(multiprocessing.cpu_count())
+    quota = cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return cpus
+
+def _cgroup_memory_headroom():
+    '''
+    Return the megabytes left under the memory limit of our cgroup, or None
+    if it has none.
+    '''
+    for path in _cgroup_paths('memory'):
+        limit = _read(os.path.join(path, 'memory.max'))
+        usage = _read(os.path.join(path, 'memory.current'))
+        if limit is None:
+            limit = _read(os.path.join(path, 'memory.limit_in_bytes'))
+            usage = _read(os.path.join(path, 'memory.usage_in_bytes'))
+        if limit is None or usage is None:
+            continue
+        if limit == 'max' or int(limit) >= 2 ** 60:
+            # No limit. (cgroup v1 gives a huge number.)
+            return None
+        return max(int(limit) - int(usage), 0) // (1024 * 1024)
+    return None
+
+def free_memory():
+    '''Return the megabytes of memory available to us, or None if unknown.'''
+    free = None
+    meminfo = _read('/proc/meminfo') or ''
+    for line in meminfo.splitlines():
+        if line.startswith('MemAvailable:'):
+            free = int(line.split()[1]) // 1024
+    headroom = _cgroup_memory_headroom()
+    if headroom is not None:
+        free = headroom if free is None else min(free, headroom)
+    return free
+
+def load_average():
+    '''Return the load average over the last minute.'''
+    return os.getloadavg()[0]
+
+class WorkerScaler(object):
+    '''
+    Decides when to add or retire local workers.
+
+    :param minimum: The fewest workers to keep.
+    :param maximum: The most workers to start.
+    '''
+    interval = 5.0
+    '''Seconds between checks of the load.'''
+    cooldown = 60.0
+    '''Seconds after a change before another is made.'''
+    idle_to_add = 1.5
+    '''Idle cores needed to add a worker.'''
+    overload_to_retire = 0.5
+    '''Load above the usable cores which retires a worker.'''
+    worker_memory = 1024
+    '''Megabytes of memory a worker is expected to use.'''
+
+    def __init__(self, minimum, maximum):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self._changed = None
+
+    def decide(self, workers, now=None):
+        '''
+        Return 1 to add a worker, -1 to retire one or 0 to keep the given
+        number of workers.
+        '''
+        if now is None:
+            now = time.time()
+        if workers < self.minimum:
+            return self._change(1, now)
+        if workers > self.maximum:
+            return self._change(-1, now)
+        if self._changed is not None and now - self._changed < self.cooldown:
+            return 0
+
+        idle = usable_cpus() - load_average()
+        free = free_memory()
+        if workers > self.minimum:
+            if idle < -self.overload_to_retire \
+                    or (free is not None and free < self.worker_memory):
+                return self._change(-1, now)
+        if workers < self.maximum:
+            if idle >= self.idle_to_add \
+                    and (free is None or free >= 2 * self.worker_memory):
+                return self._change(1, now)
+        return 0
+
+    def _change(self, change, now):
+        self._changed = now
+        return change
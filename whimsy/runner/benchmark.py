@@ -0,0 +1,105 @@
+'''
+Loopback benchmark of the dispatch rate of the transports of the distributed
+work server (see :data:`whimsy.runner.parallel.transports`).
+
+Starts a server on localhost, connects a number of client processes to it and
+measures the rate at which it gets through tasks which do no work, so the
+time measured is the cost of handing out tasks and collecting their results.
+Each result carries a payload of the given size to stand in for the results
+of a suite.
+
+Run it with::
+
+    python -m whimsy.runner.benchmark --clients 4 --tasks 2000
+'''
+import argparse
+import multiprocessing
+import os
+import time
+
+from parallel import transports, EVENT, WIRE, MANAGER
+
+passkey = 'whimsy-benchmark'
+
+def _task(arg):
+    (number, result_size) = arg
+    return (number, 'x' * result_size)
+
+def _client(transport, address, prefetch):
+    (_, client_class) = transports[transport]
+    kwargs = {}
+    if transport in (WIRE, EVENT):
+        kwargs['prefetch'] = prefetch
+    client = client_class(address[0], address[1], passkey, **kwargs)
+    client.connect()
+    ledger = client.get_ledger()
+    name = 'benchmark-%d' % os.getpid()
+    try:
+        while True:
+            lease = ledger.acquire(name, 1.0)
+            if lease is None:
+                continue
+            (item_id, _, (function, arg)) = lease
+            ledger.complete(name, item_id, function(arg))
+    except (IOError, EOFError):
+        return
+
+def run(transport, clients, tasks, result_size=0, port=0, prefetch=1):
+    '''
+    Run the benchmark of a transport.
+
+    :returns: The number of tasks completed per second.
+    '''
+    (server_class, _) = transports[transport]
+    address = ('localhost', port)
+    server = server_class(address[0], address[1], passkey,
+                          lease_timeout=30.0, max_attempts=1, aging=60.0)
+    server.start()
+
+    processes = [multiprocessing.Process(target=_client,
+                                         args=(transport, address, prefetch))
+                 for _ in range(clients)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    ledger = server.get_ledger()
+    # Let the clients connect before we start the clock.
+    for _ in range(clients):
+        ledger.put((_task, (-1, result_size)))
+    for _ in range(clients):
+        ledger.get_result()
+
+    start = time.time()
+    for number in range(tasks):
+        ledger.put((_task, (number, result_size)))
+    for _ in range(tasks):
+        ledger.get_result()
+    elapsed = time.time() - start
+
+    server.shutdown()
+    for process in processes:
+        process.terminate()
+        process.join()
+    return tasks / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--tasks', type=int, default=2000)
+    parser.add_argument('--result-size', type=int, default=1024,
+                        help='Bytes of result each task sends back.')
+    parser.add_argument('--port', type=int, default=11190)
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='Items each wire client holds ahead.')
+    parser.add_argument('--transport', action='append',
+                        choices=sorted(transports))
+    args = parser.parse_args()
+
+    for (offset, transport) in enumerate(args.transport or (MANAGER, WIRE, EVENT)):
+        rate = run(transport, args.clients, args.tasks, args.result_size,
+                   args.port + offset, args.prefetch)
+        print('%-8s %8.0f tasks/s' % (transport, rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+'''
+Describes what the clients of a distributed run are able to run and what
+test items need, so the :class:`whimsy.runner.scheduler.WorkLedger` only hands
+items to clients which can run them.
+
+A client advertises its :class:`Capabilities` when it connects to the server:
+
+- The gem5 binaries (e.g. ``X86/gem5.opt``) it can run. By default a client
+  can run any of them.
+- The binaries it has already built, which are warm. The ledger prefers
+  handing items which use a binary to clients which have it warm and also
+  counts a binary as warm on a client once the client has run an item using
+  it.
+- Its number of cores and megabytes of memory.
+- Tags, if given the client only runs items marked with one of them.
+
+The :class:`Requirements` of an item are taken from the
+:class:`whimsy.gem5.fixture.Gem5Fixture` objects it uses and its tags.
+'''
+import glob
+import multiprocessing
+import os
+
+from ..gem5.fixture import Gem5Fixture
+from ..suite import TestSuite
+
+def _physical_memory():
+    '''Return the megabytes of memory of this machine, or None if unknown.'''
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+    return pages * page_size // (1024 * 1024)
+
+def built_targets(build_dir):
+    '''
+    Return the names of the gem5 binaries which have been built in the given
+    build directory.
+    '''
+    return set(os.path.relpath(path, build_dir)
+               for path in glob.glob(os.path.join(build_dir, '*', 'gem5.*')))
+
+class Requirements(object):
+    '''
+    What a client needs to run an item.
+
+    :param targets: Names of the gem5 binaries the item runs.
+    :param tags: Tags the item is marked with.
+    :param cores: Number of cores the item needs.
+    :param memory: Megabytes of memory the item needs.
+    '''
+    def __init__(self, targets=(), tags=(), cores=1, memory=0):
+        self.targets = frozenset(targets)
+        self.tags = frozenset(tags)
+        self.cores = cores
+        self.memory = memory
+
+    @classmethod
+    def of(cls, test_item):
+        '''Return the requirements of the given suite or test case.'''
+        fixtures = list(test_item.fixtures.values())
+        tags = set(test_item.tags)
+        if isinstance(test_item, TestSuite):
+            for testcase in test_item:
+                fixtures.extend(testcase.fixtures.values())
+                tags.update(testcase.tags)
+
+        gem5_fixtures = [fixture for fixture in fixtures
+                         if isinstance(fixture, Gem5Fixture)]
+        return cls(targets=(fixture.build_target for fixture in gem5_fixtures),
+                   tags=tags,
+                   cores=max([1] + [fixture.cores
+                                    for fixture in gem5_fixtures]),
+                   memory=max([0] + [fixture.memory
+                                     for fixture in gem5_fixtures]))
+
+    def _key(self):
+        return (self.targets, self.tags, self.cores, self.memory)
+
+    def __eq__(self, other):
+        return isinstance(other, Requirements) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __str__(self):
+        parts = ['%d cores' % self.cores]
+        if self.memory:
+            parts.append('%dMB of memory' % self.memory)
+        if self.targets:
+            parts.append('targets %s' % ', '.join(sorted(self.targets)))
+        if self.tags:
+            parts.append('tags %s' % ', '.join(sorted(self.tags)))
+        return ', '.join(parts)
+
+class Capabilities(object):
+    '''
+    What a client is able to run.
+
+    :param targets: Names of the gem5 binaries the client can run, None if it
+        can run any.
+    :param warm: Names of the gem5 binaries the client has already built.
+    :param cores: Number of cores of the client.
+    :param memory: Megabytes of memory of the client, None if unknown.
+    :param tags: If given the client only runs items marked with one of these
+        tags.
+    '''
+    def __init__(self, targets=None, warm=(), cores=1, memory=None, tags=()):
+        self.targets = None if targets is None else frozenset(targets)
+        self.warm = set(warm)
+        self.cores = cores
+        self.memory = memory
+        self.tags = frozenset(tags)
+
+    @classmethod
+    def detect(cls, build_dir, targets=None, tags=()):
+        '''
+        Return the capabilities of this machine, taking the binaries already
+        built from the given build directory.
+        '''
+        return cls(targets=targets,
+                   warm=built_targets(build_dir),
+                   cores=multiprocessing.cpu_count(),
+                   memory=_physical_memory(),
+                   tags=tags)
+
+    def satisfies(self, requirements):
+        '''Return True if the client can run an item with the requirements.'''
+        if requirements is None:
+            return True
+        if self.targets is not None \
+                and not requirements.targets <= self.targets:
+            return False
+        if self.tags and not self.tags & requirements.tags:
+            return False
+        if requirements.cores > self.cores:
+            return False
+        if self.memory is not None and requirements.memory > self.memory:
+            return False
+        return True
+
+    def is_warm(self, requirements):
+        '''
+        Return True if the client has built every binary an item with the
+        requirements runs.
+        '''
+        return requirements is None or requirements.targets <= self.warm
@@ -0,0 +1,523 @@
+'''
+Implements the event transport of the distributed work server, which serves
+clients of the wire protocol (see :mod:`whimsy.runner.wire`) from a single
+thread rather than a thread per connection.
+
+The :class:`whimsy.runner.wire.WireQueueServer` gives each connection a thread
+which polls the ledger while its client waits on work. With thousands of
+clients that is thousands of threads contending for the lock of the ledger
+and the interpreter. The :class:`EventQueueServer` instead:
+
+* Watches the listening socket and every connection from one thread with
+  epoll (or poll), as :mod:`whimsy.reactor` does for the pipes of
+  subprocesses.
+* Reads into and writes out of buffers of each connection without blocking,
+  so a slow client never holds up the others.
+* Grants work to the connections waiting on it after each round of messages
+  and every :attr:`EventQueueServer.poll_interval` seconds while any wait,
+  which picks up the items the server puts itself.
+* Leaves the calls which may block, reading artifacts and waiting on the
+  results of a submitted run, to a few threads of its own and sends their
+  answers from the loop.
+
+Clients connect with the :class:`whimsy.runner.wire.WireQueueClient`
+unchanged. :mod:`whimsy.runner.stress` runs a server against hundreds of
+simulated clients.
+'''
+import collections
+import errno
+import os
+import Queue
+import select
+import socket
+import threading
+import traceback
+
+from .. import config_module
+from ..artifacts import ArtifactStore
+from ..logger import log
+from scheduler import StatusRouter, WorkLedger
+from wire import (ARTIFACT, COLLECT, CONFIG, DISCARD, GRANT, HEARTBEAT,
+                  REGISTER, RELEASE, REQUEST, RETIRE, REVOKE, STATUS, SUBMIT,
+                  AuthenticationError, answer_artifact_request,
+                  check_artifact_request, check_response, new_challenge,
+                  pack_frame, parse_frames, response_size)
+
+# epoll shares the values of the poll flags.
+_READ = select.POLLIN | select.POLLHUP | select.POLLERR
+_WRITE = select.POLLOUT
+
+_would_block = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+def _new_poller():
+    '''Return a poller and the number of its timeout units in a second.'''
+    if hasattr(select, 'epoll'):
+        return (select.epoll(), 1.0)
+    return (select.poll(), 1000.0)
+
+
+class EventQueueServer(object):
+    '''
+    Accepts client connections for a :class:`whimsy.runner.parallel.WorkServer`
+    serving all of them from a single thread.
+
+    :param lease_timeout: See :class:`whimsy.runner.scheduler.WorkLedger`,
+        defaults to the value in the config.
+    :param max_attempts: See :class:`whimsy.runner.scheduler.WorkLedger`,
+        defaults to the value in the config.
+    :param aging: See :class:`whimsy.runner.scheduler.WorkLedger`, defaults
+        to the value in the config.
+    '''
+    poll_interval = 0.1
+    '''Seconds between rounds of granting work while clients wait on it.'''
+    call_threads = 4
+    '''Threads making the calls which may block for the loop.'''
+    collect_timeout = 1.0
+    '''Most seconds a call waits on a result of a submitted run.'''
+    backlog = 1024
+    '''Connections the listening socket holds before they are accepted.'''
+    join_timeout = 1.0
+    '''Seconds to wait for the thread of the loop on shutdown.'''
+
+    def __init__(self, hostname, port, passkey, lease_timeout=None,
+                 max_attempts=None, aging=None):
+        if lease_timeout is None:
+            lease_timeout = config_module.config.lease_timeout
+        if max_attempts is None:
+            max_attempts = config_module.config.max_attempts
+        if aging is None:
+            aging = config_module.config.priority_aging
+
+        self.address = (hostname, port)
+        self.passkey = passkey
+        self.ledger = WorkLedger(lease_timeout=lease_timeout,
+                                 max_attempts=max_attempts,
+                                 aging=aging)
+        self.status_queue = Queue.Queue()
+        self.artifact_store = ArtifactStore()
+        self._listener = None
+        self._thread = None
+        self._running = False
+        (self._wakeup_r, self._wakeup_w) = (None, None)
+        # Map the file descriptor of each connection to it, only touched by
+        # the loop.
+        self._connections = {}
+        # Connections with messages to send.
+        self._dirty = set()
+        # Connections waiting on work are granted it in turns starting from
+        # a different one each round.
+        self._turn = 0
+        # Calls for our threads and the messages they answer with.
+        self._calls = Queue.Queue()
+        self._answers = collections.deque()
+        self._lock = threading.Lock()
+
+    def get_ledger(self):
+        return self.ledger
+
+    def get_status_queue(self):
+        return self.status_queue
+
+    def get_artifact_store(self):
+        return self.artifact_store
+
+    def start(self):
+        '''Start accepting connections.'''
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.address)
+        self._listener.listen(self.backlog)
+        self._listener.setblocking(False)
+        (self._wakeup_r, self._wakeup_w) = os.pipe()
+        self._running = True
+
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        for _ in range(self.call_threads):
+            thread = threading.Thread(target=self._make_calls)
+            thread.daemon = True
+            thread.start()
+
+    def shutdown(self):
+        '''Stop accepting connections and close those open.'''
+        if self._thread is None:
+            return
+        self._running = False
+        self._wake()
+        self._thread.join(self.join_timeout)
+        self._thread = None
+        for _ in range(self.call_threads):
+            self._calls.put(None)
+        with self._lock:
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            (self._wakeup_r, self._wakeup_w) = (None, None)
+
+    def _wake(self):
+        with self._lock:
+            if self._wakeup_w is not None:
+                os.write(self._wakeup_w, '\0')
+
+    def _loop(self):
+        (poller, units) = _new_poller()
+        listener = self._listener
+        poller.register(listener.fileno(), _READ)
+        poller.register(self._wakeup_r, _READ)
+        timeout = None
+        try:
+            while self._running:
+                try:
+                    events = poller.poll(-1 if timeout is None
+                                         else timeout * units)
+                except (select.error, IOError) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for (fd, event) in events:
+                    if fd == listener.fileno():
+                        self._accept(poller)
+                    elif fd == self._wakeup_r:
+                        os.read(self._wakeup_r, 4096)
+                        self._send_answers(poller)
+                    else:
+                        connection = self._connections.get(fd)
+                        if connection is not None:
+                            self._service(poller, connection, event)
+
+                # Don't block on the ledger while clients wait on work, the
+                # items put by the server don't wake us.
+                timeout = self.poll_interval if self._grant() else None
+                self._flush(poller)
+        finally:
+            for connection in self._connections.values():
+                self._close(poller, connection)
+            listener.close()
+            self._listener = None
+            if hasattr(poller, 'close'):
+                poller.close()
+
+    def _accept(self, poller):
+        while True:
+            try:
+                (sock, _) = self._listener.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] not in _would_block:
+                    # E.g. we ran out of file descriptors, the connection
+                    # waits in the backlog until the next round.
+                    log.warn('Could not accept a work client: %s' % e)
+                return
+            connection = _EventConnection(self, sock)
+            self._connections[connection.fd] = connection
+            poller.register(connection.fd, _READ)
+
+    def _service(self, poller, connection, event):
+        try:
+            if event & _WRITE:
+                self._dirty.add(connection)
+            if event & _READ:
+                for (kind, payload) in connection.receive():
+                    self._handle(connection, kind, payload)
+                if connection.eof:
+                    raise EOFError('Connection closed.')
+        except AuthenticationError:
+            log.warn('Rejected a work client which did not know the'
+                     ' passkey.')
+            self._close(poller, connection)
+        except (EOFError, IOError):
+            self._close(poller, connection)
+
+    def _flush(self, poller):
+        '''Send what we can of the messages of each connection.'''
+        (dirty, self._dirty) = (self._dirty, set())
+        for connection in dirty:
+            try:
+                sent = connection.flush()
+            except (EOFError, IOError):
+                self._close(poller, connection)
+                continue
+            # Wait for room to send the rest.
+            if sent == connection.writing:
+                connection.writing = not sent
+                poller.modify(connection.fd,
+                              _READ | _WRITE if connection.writing else _READ)
+
+    def _close(self, poller, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        del self._connections[connection.fd]
+        self._dirty.discard(connection)
+        poller.unregister(connection.fd)
+        connection.sock.close()
+        # The run which submitted them is gone.
+        for queue in connection.queues:
+            self.ledger.discard(queue)
+            self.status_queue.take(queue)
+
+    def _grant(self):
+        '''
+        Grant work to the connections waiting on it.
+
+        :returns: True if any are still waiting.
+        '''
+        connections = [connection for connection
+                       in self._connections.itervalues() if connection.wanted]
+        if not connections:
+            return False
+        self._turn = (self._turn + 1) % len(connections)
+        connections = connections[self._turn:] + connections[:self._turn]
+
+        holdings = None
+        victims = None
+        for connection in connections:
+            grants = []
+            while len(grants) < connection.wanted:
+                lease = self.ledger.acquire(connection.client, 0)
+                if lease is None:
+                    break
+                grants.append(lease)
+            if grants:
+                self._give(connection, grants)
+                continue
+
+            if holdings is None:
+                holdings = self.ledger.holdings()
+            if holdings.get(connection.client):
+                continue
+            # Our client is idle and there is nothing left to give it, take
+            # items another client is holding on to.
+            if victims is None:
+                victims = self._victims(holdings)
+            if victims:
+                (surplus, victim) = victims.pop()
+                victim.thief = connection
+                victim.send(REVOKE, (surplus + 1) // 2)
+        return any(connection.wanted for connection in connections)
+
+    def _victims(self, holdings):
+        '''
+        Return :code:`(surplus, connection)` of the connections holding items
+        they haven't started, the one holding the most last.
+        '''
+        victims = []
+        for connection in self._connections.itervalues():
+            # Each client is running one of the items it holds.
+            surplus = holdings.get(connection.client, 0) - 1
+            if surplus > 0 and connection.thief is None \
+                    and not connection.retired:
+                victims.append((surplus, connection))
+        victims.sort(key=lambda victim: victim[0])
+        return victims
+
+    def _give(self, connection, leases):
+        '''Grant the client of the connection the given leases.'''
+        if not leases:
+            return
+        if connection.retired:
+            # Our client has left, give them to someone else.
+            self.ledger.retire(connection.client)
+        elif not connection.closed:
+            connection.wanted = max(connection.wanted - len(leases), 0)
+            connection.send(GRANT, leases)
+        # Otherwise the leases expire.
+
+    def _handle(self, connection, kind, payload):
+        ledger = self.ledger
+        if kind == REQUEST:
+            (connection.client, count, results) = payload
+            for (item_id, result) in results:
+                ledger.complete(connection.client, item_id, result)
+            connection.wanted += count
+        elif kind == RETIRE:
+            (connection.client, results) = payload
+            for (item_id, result) in results:
+                ledger.complete(connection.client, item_id, result)
+            connection.retired = True
+            connection.wanted = 0
+            # Items granted which the client hadn't started.
+            ledger.retire(connection.client)
+        elif kind == HEARTBEAT:
+            ledger.heartbeat(payload)
+        elif kind == REGISTER:
+            ledger.register(*payload)
+        elif kind == STATUS:
+            self.status_queue.put(payload)
+        elif kind == RELEASE:
+            (thief, connection.thief) = (connection.thief, None)
+            if thief is not None:
+                self._give(thief, ledger.transfer(connection.client, payload,
+                                                  thief.client))
+        elif kind == ARTIFACT:
+            check_artifact_request(payload)
+            self._call(connection, ARTIFACT, answer_artifact_request,
+                       self.artifact_store, payload)
+        elif kind in (SUBMIT, COLLECT, DISCARD):
+            self._handle_submission(connection, kind, payload)
+        elif kind == CONFIG:
+            connection.send(CONFIG, (config_module.config._config,
+                                     config_module.config._defaults))
+        else:
+            raise IOError('Unexpected message %d from work client.' % kind)
+
+    def _handle_submission(self, connection, kind, payload):
+        router = self.status_queue
+        if not isinstance(router, StatusRouter):
+            raise IOError('Work server does not take submissions.')
+        if kind == SUBMIT:
+            (queue, task, requirements, priority) = payload
+            connection.queues.add(queue)
+            self.ledger.put(task, requirements, queue, priority)
+        elif kind == COLLECT:
+            (queue, timeout) = payload
+            if timeout is None or timeout > self.collect_timeout:
+                # Don't hold up one of our threads, the run asks again.
+                timeout = self.collect_timeout
+            self._call(connection, COLLECT, self._collect, queue, timeout)
+        else:
+            connection.queues.discard(payload)
+            self.ledger.discard(payload)
+            router.take(payload)
+
+    def _collect(self, queue, timeout):
+        result = self.ledger.get_result(timeout, queue)
+        # Take the events after the result so those of its item are sent
+        # with it.
+        return (result, self.status_queue.take(queue))
+
+    def _call(self, connection, kind, function, *args):
+        '''
+        Call function on one of our threads, sending its return value to the
+        client of the connection in a message of the given kind.
+        '''
+        self._calls.put((connection, kind, function, args))
+
+    def _make_calls(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+            (connection, kind, function, args) = call
+            try:
+                answer = function(*args)
+            except Exception:
+                log.warn('Exception answering a work client:\n%s'
+                         % traceback.format_exc())
+                # Drop the connection rather than leave its client waiting.
+                (kind, answer) = (None, None)
+            with self._lock:
+                self._answers.append((connection, kind, answer))
+            self._wake()
+
+    def _send_answers(self, poller):
+        with self._lock:
+            (answers, self._answers) = (self._answers, collections.deque())
+        for (connection, kind, answer) in answers:
+            if connection.closed:
+                continue
+            if kind is None:
+                self._close(poller, connection)
+            else:
+                connection.send(kind, answer)
+
+
+class _EventConnection(object):
+    '''The state and buffers of a single client of an EventQueueServer.'''
+    chunk_size = 64 * 1024
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.fd = sock.fileno()
+        self.client = None
+        # Number of items the client has asked for which it hasn't been
+        # granted.
+        self.wanted = 0
+        # The connection of the idle client we have asked our client to give
+        # items back for.
+        self.thief = None
+        # The queues submitted over the connection.
+        self.queues = set()
+        # Set once our client has retired.
+        self.retired = False
+        # Set once the client has closed its end.
+        self.eof = False
+        self.closed = False
+        # Set while the poller waits for room to send.
+        self.writing = False
+        self._received = bytearray()
+        self._outgoing = collections.deque()
+        # Bytes of the first outgoing message already sent.
+        self._sent = 0
+
+        # Until the client answers our challenge we take nothing else from
+        # it.
+        (greeting, self._challenge) = new_challenge()
+        self._outgoing.append(greeting)
+        server._dirty.add(self)
+
+    def send(self, kind, payload):
+        self._outgoing.append(pack_frame(kind, payload))
+        self.server._dirty.add(self)
+
+    def receive(self):
+        '''
+        Read what the client has sent.
+
+        :returns: List of :code:`(kind, payload)` of the messages received
+            in full.
+        '''
+        while not self.eof:
+            try:
+                data = self.sock.recv(self.chunk_size)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] in _would_block:
+                    break
+                raise
+            if not data:
+                # Handle what the client sent before it went.
+                self.eof = True
+                break
+            self._received.extend(data)
+            if len(data) < self.chunk_size:
+                break
+
+        if self._challenge is not None:
+            if len(self._received) < response_size:
+                return []
+            self._outgoing.append(check_response(
+                    self.server.passkey, self._challenge,
+                    str(self._received[:response_size])))
+            self.server._dirty.add(self)
+            self._challenge = None
+            del self._received[:response_size]
+        return parse_frames(self._received)
+
+    def flush(self):
+        '''
+        Send what we can of the outgoing messages.
+
+        :returns: True if all of them were sent.
+        '''
+        while self._outgoing:
+            data = self._outgoing[0]
+            try:
+                self._sent += self.sock.send(buffer(data, self._sent))
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] in _would_block:
+                    return False
+                raise
+            if self._sent < len(data):
+                return False
+            self._outgoing.popleft()
+            self._sent = 0
+        return True
@@ -0,0 +1,201 @@
+'''
+Serves the state of the :class:`whimsy.runner.scheduler.WorkLedger` of a work
+server in the Prometheus text format, so a slow distributed run can be looked
+into while it happens.
+
+Given ``--metrics-port``, a :class:`whimsy.runner.parallel.WorkServer` (or
+:class:`whimsy.runner.parallel.WorkDaemon`) serves the metrics over HTTP on
+localhost::
+
+    curl http://localhost:9464/metrics
+
+The metrics are:
+
+* whimsy_queue_pending - Items waiting to be handed out, by queue.
+* whimsy_items_leased - Items held by clients.
+* whimsy_clients_registered - Clients which have connected.
+* whimsy_items_dispatched_total, whimsy_items_completed_total,
+  whimsy_items_requeued_total, whimsy_items_transferred_total,
+  whimsy_items_duplicates_total and whimsy_items_abandoned_total - Counts of
+  items handed out, completed, put back after their lease expired, moved to
+  an idle client, completed again and given up on.
+* whimsy_client_completed_total - Items completed by each client.
+* whimsy_client_item_lease_seconds - Seconds each client has held each of
+  its items, a client stuck on an item shows up with a growing value.
+* whimsy_item_wait_seconds - Histogram of the seconds items waited before
+  they were first handed out.
+* whimsy_item_run_seconds - Histogram of the seconds from handing an item out
+  to its completion.
+'''
+import BaseHTTPServer
+import bisect
+import threading
+
+default_buckets = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0,
+                   1800.0, 3600.0)
+'''Upper bounds in seconds of the buckets of a :class:`Histogram`.'''
+
+class Histogram(object):
+    '''
+    Counts observed values in buckets by their upper bound.
+
+    .. note:: Not thread safe, the ledger observes values under its lock.
+    '''
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for (name, value) in sorted(labels.items()))
+
+def _format_value(value):
+    return repr(float(value))
+
+class _Writer(object):
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help, samples):
+        '''
+        Add a metric given an iterable of :code:`(labels, value)` samples,
+        labels being a dictionary.
+        '''
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+        for (labels, value) in samples:
+            self.lines.append('%s%s %s' % (name, _labels(**labels),
+                                           _format_value(value)))
+
+    def histogram(self, name, help, histogram):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s histogram' % name)
+        cumulative = 0
+        for (bound, count) in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self.lines.append('%s_bucket%s %s' % (
+                    name, _labels(le=_format_value(bound)),
+                    _format_value(cumulative)))
+        self.lines.append('%s_bucket%s %s' % (name, _labels(le='+Inf'),
+                                              _format_value(histogram.count)))
+        self.lines.append('%s_sum %s' % (name, _format_value(histogram.sum)))
+        self.lines.append('%s_count %s' % (name,
+                                           _format_value(histogram.count)))
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+def render(metrics):
+    '''
+    Return the Prometheus text format of a snapshot given by
+    :meth:`whimsy.runner.scheduler.WorkLedger.metrics`.
+    '''
+    writer = _Writer()
+    writer.metric('whimsy_queue_pending', 'gauge',
+                  'Items waiting to be handed out.',
+                  ((dict(queue='' if queue is None else queue), pending)
+                   for (queue, pending) in metrics['queues'].iteritems()))
+    writer.metric('whimsy_items_leased', 'gauge', 'Items held by clients.',
+                  [({}, sum(len(held)
+                            for held in metrics['leases'].itervalues()))])
+    writer.metric('whimsy_clients_registered', 'gauge',
+                  'Clients which have connected.',
+                  [({}, metrics['clients'])])
+    for (counter, help) in (
+            ('dispatched', 'Items handed out to clients.'),
+            ('completed', 'Items completed.'),
+            ('requeued', 'Items put back after their lease expired.'),
+            ('transferred', 'Items moved to an idle client.'),
+            ('duplicates', 'Items completed again after their first result.'),
+            ('abandoned', 'Items given up on.')):
+        writer.metric('whimsy_items_%s_total' % counter, 'counter', help,
+                      [({}, metrics[counter])])
+    writer.metric('whimsy_client_completed_total', 'counter',
+                  'Items completed by each client.',
+                  ((dict(client=client), completed) for (client, completed)
+                   in metrics['client_completed'].iteritems()))
+    writer.metric('whimsy_client_item_lease_seconds', 'gauge',
+                  'Seconds each client has held each of its items.',
+                  ((dict(client=client, item=item), seconds)
+                   for (client, held) in metrics['leases'].iteritems()
+                   for (item, seconds) in held))
+    writer.histogram('whimsy_item_wait_seconds',
+                     'Seconds items waited before they were first handed out.',
+                     metrics['wait_times'])
+    writer.histogram('whimsy_item_run_seconds',
+                     'Seconds from handing an item out to its completion.',
+                     metrics['run_times'])
+    return writer.text()
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = render(self.server.snapshot())
+        except (IOError, EOFError):
+            # The work server is going away.
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the console.
+        pass
+
+class MetricsServer(object):
+    '''
+    Serves the metrics of a ledger over HTTP from a thread of its own.
+
+    :param snapshot: Called to get a snapshot of the ledger, e.g. the
+        :meth:`~whimsy.runner.scheduler.WorkLedger.metrics` method of the
+        ledger or of a proxy of it.
+    :param port: Port to listen on, 0 picks a free port.
+    :param hostname: Address to listen on, only this machine by default.
+    '''
+    def __init__(self, snapshot, port, hostname='localhost'):
+        self._server = BaseHTTPServer.HTTPServer((hostname, port), _Handler)
+        self._server.snapshot = snapshot
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
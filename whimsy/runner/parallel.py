@@ -4,15 +4,46 @@ implementation of imap_unordered depending on the number of threads requested
 on subclass `__init__`. A single instance of imap_unordered may be active at
 one time. Additional executions will require that the previous imap have
 finished.
+
+A :class:`WorkDaemon` (the ``serve`` command) keeps a work server and its
+workers running between runs. Runs given ``--server`` submit their items to
+it through a :class:`WorkSubmitter` rather than starting their own, each run
+getting its own queue in the daemon's
+:class:`~whimsy.runner.scheduler.WorkLedger` so concurrent runs share the
+workers fairly.
 '''
 import abc
 import multiprocessing
 from multiprocessing.managers import SyncManager
+import os
 import Queue
+import signal
+import socket
+import sys
+import threading
+import time
 from itertools import imap
 
+from .. import artifacts
 from .. import config_module
+from ..artifacts import ArtifactCache, ArtifactFetcher, ArtifactStore
 from ..logger import log
+from ..profiler import profiler
+from ..timeline import timeline
+from autoscale import WorkerScaler
+from capability import Capabilities
+from eventserver import EventQueueServer
+from metrics import MetricsServer
+from scheduler import AbandonedWork, StatusRouter, Submission, WorkLedger
+from wire import WireQueueServer, WireQueueClient
+
+status_queue = None
+'''
+In the process of a :class:`WorkClient` the queue which status events of the
+items it runs are sent to the server through.
+'''
+worker_id = None
+'''In the process of a :class:`WorkClient` the id of this worker.'''
 
 class WorkerPool(object):
     '''
@@ -31,24 +62,36 @@ class WorkerPool(object):
     def pool(self):
         pass
 
-    def imap_unordered(self, map_function, args):
+    def imap_unordered(self, map_function, args, status_callback=None,
+                       requirements=None, priority=None):
         '''
         :param function: A module level function to supply jobs to. (Note: Must
             be exposed globaly by a module.
         :param args: An iterable containing arguments provided to members of
             the pool which the function will take.
+        :param status_callback: Called with each status event workers put on
+            the :data:`status_queue` while the jobs run. Only used by pools
+            which support it.
+        :param requirements: Called with each argument to get the
+            :class:`~whimsy.runner.capability.Requirements` of a worker to
+            run its job. Only used by pools which support it.
+        :param priority: Called with each argument to get the priority of its
+            job, jobs with a higher priority are run first. Only used by pools
+            which support it.
 
         Effectively this function performs:
 
         >>> return (map_function(arg) for arg in args)
         '''
         if self.parallel:
-            return self._imap_parallel(map_function, args)
+            return self._imap_parallel(map_function, args, status_callback,
+                                       requirements, priority)
         return self._imap_serial(map_function, args)
 
     _imap_serial = imap
 
-    def _imap_parallel(self, map_function, args):
+    def _imap_parallel(self, map_function, args, status_callback=None,
+                       requirements=None, priority=None):
         return self.pool.imap_unordered(map_function, args)
 
 class MulticoreWorkerPool(WorkerPool):
@@ -67,7 +110,8 @@ class MulticoreWorkerPool(WorkerPool):
     def pool(self):
         return getattr(self, '_process_pool', None)
 
-    def _imap_parallel(self, map_function, args):
+    def _imap_parallel(self, map_function, args, status_callback=None,
+                       requirements=None, priority=None):
         jobs = ((map_function, arg) for arg in args)
         try:
             gen = super(MulticoreWorkerPool, self)._imap_parallel(
@@ -97,48 +141,118 @@ class ComplexMulticorePool(WorkerPool):
 
     Additionally, if more than one thread is given will allow remote clients to
     connect and join the pool.
+
+    If the config is adaptive the number of local workers is scaled between
+    the minimum and the number of threads by a
+    :class:`~whimsy.runner.autoscale.WorkerScaler` while items run.
     '''
     def __init__(self, threads=None):
         super(ComplexMulticorePool, self).__init__(threads)
-
-        if self.parallel:
+        self.scaler = None
+
+        if config_module.config.server:
+            # The daemon's workers run our items, however many threads we
+            # were given.
+            self.parallel = True
+            self.server = WorkSubmitter(*config_module.config.credentials)
+        elif self.parallel:
             credentials = config_module.config.credentials
             self.server = WorkServer(*credentials)
 
+            workers = threads
+            if config_module.config.adaptive:
+                self.scaler = WorkerScaler(config_module.config.min_workers,
+                                           threads)
+                workers = self.scaler.minimum
+
             # The work server starts it's own worker, so we only make n-1
             # additional workers.
             self._additional_workers = []
-            for thread in range(1, threads):
-                new_worker = WorkClient(*credentials, as_client=False)
-                new_worker.daemon = True
-                # NOTE: When this pool is deleted and the server closes down
-                # this process will be killed.
-                new_worker.start()
-                self._additional_workers.append(new_worker)
+            for thread in range(1, workers):
+                self._add_worker()
 
 
     @property
     def pool(self):
         return self.server
 
-    def _imap_parallel(self, function, args):
+    def _add_worker(self):
+        new_worker = WorkClient(*config_module.config.credentials,
+                                as_client=False)
+        new_worker.daemon = True
+        # NOTE: When this pool is deleted and the server closes down
+        # this process will be killed.
+        new_worker.start()
+        self._additional_workers.append(new_worker)
+
+    def _scale(self, stop):
+        '''
+        Add and retire local workers as our scaler decides until stop is
+        set.
+        '''
+        while not stop.wait(self.scaler.interval):
+            self._additional_workers = [worker for worker
+                                        in self._additional_workers
+                                        if worker.is_alive()]
+            # The work server's own worker counts as one.
+            workers = len(self._additional_workers) + 1
+            change = self.scaler.decide(workers)
+            if change > 0:
+                log.info('Starting local worker %d.' % (workers + 1))
+                self._add_worker()
+            elif change < 0:
+                log.info('Retiring local worker %d.' % workers)
+                self._additional_workers.pop().retire()
+
+    def _imap_parallel(self, function, args, status_callback=None,
+                       requirements=None, priority=None):
         self.server.start()
-        for i in self.server.imap_unordered(function, args):
-            yield i
+        stop = threading.Event()
+        if self.scaler is not None:
+            scaling = threading.Thread(target=self._scale, args=(stop,))
+            scaling.daemon = True
+            scaling.start()
+        try:
+            for i in self.server.imap_unordered(function, args,
+                                                status_callback, requirements,
+                                                priority):
+                yield i
+        finally:
+            stop.set()
         self.server.shutdown()
 
 class WorkQueueServer(SyncManager):
     '''
-    Implements a server which clients can connect to get work and result queues
-    as well as the server's config setup.
+    Implements a server which clients can connect to get the work ledger and
+    status queue as well as the server's config setup.
+
+    :param lease_timeout: See :class:`whimsy.runner.scheduler.WorkLedger`,
+        defaults to the value in the config.
+    :param max_attempts: See :class:`whimsy.runner.scheduler.WorkLedger`,
+        defaults to the value in the config.
+    :param aging: See :class:`whimsy.runner.scheduler.WorkLedger`, defaults
+        to the value in the config.
     '''
-    def __init__(self, hostname, port, passkey):
-
-        self.work_queue = Queue.Queue()
-        self.result_queue = Queue.Queue()
-
-        self.register('get_work_queue', lambda:self.work_queue)
-        self.register('get_result_queue', lambda:self.result_queue)
+    def __init__(self, hostname, port, passkey, lease_timeout=None,
+                 max_attempts=None, aging=None):
+        if lease_timeout is None:
+            lease_timeout = config_module.config.lease_timeout
+        if max_attempts is None:
+            max_attempts = config_module.config.max_attempts
+        if aging is None:
+            aging = config_module.config.priority_aging
+
+        self.ledger = WorkLedger(lease_timeout=lease_timeout,
+                                 max_attempts=max_attempts,
+                                 aging=aging)
+        self.status_queue = Queue.Queue()
+        self.artifact_store = ArtifactStore()
+
+        self.register('get_ledger', lambda:self.ledger)
+        self.register('get_status_queue', lambda:self.status_queue)
+        self.register('get_artifact_store', lambda:self.artifact_store)
+        self.register('get_submission',
+                lambda queue:Submission(self.ledger, self.status_queue, queue))
 
         # NOTE: We use a tuple with dictionaries because the SyncManager will
         # not automatically pass 'deepcopy's of objects. So the config manually
@@ -151,11 +265,37 @@ class WorkQueueServer(SyncManager):
 
 class WorkQueueClient(SyncManager):
     def __init__(self, hostname, port, passkey):
-        self.register('get_work_queue')
-        self.register('get_result_queue')
+        self.register('get_ledger')
+        self.register('get_status_queue')
+        self.register('get_artifact_store')
+        self.register('get_submission')
         self.register('get_shared_config')
         super(WorkQueueClient, self).__init__((hostname, port), passkey)
 
+    def shared_config(self):
+        '''Return the config dictionaries of the server.'''
+        return self.get_shared_config()._getvalue()
+
+MANAGER = 'manager'
+WIRE = 'wire'
+EVENT = 'event'
+transports = {
+    MANAGER: (WorkQueueServer, WorkQueueClient),
+    WIRE: (WireQueueServer, WireQueueClient),
+    EVENT: (EventQueueServer, WireQueueClient),
+}
+'''
+Map the name of each transport to its pair of server and client classes.
+
+manager - Clients call the server through
+    :class:`multiprocessing.managers.SyncManager` proxies.
+
+wire - Clients use the framed protocol of :mod:`whimsy.runner.wire`.
+
+event - Clients use the framed protocol, the server serves all of them from
+    a single thread. (See :mod:`whimsy.runner.eventserver`.)
+'''
+
 class WorkServer(object):
     '''
     Implements a server object which creates work queues and result queues
@@ -163,18 +303,24 @@ class WorkServer(object):
     implement an imap_unordered function that does not block, a separate client
     is spawned with the server.
     '''
+    status_interval = 0.1
+    '''Seconds between checks for status events while waiting on results.'''
+
     def __init__(self, hostname, port, passkey):
-        self.queue_server = WorkQueueServer(hostname, port, passkey)
+        (server_class, _) = transports[config_module.config.transport]
+        self.queue_server = server_class(hostname, port, passkey)
         self.dest = (hostname, port, passkey)
 
         # Indicates that a imap function is already in progress.
         self.in_progress = False
         self.started = False
+        self.metrics_server = None
 
     def start(self):
         '''Start the server and the helping work_client.'''
         # Start the work queue manager.
         self.queue_server.start()
+        self.metrics_server = _start_metrics(self.queue_server)
 
         # Spawn a subprocess to also participate in work in case we are a server
         # with no workers.
@@ -189,6 +335,8 @@ class WorkServer(object):
         Shutdown the server, the client will close asynchronosly since it
         will block in its own process waiting for the socket to close.
         '''
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
         self.queue_server.shutdown()
         # NOTE: It will take a decent amount of time for the work_client to close
         # its sockets so we don't bother joining. Just let the process cleanup
@@ -196,43 +344,297 @@ class WorkServer(object):
         # self.p.terminate()
         # self.work_client.join()
 
-    def imap_unordered(self, function, args):
+    def imap_unordered(self, function, args, status_callback=None,
+                       requirements=None, priority=None):
         '''
         Provides functional equivalence of:
 
         >>> return (function(arg) for arg in args)
 
+        :param status_callback: If given, called with each status event put
+            on the status queue by workers while we wait for results.
+        :param requirements: If given, called with each arg to get the
+            :class:`~whimsy.runner.capability.Requirements` of a client to
+            run it. Only clients which satisfy them are given the item.
+        :param priority: If given, called with each arg to get the priority
+            of its item. Items with a higher priority are leased first.
+
+        Items are leased to clients through a
+        :class:`whimsy.runner.scheduler.WorkLedger`, so items held by clients
+        which crash or lose their connection are run again. An item which is
+        never completed or which no client can run is given as
+        a :class:`whimsy.runner.scheduler.AbandonedWork` result.
+
         .. note:: This will not block since we also spawn a `work_client` to
             assist this process.
         '''
-        work_queue = self.queue_server.get_work_queue()
-        result_queue = self.queue_server.get_result_queue()
+        ledger = self._get_ledger()
         length = 0
         for arg in args:
             length += 1
-            work_queue.put((function, arg))
+            ledger.put((function, arg),
+                       None if requirements is None else requirements(arg),
+                       priority=0 if priority is None else priority(arg))
+
+        status_queue = None
+        if status_callback is not None:
+            status_queue = self._get_status_queue()
 
         for _ in range(length):
-            yield result_queue.get()
+            while True:
+                if status_queue is not None:
+                    self._drain_status(status_queue, status_callback)
+                result = ledger.get_result(self.status_interval)
+                if result is not None:
+                    break
+            (_, result) = result
+            if isinstance(result, AbandonedWork):
+                log.warn('Giving up on %s: %s' % (result.arg, result.reason))
+            if status_queue is not None:
+                # Workers send status before their result, make sure we pass
+                # it on before the result.
+                self._drain_status(status_queue, status_callback)
+            yield result
+
+    def _get_ledger(self):
+        return self.queue_server.get_ledger()
+
+    def _get_status_queue(self):
+        return self.queue_server.get_status_queue()
+
+    @staticmethod
+    def _drain_status(status_queue, status_callback):
+        while True:
+            try:
+                event = status_queue.get_nowait()
+            except Queue.Empty:
+                return
+            status_callback(event)
+
+class _Submitted(object):
+    '''
+    An item of a run submitted to a :class:`WorkDaemon`. Carries the config of
+    the run so the daemon's workers run it as the run's own workers would.
+    '''
+    def __init__(self, queue, shared_config, function, arg):
+        self.queue = queue
+        self.shared_config = shared_config
+        self.function = function
+        self.arg = arg
+
+    def __str__(self):
+        return str(self.arg)
+
+class _TaggedQueue(object):
+    '''
+    Puts status events on a :class:`~whimsy.runner.scheduler.StatusRouter`
+    tagged with the queue of the item they are for.
+    '''
+    def __init__(self, queue, tag):
+        self.queue = queue
+        self.tag = tag
+
+    def put(self, event):
+        self.queue.put((self.tag, event))
+
+def _run_submitted(submitted):
+    '''
+    Module level function used by the workers of a :class:`WorkDaemon` to run
+    an item submitted by a :class:`WorkSubmitter`.
+    '''
+    global status_queue
+    _apply_config(submitted.shared_config)
+    # Drop events of the items of other runs, the timeline only records if
+    # this run asked for it.
+    timeline.drain()
+    timeline.enabled = bool(config_module.config.trace_file)
+
+    router = status_queue
+    status_queue = _TaggedQueue(router, submitted.queue)
+    try:
+        return submitted.function(submitted.arg)
+    finally:
+        status_queue = router
+
+class WorkSubmitter(WorkServer):
+    '''
+    Runs items on the workers of a :class:`WorkDaemon` rather than our own,
+    exposing the same interface as a :class:`WorkServer`.
+    '''
+    def __init__(self, hostname, port, passkey):
+        (_, client_class) = transports[config_module.config.transport]
+        self.queue_client = client_class(hostname, port, passkey)
+        self.dest = (hostname, port, passkey)
+        # Name our queue in the daemon's ledger after our process.
+        self.queue = '%s:%d:%f' % (socket.gethostname(), os.getpid(),
+                                   time.time())
+        self.submission = None
+
+    def start(self):
+        '''Connect to the daemon.'''
+        self.queue_client.connect()
+        self.submission = self.queue_client.get_submission(self.queue)
+
+    def shutdown(self):
+        '''Drop whatever is left of our items on the daemon.'''
+        if self.submission is not None:
+            self.submission.discard()
+            self.submission = None
+
+    def _get_ledger(self):
+        return self.submission
+
+    def _get_status_queue(self):
+        return self.submission
+
+    def imap_unordered(self, function, args, status_callback=None,
+                       requirements=None, priority=None):
+        '''
+        See :meth:`WorkServer.imap_unordered`, the function is called with
+        each arg on the daemon's workers under our config.
+        '''
+        shared_config = (config_module.config._config,
+                         config_module.config._defaults)
+        submitted = (_Submitted(self.queue, shared_config, function, arg)
+                     for arg in args)
+        if requirements is not None:
+            requirements = (lambda submitted, requirements=requirements:
+                            requirements(submitted.arg))
+        if priority is not None:
+            priority = (lambda submitted, priority=priority:
+                        priority(submitted.arg))
+
+        for result in super(WorkSubmitter, self).imap_unordered(
+                _run_submitted, submitted, status_callback, requirements,
+                priority):
+            if isinstance(result, AbandonedWork):
+                # Give back the task as it would have been put.
+                result.task = (function, result.task[1].arg)
+            yield result
+
+class WorkDaemon(object):
+    '''
+    Keeps a work server and local workers running, running the items of the
+    runs submitted to it by :class:`WorkSubmitter` objects until interrupted.
+    Remote clients may connect to it as they would to the server of a run.
+
+    :param threads: Number of local workers to start.
+    '''
+    poll_interval = 1.0
+    '''Seconds to sleep between waking up to check for interrupts.'''
+
+    def __init__(self, hostname, port, passkey, threads=1):
+        (server_class, _) = transports[config_module.config.transport]
+        self.queue_server = server_class(hostname, port, passkey)
+        # Keep the status events of each run apart. (The manager transport
+        # looks this up each time a client asks for it.)
+        self.queue_server.status_queue = StatusRouter()
+        self.dest = (hostname, port, passkey)
+        self.threads = threads
+        self.workers = []
+
+    def serve(self):
+        '''Serve submitted runs until interrupted.'''
+        self.queue_server.start()
+        metrics_server = _start_metrics(self.queue_server)
+        for _ in range(self.threads):
+            worker = WorkClient(*self.dest, as_client=False)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        try:
+            while True:
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if metrics_server is not None:
+                metrics_server.shutdown()
+            self.queue_server.shutdown()
+
+def _start_metrics(queue_server):
+    '''
+    Start serving the metrics of the ledger of the started queue server if
+    a metrics port was given.
+
+    :returns: The :class:`~whimsy.runner.metrics.MetricsServer` or None.
+    '''
+    port = config_module.config.metrics_port
+    if port is None:
+        return None
+    # The ledger of the manager transport lives in the manager's process, ask
+    # it through a proxy.
+    metrics_server = MetricsServer(queue_server.get_ledger().metrics, port)
+    metrics_server.start()
+    log.bold('Serving work server metrics on http://%s:%d/metrics'
+             % metrics_server.address)
+    return metrics_server
 
 class WorkClient(multiprocessing.Process):
-    # Signals sent through the work queue.
+    reconnect_attempts = 5
+    '''
+    Number of times to try to reconnect to the server after losing the
+    connection to it.
+    '''
+    reconnect_delay = 1.0
+    '''Seconds to wait before each attempt to reconnect.'''
+    acquire_timeout = 1.0
+    '''Seconds to wait for work before asking the server again.'''
+    profile_interval = 5.0
+    '''
+    Most seconds between writing out our profiles while we are kept busy.
+    (They are also written when we go idle and when we exit.)
+    '''
+
     def __init__(self, hostname, port, passkey, as_client=True):
         '''
         :param as_client: Set the config.command of the client process to
             'client'.
         '''
         self.dest = (hostname, port, passkey)
-        self.queue_client = WorkQueueClient(hostname, port, passkey)
+        transport = config_module.config.transport
+        (_, self.client_class) = transports[transport]
+        self.client_kwargs = {}
+        if transport in (WIRE, EVENT):
+            # Remote clients prefetch as many items as they were told to
+            # rather than the server.
+            self.client_kwargs['prefetch'] = config_module.config.prefetch
+        self.queue_client = self.client_class(hostname, port, passkey,
+                                              **self.client_kwargs)
+        # Take what we can run from our own config, it is replaced by that of
+        # the server once we connect.
+        if as_client:
+            self.capabilities = Capabilities.detect(
+                    config_module.config.build_dir,
+                    config_module.config.targets or None,
+                    config_module.config.tags)
+            # Remote clients fetch what they don't have in their filesystem
+            # from the server, local ones share it.
+            self.artifact_cache = ArtifactCache(
+                    config_module.config.artifact_cache,
+                    config_module.config.artifact_cache_size * 1024 * 1024)
+        else:
+            self.capabilities = Capabilities.detect(
+                    config_module.config.build_dir)
+            self.artifact_cache = None
         self.as_client = as_client
+        self.ledger = None
+        self._retiring = multiprocessing.Event()
         super(WorkClient, self).__init__()
 
+    def retire(self):
+        '''
+        Ask the worker to leave once it finishes the item it is running, the
+        items it holds but hasn't started are given to other workers.
+        '''
+        self._retiring.set()
 
     def run(self):
         '''
-        Connects to the server and gathers its work and result queues. Also
-        the majority of the config of the server process. (Allowing flags like
-        `fail_fast` to be passed to us.)
+        Connects to the server and gathers its work ledger and status queue.
+        Also the majority of the config of the server process. (Allowing flags
+        like `fail_fast` to be passed to us.)
 
         .. note:: Exectued on the client process.
         '''
@@ -248,37 +650,175 @@ class WorkClient(multiprocessing.Process):
                             ' could start.')
         try:
             self._copy_config()
-            work_queue = self.queue_client.get_work_queue()
-            result_queue = self.queue_client.get_result_queue()
+            self.ledger = self.queue_client.get_ledger()
+            self._set_status_queue(self.queue_client.get_status_queue())
+            self.ledger.register(worker_id, self.capabilities)
+            self._set_artifact_store(self.queue_client)
         except IOError:
             log.bold(disconnected_msg)
         except EOFError:
             log.bold(disconnected_msg)
         else:
-            self.imap_task(work_queue, result_queue)
+            heartbeat = threading.Thread(target=self._heartbeat)
+            heartbeat.daemon = True
+            heartbeat.start()
+            # Local workers are terminated once the run is over, leave
+            # through the finally clause so our profiles are written.
+            signal.signal(signal.SIGTERM, _exit_on_sigterm)
+            try:
+                self.imap_task()
+            finally:
+                self._dump_profiles()
             log_if_client(log.bold, 'Work completed for test server, closing.')
 
 
+    @staticmethod
+    def _dump_profiles():
+        '''
+        Write the profiles of our process for the server to aggregate with
+        its own.
+        '''
+        try:
+            profiler.dump(config_module.config.result_path,
+                          worker_id.replace(':', '-'))
+        except (IOError, OSError) as e:
+            log.warn('Could not write the profiles of worker %s: %s'
+                     % (worker_id, e))
+
+    def _checkpoint_profiles(self, idle):
+        '''
+        Write our profiles if we have run items since we last did and we have
+        gone idle, so the server likely has all of our results, or it has
+        been profile_interval seconds. Rewriting them after every item would
+        cost more than the profiling itself.
+        '''
+        if not self._ran_items or not profiler.phases:
+            return
+        now = time.time()
+        if idle or now - self._profiles_written >= self.profile_interval:
+            self._dump_profiles()
+            self._ran_items = False
+            self._profiles_written = now
+
     def _copy_config(self):
         '''
         Copies the config of the server, modifying it sligtly to fit the
         requirements for a work client.
         '''
-        newconfig = self.queue_client.get_shared_config()
-        config_module.config._init_with_dicts(*newconfig._getvalue())
-        # In the copied config, don't spawn additional threads.
-        config_module.config._set('threads', 1)
-        if self.as_client:
-            config_module.config._set('command', 'client')
+        _apply_config(self.queue_client.shared_config(),
+                      'client' if self.as_client else None)
+        if config_module.config.trace_file:
+            # Drop any events we inherited from the server when forked,
+            # otherwise they would be sent back to it as our own.
+            timeline.drain()
+            timeline.enable()
+        profiler.enable(config_module.config.profile)
 
     @staticmethod
-    def imap_task(wq, rq):
-        try:
-            while True:
-                (function, arg) = wq.get()
-                rq.put(function(arg))
-        except EOFError:
-            return
+    def _set_status_queue(queue):
+        global status_queue, worker_id
+        status_queue = queue
+        worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def _set_artifact_store(self, queue_client):
+        if self.artifact_cache is not None:
+            artifacts.fetcher = ArtifactFetcher(
+                    queue_client.get_artifact_store(), self.artifact_cache)
+
+    def _heartbeat(self):
+        '''
+        Renew the leases on the items we hold while we run them.
+
+        .. note:: Runs on its own thread, the proxy gives each thread its own
+            connection to the server.
+        '''
+        interval = config_module.config.lease_timeout / 3.0
+        while True:
+            time.sleep(interval)
+            try:
+                self.ledger.heartbeat(worker_id)
+            except (IOError, EOFError):
+                # The main thread will notice and reconnect.
+                pass
+
+    def _reconnect(self):
+        '''
+        Try to reconnect to the server after losing the connection to it.
+
+        :returns: True if we reconnected.
+        '''
+        for _ in range(self.reconnect_attempts):
+            time.sleep(self.reconnect_delay)
+            queue_client = self.client_class(*self.dest, **self.client_kwargs)
+            try:
+                # Both transports keep retrying a refused connection for
+                # a long time, check the server is back first.
+                socket.create_connection(self.dest[:2],
+                                         self.reconnect_delay).close()
+                queue_client.connect()
+                self.ledger = queue_client.get_ledger()
+                self._set_status_queue(queue_client.get_status_queue())
+                self.ledger.register(worker_id, self.capabilities)
+                self._set_artifact_store(queue_client)
+            except (IOError, EOFError):
+                continue
+            self.queue_client = queue_client
+            log_if_client(log.bold, 'Reconnected to test server.')
+            return True
+        return False
+
+    def imap_task(self):
+        '''
+        Run items leased from the server until it goes away.
+
+        If the connection drops we try to reconnect and send the result we
+        were holding. The server will have already run the item again if we
+        took longer than a lease, in which case it drops our result.
+        '''
+        unsent = None
+        self._ran_items = False
+        self._profiles_written = time.time()
+        while True:
+            try:
+                if unsent is None:
+                    if self._retiring.is_set():
+                        self.ledger.retire(worker_id)
+                        return
+                    lease = self.ledger.acquire(worker_id,
+                                                self.acquire_timeout)
+                    if lease is None:
+                        # The server may be done with the run before we
+                        # exit.
+                        self._checkpoint_profiles(idle=True)
+                        continue
+                    (item_id, _, (function, arg)) = lease
+                    unsent = (item_id, function(arg))
+                    self._ran_items = True
+                    # Write them before the server can have all our results.
+                    self._checkpoint_profiles(idle=False)
+                self.ledger.complete(worker_id, *unsent)
+                unsent = None
+            except (IOError, EOFError):
+                if not self._reconnect():
+                    return
+
+def _exit_on_sigterm(signum, frame):
+    sys.exit(0)
+
+def _apply_config(shared_config, command=None):
+    '''
+    Replace our config with the given config dictionaries of a server,
+    modifying it slightly to fit the requirements of a worker.
+
+    :param command: If given, replaces the command of the config.
+    '''
+    config_module.config._init_with_dicts(*shared_config)
+    # In the copied config, don't spawn additional threads or submit to
+    # a daemon.
+    config_module.config._set('threads', 1)
+    config_module.config._set('server', False)
+    if command is not None:
+        config_module.config._set('command', command)
 
 def log_if_client(callback, *args, **kwargs):
     '''
@@ -70,20 +70,27 @@ TestCase instances in that TestSuite will be skipped.
 import traceback
 import itertools
 import datetime
+import os
 
+import parallel
+from capability import Requirements
 from parallel import MulticoreWorkerPool, ComplexMulticorePool
+from scheduler import AbandonedWork
 
 from .. import test
 from .. import _util
 
 from ..config import config
-from ..helper import mkdir_p, joinpath
+from ..helper import mkdir_p, joinpath, resource_accounting
 from ..logger import log
-from ..result import ConsoleLogger, Outcome, test_results_output_path
+from ..profiler import profiler
+from ..result import ConsoleLogger, Outcome, ResultLogger, \
+        test_results_output_path
 from ..suite import TestSuite, SuiteList
 from ..tee import tee
 from ..terminal import separator
 from ..test import TestCase
+from ..timeline import timeline
 
 
 class Runner(object):
@@ -195,8 +202,26 @@ class Runner(object):
            - Collect results as tests are performed.
         2. Handle teardown for all fixtures in the test_suite.
         '''
+        with timeline.span(test_suite.name, 'suite', uid=test_suite.uid):
+            return self._run_suite_wrapped(test_suite)
+
+    def _run_suite_wrapped(self, test_suite):
         self.callbacks.begin(item=test_suite)
 
+        timer = _util.Timer()
+        timer.start()
+        with resource_accounting() as usage:
+            outcome = self._run_suite_tests(test_suite)
+        timer.stop()
+
+        self.callbacks.set_outcome(item=test_suite, outcome=outcome,
+                                   runtime=timer.runtime(),
+                                   resource_usage=usage)
+        self.callbacks.end(item=test_suite)
+
+        return outcome
+
+    def _run_suite_tests(self, test_suite):
         suite_iterator = enumerate(test_suite.iter_testlists())
 
         outcomes = set()
@@ -229,15 +254,9 @@ class Runner(object):
                     # Iterate through the current testlist skipping its tests.
                     self._generate_skips(testcase.name, rem_iter)
 
-        for fixture in test_suite.fixtures.values():
-            fixture.teardown()
-
-        outcome = self._suite_outcome(outcomes)
-
-        self.callbacks.set_outcome(item=test_suite, outcome=outcome)
-        self.callbacks.end(item=test_suite)
+        self._teardown(test_suite.fixtures.values())
 
-        return outcome
+        return self._suite_outcome(outcomes)
 
     def _suite_outcome(self, outcomes):
         '''
@@ -282,10 +301,21 @@ class Runner(object):
         fstderr_name = joinpath(outdir, config.constants.system_out_name)
 
         # Capture the output into a file.
-        with tee(fstderr_name, stderr=True, stdout=False),\
+        with timeline.span(testobj.name, 'test', uid=testobj.uid,
+                           cls=testobj.__class__.__name__),\
+                tee(fstderr_name, stderr=True, stdout=False),\
                 tee(fstdout_name, stderr=False, stdout=True):
-            return self._run_test_wrapped(testobj, fstdout_name,
-                                  fstderr_name, fixtures)
+            outcome = self._run_test_wrapped(testobj, fstdout_name,
+                                             fstderr_name, fixtures)
+
+        # Now that tee has closed the output files, bound their size so huge
+        # logs don't have to be carried around by result loggers.
+        if config.output_limit is not None:
+            for fname in (fstdout_name, fstderr_name):
+                _util.bound_output_file(fname,
+                                        config.output_limit * 1024,
+                                        keep_full=config.keep_full_output)
+        return outcome
 
     def _run_test_wrapped(self, testobj, fstdout_name, fstderr_name, fixtures):
         if fixtures is None:
@@ -298,10 +328,13 @@ class Runner(object):
 
         self.callbacks.begin(item=testobj)
 
+        outdir = os.path.dirname(fstdout_name)
+
         def _run_test():
             reason = None
             try:
-                testobj(fixtures=fixtures)
+                with profiler.profile('test', outdir):
+                    testobj(fixtures=fixtures)
             except AssertionError as e:
                 reason = e.message
                 if not reason:
@@ -321,31 +354,37 @@ class Runner(object):
 
             return (outcome, reason)
 
-        # Build any fixtures that haven't been built yet.
-        log.debug('Building fixtures for TestCase: %s' % testobj.name)
-        failed_builds = self._setup_unbuilt(
-                fixtures.values(),
-                setup_lazy_init=True)
-
-        if failed_builds:
-            reason = ''
-            for fixture, error in failed_builds:
-                reason += 'Failed to build %s\n' % fixture
-                reason += '%s' % error
-            reason = reason
-            outcome = Outcome.ERROR
-        else:
-            (outcome, reason) = _run_test()
+        timer = _util.Timer()
+        timer.start()
+        with resource_accounting() as usage:
+            # Build any fixtures that haven't been built yet.
+            log.debug('Building fixtures for TestCase: %s' % testobj.name)
+            failed_builds = self._setup_unbuilt(
+                    fixtures.values(),
+                    setup_lazy_init=True,
+                    outdir=outdir)
+
+            if failed_builds:
+                reason = ''
+                for fixture, error in failed_builds:
+                    reason += 'Failed to build %s\n' % fixture
+                    reason += '%s' % error
+                reason = reason
+                outcome = Outcome.ERROR
+            else:
+                (outcome, reason) = _run_test()
 
-        for fixture in testobj.fixtures.values():
-            fixture.teardown()
+            self._teardown(testobj.fixtures.values())
+        timer.stop()
 
         self.callbacks.set_outcome(
                 item=testobj,
                 outcome=outcome,
                 reason=reason,
                 fstdout_name=fstdout_name,
-                fstderr_name=fstderr_name
+                fstderr_name=fstderr_name,
+                runtime=timer.runtime(),
+                resource_usage=usage
         )
         self.callbacks.end(item=testobj)
         return outcome
@@ -401,18 +440,28 @@ class Runner(object):
             elif __debug__:
                 raise AssertionError(_util.unexpected_item_msg)
 
-    def _setup_unbuilt(self, fixtures, setup_lazy_init=False):
+    def _setup_unbuilt(self, fixtures, setup_lazy_init=False, outdir=None):
         failures = []
-        for fixture in fixtures:
-            if not fixture.built:
-                if fixture.lazy_init == setup_lazy_init:
-                    try:
-                        fixture.setup()
-                    except Exception as e:
-                        failures.append((fixture.name,
-                                         traceback.format_exc()))
+        # A single profile for all of the fixtures, so one fixture's doesn't
+        # replace another's.
+        with profiler.profile('setup', outdir):
+            for fixture in fixtures:
+                if not fixture.built:
+                    if fixture.lazy_init == setup_lazy_init:
+                        try:
+                            with timeline.span(fixture.name,
+                                               'fixture-setup'):
+                                fixture.setup()
+                        except Exception as e:
+                            failures.append((fixture.name,
+                                             traceback.format_exc()))
         return failures
 
+    def _teardown(self, fixtures):
+        for fixture in fixtures:
+            with timeline.span(fixture.name, 'fixture-teardown'):
+                fixture.teardown()
+
     class _CallbackWrapper(object):
         '''
         Class returns a function for accessed attributes which will access the
@@ -423,7 +472,11 @@ class Runner(object):
         def __getattr__(self, attr):
             def do_with_loggers(**kwargs):
                 for logger in self.__dict__['runner'].loggers:
-                    getattr(logger, attr)(**kwargs)
+                    with timeline.span('%s.%s' % (logger.__class__.__name__,
+                                                  attr),
+                                       'result-logger'),\
+                            profiler.profile('log'):
+                        getattr(logger, attr)(**kwargs)
             return do_with_loggers
 
     #class _RunnerPool(MulticoreWorkerPool):
@@ -441,6 +494,22 @@ class Runner(object):
             return self._run_serial(test_items)
 
         def _run_parallel(self, test_items):
+            # Workers report the items they begin and end by uid, keep track
+            # of the items so we can pass them on to our loggers.
+            test_items = list(test_items)
+            items = {}
+            for test_item in test_items:
+                items[test_item.uid] = test_item
+                if isinstance(test_item, TestSuite):
+                    for testcase in test_item:
+                        items[testcase.uid] = testcase
+
+            def forward_status(status):
+                (event, uid, worker) = status
+                if uid in items:
+                    getattr(self.runner.callbacks, event)(item=items[uid],
+                                                          worker=worker)
+
             # Pass the TestItem UID to the parallelized run function. (Test Items
             # are not serializable.)
             test_items = (test_item.uid for test_item in test_items)
@@ -448,17 +517,78 @@ class Runner(object):
             # We need to do post processing on items generated here in order
             # to report them with our own reporters.
             def merge_result(result_logger):
+                if isinstance(result_logger, AbandonedWork):
+                    return self._abandon(items[result_logger.arg],
+                                         result_logger.reason)
+                timeline.extend(result_logger.timeline_events)
                 for logger in self.runner.loggers:
                     if hasattr(logger, 'insert_results'):
-                        logger.insert_results(result_logger)
+                        with timeline.span('%s.insert_results'
+                                           % logger.__class__.__name__,
+                                           'result-logger'),\
+                                profiler.profile('log'):
+                            logger.insert_results(result_logger)
                 return result_logger.results[0]
 
-            for result in self.imap_unordered(_run_parallel, test_items):
+            # Only clients able to run an item are given it.
+            requirements = lambda uid: Requirements.of(items[uid])
+            priority = lambda uid: _priority(items[uid])
+
+            for result in self.imap_unordered(_run_parallel, test_items,
+                                              forward_status, requirements,
+                                              priority):
                 yield merge_result(result)
 
         def _run_serial(self, test_items):
             return self.imap_unordered(self.runner._run_item, test_items)
 
+        def _abandon(self, test_item, reason):
+            '''
+            Report an ERROR for the given item which was given up on since no
+            client completed it.
+            '''
+            callbacks = self.runner.callbacks
+            if isinstance(test_item, TestSuite):
+                for testcase in test_item:
+                    callbacks.set_outcome(item=testcase,
+                                          outcome=Outcome.ERROR,
+                                          reason=reason)
+                callbacks.set_outcome(item=test_item, outcome=Outcome.ERROR)
+            else:
+                callbacks.set_outcome(item=test_item, outcome=Outcome.ERROR,
+                                      reason=reason)
+            return Outcome.ERROR
+
+def _priority(test_item):
+    '''
+    Return the priority of the given suite or test case in a parallel run,
+    the sum of the priorities given by --priority for its name, uid and tags
+    (including those of its test cases).
+    '''
+    names = set([test_item.name, test_item.uid])
+    names.update(test_item.tags)
+    if isinstance(test_item, TestSuite):
+        for testcase in test_item:
+            names.update(testcase.tags)
+    return sum(level for (name, level) in config.priority if name in names)
+
+class StatusReporter(ResultLogger):
+    '''
+    Logger used by the workers of a parallel run to report the items they
+    begin and end to the server, where they are passed on to its loggers
+    along with the id of the worker. (Outcomes are reported with the
+    results.)
+    '''
+    def __init__(self, queue, worker):
+        self.queue = queue
+        self.worker = worker
+
+    def begin(self, item, **kwargs):
+        self.queue.put(('begin', item.uid, self.worker))
+
+    def end(self, item, **kwargs):
+        self.queue.put(('end', item.uid, self.worker))
+
 def _run_parallel(uid):
     '''
     Module level function used by the workers in the RunnerPool to run test
@@ -480,6 +610,15 @@ def _run_parallel(uid):
     (file_handle, file_name) = tempfile.mkstemp()
     with open(file_name, 'w') as result_file:
         logger = InternalLogger(result_file)
-        runner = Runner(threads=1, loggers=(logger,))
+        loggers = [logger]
+        if parallel.status_queue is not None:
+            loggers.append(StatusReporter(parallel.status_queue,
+                                          parallel.worker_id))
+        runner = Runner(threads=1, loggers=loggers)
         runner._run_item(test_item)
+
+        # Pass our part of the timeline back to the server along with the
+        # results.
+        logger.timeline_events = timeline.drain()
+        logger.worker = parallel.worker_id
         return logger
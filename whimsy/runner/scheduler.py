@@ -0,0 +1,745 @@
+'''
+Implements the :class:`WorkLedger` which hands out the work items of
+a distributed run to clients under leases.
+
+A client which takes an item holds a lease on it until it completes the item.
+While it runs the item the client sends heartbeats which renew its leases. If
+a client crashes or loses its connection to the server its heartbeats stop,
+its leases expire and the items it held are put back to be taken by another
+client. Every time an item is leased its attempt count goes up; an item whose
+lease has expired :attr:`WorkLedger.max_attempts` times is given up on and
+reported with an :class:`AbandonedWork` result so the run can still finish.
+
+Since an item may be run again while the client which lost it is still
+running it, the first completion of an item wins and later completions are
+dropped.
+
+Items may be put with :class:`whimsy.runner.capability.Requirements` which
+only the clients which registered satisfying
+:class:`whimsy.runner.capability.Capabilities` are given. A client is given
+the first pending item it is warm for before others, and an item another
+client is warm for is held back from cold clients for
+:attr:`WorkLedger.warm_wait` seconds. An item no registered client satisfies
+for :attr:`WorkLedger.route_timeout` seconds is reported with an
+:class:`UnroutableWork` result.
+
+Items are put in a named queue, each run submitted to
+a :class:`whimsy.runner.parallel.WorkDaemon` gets its own. The queues share
+the clients fairly: an item is taken from the queue with the fewest items
+leased out, queues with the same number taking turns.
+
+Within a queue items are taken in order of priority. Each level of priority
+is worth :attr:`WorkLedger.aging` seconds of waiting, an item put with
+priority 1 is taken before items of priority 0 put up to that many seconds
+before it. Since items age as they wait, those with a low priority are still
+taken eventually.
+
+Clients may hold leases on items they have not started yet (see
+:attr:`whimsy.runner.wire.WireQueueClient.prefetch`). Those can be moved to
+an idle client with :meth:`WorkLedger.transfer`.
+
+Expired leases are checked for whenever the ledger is used, so it needs no
+thread of its own. :meth:`WorkLedger.metrics` gives a snapshot of the ledger
+for :mod:`whimsy.runner.metrics`.
+'''
+import bisect
+import collections
+import Queue
+import threading
+import time
+
+from metrics import Histogram
+
+class AbandonedWork(object):
+    '''
+    Result given for an item which was leased :attr:`attempts` times without
+    being completed.
+    '''
+    def __init__(self, task, attempts):
+        self.task = task
+        self.attempts = attempts
+
+    @property
+    def arg(self):
+        '''The argument the item's function was to be called with.'''
+        return self.task[1]
+
+    @property
+    def reason(self):
+        '''Why the item was given up on.'''
+        return ('Gave up on the item after %d attempts to run it were lost.'
+                % self.attempts)
+
+class UnroutableWork(AbandonedWork):
+    '''
+    Result given for an item whose requirements no client satisfied.
+    '''
+    def __init__(self, task, requirements):
+        super(UnroutableWork, self).__init__(task, 0)
+        self.requirements = requirements
+
+    @property
+    def reason(self):
+        return ('No client was able to run the item, it requires %s.'
+                % self.requirements)
+
+class _Item(object):
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+
+    def __init__(self, item_id, task, requirements, queue, rank):
+        self.item_id = item_id
+        self.task = task
+        self.requirements = requirements
+        self.queue = queue
+        # Items of a queue with a lower rank are taken first.
+        self.rank = rank
+        self.state = self.PENDING
+        self.attempts = 0
+        self.client = None
+        self.deadline = None
+        # When the item was last put in pending.
+        self.queued = time.time()
+        self.created = self.queued
+        # When the client holding the item was given it.
+        self.leased = None
+
+def _order(item):
+    return (item.rank, item.item_id)
+
+class _Ordered(object):
+    '''Items in the order they are to be taken.'''
+    def __init__(self):
+        self._keys = []
+        self._items = []
+
+    def add(self, item):
+        key = _order(item)
+        index = bisect.bisect(self._keys, key)
+        self._keys.insert(index, key)
+        self._items.insert(index, item)
+
+    def discard(self, item):
+        key = _order(item)
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            del self._keys[index]
+            del self._items[index]
+
+    def __contains__(self, item):
+        key = _order(item)
+        index = bisect.bisect_left(self._keys, key)
+        return index < len(self._keys) and self._keys[index] == key
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+class _Bucket(object):
+    '''The pending items of a queue which have the same requirements.'''
+    def __init__(self):
+        self.items = _Ordered()
+        # The items which were put in pending over warm_wait seconds ago,
+        # those aren't held back from cold clients any more.
+        self.ripe = _Ordered()
+        # Tuples of (queued, item) in the order items were put in pending,
+        # entries of items which have since left are skipped.
+        self._fresh = collections.deque()
+
+    def add(self, item):
+        self.items.add(item)
+        self._fresh.append((item.queued, item))
+
+    def remove(self, item):
+        self.items.discard(item)
+        self.ripe.discard(item)
+
+    def ripen(self, before):
+        '''Move the items put in pending before the given time to ripe.'''
+        while self._fresh and self._fresh[0][0] <= before:
+            (queued, item) = self._fresh.popleft()
+            if item.state == _Item.PENDING and item.queued == queued \
+                    and item in self.items and item not in self.ripe:
+                self.ripe.add(item)
+
+    def __len__(self):
+        return len(self.items)
+
+class _Pending(object):
+    '''
+    The pending items of a queue, kept in a bucket for each set of
+    requirements so a client only looks at the first items of the buckets.
+    '''
+    def __init__(self):
+        # Map the requirements of items to their bucket.
+        self.buckets = {}
+        self._len = 0
+
+    def add(self, item):
+        bucket = self.buckets.get(item.requirements)
+        if bucket is None:
+            bucket = self.buckets[item.requirements] = _Bucket()
+        bucket.add(item)
+        self._len += 1
+
+    def remove(self, item):
+        bucket = self.buckets[item.requirements]
+        bucket.remove(item)
+        if not bucket:
+            del self.buckets[item.requirements]
+        self._len -= 1
+
+    def first(self):
+        '''Return the item to be taken first.'''
+        return min((bucket.items[0] for bucket in self.buckets.itervalues()),
+                   key=_order)
+
+    def __len__(self):
+        return self._len
+
+class WorkLedger(object):
+    '''
+    Keeps track of which client holds which work item.
+
+    :param lease_timeout: Seconds a lease lasts without a heartbeat from the
+        client holding it.
+    :param max_attempts: Number of times an item is leased before it is
+        abandoned.
+    :param aging: Seconds of waiting each level of priority is worth.
+    '''
+    warm_wait = 5.0
+    '''
+    Seconds an item is held back from cold clients while a client which is
+    warm for it may take it.
+    '''
+    route_timeout = 60.0
+    '''
+    Seconds an item waits for a client satisfying its requirements before it
+    is given up on.
+    '''
+    def __init__(self, lease_timeout=30.0, max_attempts=3, aging=60.0):
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.aging = aging
+        # Map client to the capabilities it registered.
+        self._capabilities = {}
+        # Map each binary to the clients which have it warm.
+        self._warm = collections.defaultdict(set)
+        self._routed = time.time()
+        # No lease runs out before this time, so the leases are only looked
+        # through once one might have.
+        self._next_expiry = float('inf')
+
+        self._items = {}
+        # Map each queue to its pending items.
+        self._queues = collections.OrderedDict()
+        # Map each queue to a deque of its results.
+        self._results = collections.defaultdict(collections.deque)
+        self._discarded = set()
+        # Map client to the ids of the items it holds leases on.
+        self._leases = collections.defaultdict(set)
+        self._next_id = 0
+        self._completed = 0
+        self._duplicates = 0
+        self._requeued = 0
+        self._transferred = 0
+        self._dispatched = 0
+        self._abandoned = 0
+        # Map client to the number of items it completed.
+        self._client_completed = collections.Counter()
+        # Seconds items waited before their first lease.
+        self.wait_times = Histogram()
+        # Seconds from the lease of items to their completion.
+        self.run_times = Histogram()
+
+        self._lock = threading.Lock()
+        self._work_available = threading.Condition(self._lock)
+        self._result_available = threading.Condition(self._lock)
+
+    def register(self, client, capabilities):
+        '''
+        Record the capabilities of a client. Until it registers a client is
+        given any item.
+        '''
+        with self._lock:
+            self._forget(client)
+            self._capabilities[client] = capabilities
+            self._warm_up(client, capabilities.warm)
+            self._work_available.notify_all()
+
+    def _warm_up(self, client, targets):
+        for target in targets:
+            self._warm[target].add(client)
+
+    def _forget(self, client):
+        '''Drop the registered capabilities of a client.'''
+        capabilities = self._capabilities.pop(client, None)
+        if capabilities is None:
+            return
+        for target in capabilities.warm:
+            clients = self._warm.get(target)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del self._warm[target]
+
+    def put(self, task, requirements=None, queue=None, priority=0):
+        '''
+        Add a work item.
+
+        :param task: Tuple of :code:`(function, arg)` the client will call.
+        :param requirements: The
+            :class:`~whimsy.runner.capability.Requirements` of a client to run
+            the item, None if any client can.
+        :param queue: The name of the queue to add the item to.
+        :param priority: Items with a higher priority are taken first.
+        :returns: The id of the item.
+        '''
+        with self._lock:
+            if queue in self._discarded:
+                raise ValueError('Queue %s was discarded.' % (queue,))
+            item = _Item(self._next_id, task, requirements, queue,
+                         time.time() - priority * self.aging)
+            self._next_id += 1
+            self._items[item.item_id] = item
+            self._queues.setdefault(queue, _Pending()).add(item)
+            self._work_available.notify()
+            return item.item_id
+
+    def discard(self, queue):
+        '''
+        Drop the pending items and results of the given queue, results of its
+        items still leased out are dropped once completed.
+        '''
+        with self._lock:
+            self._discarded.add(queue)
+            self._queues.pop(queue, None)
+            self._results.pop(queue, None)
+            for item_id in [item_id for (item_id, item)
+                            in self._items.iteritems()
+                            if item.queue == queue
+                            and item.state != _Item.LEASED]:
+                del self._items[item_id]
+
+    def acquire(self, client, timeout=None):
+        '''
+        Lease the next pending item to the given client, waiting up to
+        timeout seconds for one to become available.
+
+        :returns: Tuple of :code:`(item_id, attempt, task)` or None if there
+            was no work in time.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                self._expire(now)
+                item = self._route(client, now)
+                if item is not None:
+                    self._queues[item.queue].remove(item)
+                    return self._lease(item, client, now)
+
+                if deadline is None:
+                    wait = self.lease_timeout
+                else:
+                    wait = min(deadline - now, self.lease_timeout)
+                    if wait <= 0:
+                        return None
+                # Wake up in time to expire the leases of lost clients and to
+                # take items no warm client took.
+                self._work_available.wait(min(wait, self.warm_wait))
+
+    def _route(self, client, now):
+        '''Return the pending item to lease to the given client, if any.'''
+        queues = [queue for (queue, pending) in self._queues.iteritems()
+                  if pending]
+        if len(queues) > 1:
+            leased = collections.Counter(self._items[item_id].queue
+                                         for held in self._leases.itervalues()
+                                         for item_id in held)
+            # Sorting is stable, queues with the same share keep their turns.
+            queues.sort(key=lambda queue: leased[queue])
+        for queue in queues:
+            item = self._route_from(self._queues[queue], client, now)
+            if item is not None:
+                # Go behind the other queues with the same share.
+                self._queues[queue] = self._queues.pop(queue)
+                return item
+        return None
+
+    def _route_from(self, pending, client, now):
+        capabilities = self._capabilities.get(client)
+        if capabilities is None:
+            return pending.first()
+
+        warm = None
+        cold = None
+        for (requirements, bucket) in pending.buckets.iteritems():
+            if not capabilities.satisfies(requirements):
+                continue
+            bucket.ripen(now - self.warm_wait)
+            if capabilities.is_warm(requirements):
+                candidate = bucket.items[0]
+                if warm is None or _order(candidate) < _order(warm):
+                    warm = candidate
+            elif warm is None:
+                if not self._warm_elsewhere(requirements, client):
+                    candidate = bucket.items[0]
+                elif bucket.ripe:
+                    candidate = bucket.ripe[0]
+                else:
+                    continue
+                if cold is None or _order(candidate) < _order(cold):
+                    cold = candidate
+        return cold if warm is None else warm
+
+    def _warm_elsewhere(self, requirements, client):
+        '''
+        Return True if a client other than the given one is warm for items
+        with the requirements, those are held back from cold clients for
+        :attr:`warm_wait` seconds.
+        '''
+        warm = [self._warm.get(target, ()) for target in requirements.targets]
+        if not warm:
+            return False
+        warm.sort(key=len)
+        return any(other != client
+                   and all(other in clients for clients in warm[1:])
+                   and self._capabilities[other].satisfies(requirements)
+                   for other in warm[0])
+
+    def _lease(self, item, client, now):
+        if not item.attempts:
+            self.wait_times.observe(now - item.created)
+        self._dispatched += 1
+        item.state = _Item.LEASED
+        item.attempts += 1
+        item.client = client
+        item.leased = now
+        item.deadline = now + self.lease_timeout
+        self._next_expiry = min(self._next_expiry, item.deadline)
+        self._leases[client].add(item.item_id)
+        return (item.item_id, item.attempts, item.task)
+
+    def heartbeat(self, client):
+        '''
+        Renew the leases of the given client.
+
+        :returns: The number of leases the client still holds.
+        '''
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            held = self._leases.get(client, ())
+            for item_id in held:
+                self._items[item_id].deadline = now + self.lease_timeout
+            return len(held)
+
+    def held(self, client):
+        '''Return the number of leases the given client holds.'''
+        with self._lock:
+            return len(self._leases.get(client, ()))
+
+    def holdings(self):
+        '''Return a dictionary mapping each client to its number of leases.'''
+        with self._lock:
+            return dict((client, len(held))
+                        for (client, held) in self._leases.iteritems())
+
+    def transfer(self, client, item_ids, to_client):
+        '''
+        Move the leases of client on the given items (which it has not
+        started) to another client. The move doesn't count as an attempt.
+        Items the other client can't run are put back in pending.
+
+        :returns: List of the :code:`(item_id, attempt, task)` leases moved.
+        '''
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            held = self._leases.get(client, set())
+            moved = []
+            for item_id in item_ids:
+                # The lease may have expired in the meantime.
+                if item_id not in held:
+                    continue
+                held.discard(item_id)
+                item = self._items[item_id]
+                capabilities = self._capabilities.get(to_client)
+                if capabilities is not None \
+                        and not capabilities.satisfies(item.requirements):
+                    # Put it back for a client which can run it, the client
+                    # giving it up never started it.
+                    item.attempts -= 1
+                    self._requeue(item, now)
+                    continue
+                item.client = to_client
+                item.leased = now
+                item.deadline = now + self.lease_timeout
+                self._next_expiry = min(self._next_expiry, item.deadline)
+                self._leases[to_client].add(item_id)
+                self._transferred += 1
+                moved.append((item_id, item.attempts, item.task))
+            if not held:
+                self._leases.pop(client, None)
+            return moved
+
+    def retire(self, client):
+        '''
+        Forget a client which is leaving. The items it holds, which it has not
+        started, are put back in pending without counting as an attempt.
+        '''
+        with self._lock:
+            now = time.time()
+            self._forget(client)
+            for item_id in self._leases.pop(client, ()):
+                item = self._items[item_id]
+                item.attempts -= 1
+                self._requeue(item, now)
+
+    def complete(self, client, item_id, result):
+        '''
+        Record the result of an item.
+
+        :returns: False if the item had already been completed and the result
+            was dropped.
+        '''
+        with self._lock:
+            item = self._items.get(item_id)
+            if item is None:
+                return False
+            self._leases[client].discard(item_id)
+            if not self._leases[client]:
+                del self._leases[client]
+            if item.state == _Item.DONE:
+                self._duplicates += 1
+                return False
+            if item.state == _Item.LEASED and item.client != client:
+                # A client whose lease expired got the result in before the
+                # one we gave the item to next. Keep the first result.
+                self._leases[item.client].discard(item_id)
+                if not self._leases[item.client]:
+                    del self._leases[item.client]
+            elif item.state == _Item.PENDING:
+                self._queues[item.queue].remove(item)
+            if item.leased is not None:
+                self.run_times.observe(time.time() - item.leased)
+            self._client_completed[client] += 1
+            if item.requirements is not None and client in self._capabilities:
+                # The client has the binaries the item used now.
+                self._capabilities[client].warm.update(
+                        item.requirements.targets)
+                self._warm_up(client, item.requirements.targets)
+            self._finish(item, result)
+            return True
+
+    def _finish(self, item, result):
+        item.state = _Item.DONE
+        item.client = None
+        item.task = None
+        self._completed += 1
+        if isinstance(result, AbandonedWork):
+            self._abandoned += 1
+        if item.queue in self._discarded:
+            del self._items[item.item_id]
+        else:
+            self._results[item.queue].append((item.item_id, result))
+            # Runs waiting on other queues share the condition.
+            self._result_available.notify_all()
+
+    def get_result(self, timeout=None, queue=None):
+        '''
+        Wait up to timeout seconds for the result of an item of the given
+        queue.
+
+        :returns: Tuple of :code:`(item_id, result)` or None if no result was
+            ready in time.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                self._expire(now)
+                if self._results.get(queue):
+                    return self._results[queue].popleft()
+
+                if deadline is None:
+                    wait = self.lease_timeout
+                else:
+                    wait = min(deadline - now, self.lease_timeout)
+                    if wait <= 0:
+                        return None
+                self._result_available.wait(wait)
+
+    def _expire(self, now):
+        '''Requeue or abandon the items of leases past their deadline.'''
+        if now >= self._next_expiry:
+            self._expire_leases(now)
+
+        if now - self._routed >= 1.0:
+            self._routed = now
+            self._expire_unroutable(now)
+
+    def _expire_leases(self, now):
+        self._next_expiry = float('inf')
+        for (client, held) in self._leases.items():
+            for item_id in list(held):
+                item = self._items[item_id]
+                if item.deadline > now:
+                    self._next_expiry = min(self._next_expiry, item.deadline)
+                    continue
+                held.discard(item_id)
+                if item.attempts >= self.max_attempts:
+                    self._finish(item, AbandonedWork(item.task, item.attempts))
+                else:
+                    self._requeued += 1
+                    self._requeue(item, now)
+            if not held:
+                del self._leases[client]
+
+    def _requeue(self, item, now):
+        '''
+        Put an item back in its queue. It keeps its rank, so it goes ahead of
+        the items put after it.
+        '''
+        item.state = _Item.PENDING
+        item.client = None
+        item.queued = now
+        if item.queue in self._discarded:
+            item.task = None
+            self._items.pop(item.item_id, None)
+            return
+        self._queues.setdefault(item.queue, _Pending()).add(item)
+        self._work_available.notify()
+
+    def _expire_unroutable(self, now):
+        '''
+        Give up on pending items which no registered client has been able to
+        run for :attr:`route_timeout` seconds.
+        '''
+        if not self._capabilities:
+            return
+        for pending in self._queues.itervalues():
+            for (requirements, bucket) in pending.buckets.items():
+                if requirements is None \
+                        or any(capabilities.satisfies(requirements)
+                               for capabilities
+                               in self._capabilities.itervalues()):
+                    continue
+                for item in list(bucket.items):
+                    if now - item.queued >= self.route_timeout:
+                        pending.remove(item)
+                        self._finish(item, UnroutableWork(item.task,
+                                                          requirements))
+
+    def stats(self):
+        '''
+        :returns: Dictionary of counts of the items pending, leased, completed,
+            requeued after their lease expired, transferred between clients and
+            duplicate completions dropped.
+        '''
+        with self._lock:
+            self._expire(time.time())
+            return dict(pending=sum(len(pending)
+                                    for pending in self._queues.itervalues()),
+                        leased=sum(len(held)
+                                   for held in self._leases.itervalues()),
+                        completed=self._completed,
+                        requeued=self._requeued,
+                        transferred=self._transferred,
+                        duplicates=self._duplicates)
+
+    def metrics(self):
+        '''
+        Return a dictionary holding a snapshot of the ledger:
+
+        * queues - Map each queue to its number of pending items.
+        * leases - Map each client to a list of :code:`(arg, seconds)` of the
+          items it holds, the argument of each item's task and the seconds
+          since the client was given it.
+        * clients - The number of clients which registered.
+        * client_completed - Map each client to the number of items it
+          completed.
+        * dispatched, completed, requeued, transferred, duplicates and
+          abandoned - Counts of items since the ledger was created.
+        * wait_times and run_times - Copies of the :attr:`wait_times` and
+          :attr:`run_times` histograms.
+        '''
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            leases = {}
+            for (client, held) in self._leases.iteritems():
+                items = [self._items[item_id] for item_id in held]
+                leases[client] = [(str(item.task[1]), now - item.leased)
+                                  for item in items]
+            return dict(queues=dict((queue, len(pending)) for (queue, pending)
+                                    in self._queues.iteritems()),
+                        leases=leases,
+                        clients=len(self._capabilities),
+                        client_completed=dict(self._client_completed),
+                        dispatched=self._dispatched,
+                        completed=self._completed,
+                        requeued=self._requeued,
+                        transferred=self._transferred,
+                        duplicates=self._duplicates,
+                        abandoned=self._abandoned,
+                        wait_times=self.wait_times.copy(),
+                        run_times=self.run_times.copy())
+
+class StatusRouter(object):
+    '''
+    Stands in for the status queue of a server whose work comes from several
+    queues, keeping the status events of the items of each queue apart.
+    Events are put tagged with their queue as :code:`(queue, event)`.
+    '''
+    def __init__(self):
+        self._events = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def put(self, tagged_event):
+        (queue, event) = tagged_event
+        with self._lock:
+            self._events[queue].append(event)
+
+    def take(self, queue):
+        '''Return and forget the list of events put for the given queue.'''
+        with self._lock:
+            return list(self._events.pop(queue, ()))
+
+class Submission(object):
+    '''
+    The items of a single queue of a :class:`WorkLedger` and their status
+    events from a :class:`StatusRouter`, serving as both the ledger and the
+    status queue of a :class:`whimsy.runner.parallel.WorkServer`.
+    '''
+    def __init__(self, ledger, router, queue):
+        self.ledger = ledger
+        self.router = router
+        self.queue = queue
+        self._events = collections.deque()
+
+    def put(self, task, requirements=None, priority=0):
+        return self.ledger.put(task, requirements, self.queue, priority)
+
+    def get_result(self, timeout=None):
+        return self.ledger.get_result(timeout, self.queue)
+
+    def get_nowait(self):
+        '''Return the next status event, raise Queue.Empty if there is none.'''
+        if not self._events:
+            self._events.extend(self.router.take(self.queue))
+        if not self._events:
+            raise Queue.Empty
+        return self._events.popleft()
+
+    def discard(self):
+        '''Drop what is left of the submission.'''
+        self.ledger.discard(self.queue)
+        self.router.take(self.queue)
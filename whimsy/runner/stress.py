@@ -0,0 +1,151 @@
+'''
+Loopback stress test of the work servers with many clients (see
+:data:`whimsy.runner.parallel.transports`).
+
+Starts a server on localhost and connects hundreds of simulated clients to
+it, spread over a few processes each running a thread per client. Every task
+sleeps for a moment so the clients hold leases at the same time. Once every
+client has connected the server is given the tasks and the test checks each
+result came back exactly once and no task was given up on.
+
+Run it with::
+
+    python -m whimsy.runner.stress --clients 500 --tasks 20000
+'''
+import argparse
+import multiprocessing
+import sys
+import threading
+import time
+
+from capability import Capabilities
+from parallel import transports, EVENT, WIRE
+from scheduler import AbandonedWork
+
+passkey = 'whimsy-stress'
+
+def _task(arg):
+    (number, task_time) = arg
+    time.sleep(task_time)
+    return number
+
+def _simulate(transport, address, name):
+    (_, client_class) = transports[transport]
+    kwargs = {}
+    if transport in (WIRE, EVENT):
+        kwargs['prefetch'] = 1
+    client = client_class(address[0], address[1], passkey, **kwargs)
+    try:
+        client.connect()
+        ledger = client.get_ledger()
+        ledger.register(name, Capabilities())
+        while True:
+            lease = ledger.acquire(name, 1.0)
+            if lease is None:
+                continue
+            (item_id, _, (function, arg)) = lease
+            ledger.complete(name, item_id, function(arg))
+    except (IOError, EOFError):
+        return
+
+def _clients(transport, address, first, count):
+    '''Simulate count clients on threads of this process.'''
+    threads = [threading.Thread(target=_simulate,
+                                args=(transport, address,
+                                      'stress-%d' % number))
+               for number in range(first, first + count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def run(transport, clients, tasks, task_time=0.01, processes=4, port=0,
+        connect_timeout=60.0):
+    '''
+    Run the stress test of a transport.
+
+    :returns: Tuple of :code:`(connect_seconds, tasks_per_second)`.
+    :raises AssertionError: If a task was lost, given up on or completed
+        more than once.
+    '''
+    (server_class, _) = transports[transport]
+    address = ('localhost', port)
+    server = server_class(address[0], address[1], passkey,
+                          lease_timeout=30.0, max_attempts=1, aging=60.0)
+    server.start()
+
+    start = time.time()
+    workers = []
+    per_process = -(-clients // processes)
+    for first in range(0, clients, per_process):
+        worker = multiprocessing.Process(
+                target=_clients,
+                args=(transport, address, first,
+                      min(per_process, clients - first)))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    ledger = server.get_ledger()
+    try:
+        while ledger.metrics()['clients'] < clients:
+            if time.time() - start > connect_timeout:
+                raise AssertionError('Only %d of %d clients connected.'
+                                     % (ledger.metrics()['clients'], clients))
+            time.sleep(0.1)
+        connected = time.time() - start
+
+        start = time.time()
+        for number in range(tasks):
+            ledger.put((_task, (number, task_time)))
+        seen = set()
+        for _ in range(tasks):
+            (_, result) = ledger.get_result()
+            if isinstance(result, AbandonedWork):
+                raise AssertionError('Task %s was given up on.'
+                                     % (result.task[1],))
+            if result in seen:
+                raise AssertionError('Task %d completed twice.' % result)
+            seen.add(result)
+        elapsed = time.time() - start
+        stats = ledger.stats()
+        if stats['duplicates']:
+            raise AssertionError('%d tasks completed twice.'
+                                 % stats['duplicates'])
+    finally:
+        server.shutdown()
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+    return (connected, tasks / elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--tasks', type=int, default=20000)
+    parser.add_argument('--task-time', type=float, default=0.01,
+                        help='Seconds each task sleeps.')
+    parser.add_argument('--processes', type=int, default=4,
+                        help='Processes to spread the clients over.')
+    parser.add_argument('--port', type=int, default=11290)
+    parser.add_argument('--transport', action='append',
+                        choices=sorted(transports))
+    args = parser.parse_args()
+
+    failed = False
+    for (offset, transport) in enumerate(args.transport or (EVENT,)):
+        try:
+            (connected, rate) = run(transport, args.clients, args.tasks,
+                                    args.task_time, args.processes,
+                                    args.port + offset)
+        except AssertionError as e:
+            print('%-8s FAILED: %s' % (transport, e))
+            failed = True
+        else:
+            print('%-8s %d clients connected in %.1fs, %8.0f tasks/s'
+                  % (transport, args.clients, connected, rate))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
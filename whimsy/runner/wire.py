@@ -0,0 +1,766 @@
+'''
+Implements the wire transport of the distributed work server, a framed socket
+protocol used in place of the :class:`multiprocessing.managers.SyncManager`
+proxies of the manager transport.
+
+With the manager transport every call a client makes is a synchronous round
+trip carrying a pickled request. The wire transport instead keeps a single
+connection per client over which:
+
+* Clients ask for work ahead of time, holding up to
+  :attr:`WireQueueClient.prefetch` items besides the one they run, so they
+  never wait a round trip between items.
+* Results are sent along with the next request for work rather than on their
+  own and are never acknowledged.
+* Heartbeats and status events are sent without waiting for a reply.
+
+Near the end of a run a client may sit idle while others hold items they
+have prefetched but not started. When a client has nothing left to run and
+there are no pending items, the server sends a REVOKE to the client holding
+the most prefetched items, which gives them back with a RELEASE and the
+server grants them to the idle client.
+
+The server side hands out the items through the same
+:class:`whimsy.runner.scheduler.WorkLedger` as the manager transport, but it
+lives in the server's process rather than behind a proxy. The
+:class:`whimsy.runner.eventserver.EventQueueServer` serves the same protocol
+from a single thread.
+
+Frames are a header of the payload's length and the kind of message followed
+by the pickled payload. Before any frames are exchanged both sides prove they
+know the passkey with an HMAC challenge.
+
+Messages sent by clients:
+
+* CONFIG - Ask for the server's config, answered with a CONFIG message
+  holding the config dictionaries.
+* REQUEST - :code:`(client, count, results)` Ask for count more items and
+  hand in the results of completed items as :code:`(item_id, result)`
+  records.
+* HEARTBEAT - :code:`client` Renew the leases of the client.
+* STATUS - A status event to pass on to the server's status queue.
+* RELEASE - List of the ids of items given back in answer to a REVOKE.
+* REGISTER - :code:`(client, capabilities)` Record the
+  :class:`whimsy.runner.capability.Capabilities` of the client.
+* ARTIFACT - :code:`(method, args)` Call lookup or read of the server's
+  :class:`whimsy.artifacts.ArtifactStore`, answered with an ARTIFACT message
+  holding :code:`(True, result)` or :code:`(False, error)`.
+* RETIRE - :code:`(client, results)` The client is leaving once it has sent
+  the given results, the items it holds are given to other clients.
+
+Messages sent by runs submitting their items to
+a :class:`whimsy.runner.parallel.WorkDaemon`:
+
+* SUBMIT - :code:`(queue, task, requirements, priority)` Add an item to the
+  queue of the run.
+* COLLECT - :code:`(queue, timeout)` Wait up to timeout seconds for a result
+  of the queue, answered with a COLLECT message holding
+  :code:`(result, events)` where result is None if there was none in time and
+  events are the status events of the queue.
+* DISCARD - :code:`queue` Drop what is left of the queue. Queues submitted
+  over a connection are also dropped when it closes.
+
+Messages sent by the server:
+
+* GRANT - List of :code:`(item_id, attempt, task)` leases.
+* REVOKE - :code:`count` Ask for up to count items which haven't been started
+  to be given back.
+'''
+import collections
+import cPickle as pickle
+import errno
+import hashlib
+import hmac
+import os
+import Queue
+import select
+import socket
+import struct
+import threading
+import time
+
+from .. import config_module
+from ..artifacts import ArtifactStore
+from ..logger import log
+from scheduler import StatusRouter, WorkLedger
+
+CONFIG = 1
+REQUEST = 2
+GRANT = 3
+HEARTBEAT = 4
+STATUS = 5
+REVOKE = 6
+RELEASE = 7
+REGISTER = 8
+ARTIFACT = 9
+SUBMIT = 10
+COLLECT = 11
+DISCARD = 12
+RETIRE = 13
+
+magic = 'WHIMSYW1'
+_header = struct.Struct('!IB')
+_challenge_size = 32
+_digest = hashlib.sha256
+
+class AuthenticationError(Exception):
+    '''Signals the other end of a connection did not know the passkey.'''
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        try:
+            chunk = sock.recv(size)
+        except socket.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            raise EOFError('Connection closed.')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def pack_frame(kind, payload):
+    '''Return a frame of the given kind carrying the pickled payload.'''
+    data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+    return _header.pack(len(data), kind) + data
+
+def send_frame(sock, kind, payload):
+    '''Send a frame of the given kind carrying the pickled payload.'''
+    sock.sendall(pack_frame(kind, payload))
+
+def recv_frame(sock):
+    '''
+    Receive the next frame.
+
+    :returns: Tuple of :code:`(kind, payload)`
+    :raises EOFError: If the connection was closed.
+    '''
+    (length, kind) = _header.unpack(_recv_exactly(sock, _header.size))
+    return (kind, pickle.loads(_recv_exactly(sock, length)))
+
+def parse_frames(buffer):
+    '''
+    Take the complete frames off the front of a bytearray of received data.
+
+    :returns: List of :code:`(kind, payload)` of the frames.
+    '''
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= _header.size:
+        (length, kind) = _header.unpack_from(buffer, offset)
+        end = offset + _header.size + length
+        if len(buffer) < end:
+            break
+        frames.append((kind, pickle.loads(
+                str(buffer[offset + _header.size:end]))))
+        offset = end
+    del buffer[:offset]
+    return frames
+
+def _sign(passkey, challenge):
+    return hmac.new(passkey, challenge, _digest).digest()
+
+def _verify(passkey, challenge, response):
+    if not hmac.compare_digest(_sign(passkey, challenge), response):
+        raise AuthenticationError('Passkey did not match.')
+
+response_size = _digest().digest_size + _challenge_size
+'''Bytes of a client's answer to the greeting of :func:`new_challenge`.'''
+
+def new_challenge():
+    '''
+    Return :code:`(greeting, challenge)`, the greeting to send a client which
+    has connected and the challenge it holds. (Server side.)
+    '''
+    challenge = os.urandom(_challenge_size)
+    return (magic + challenge, challenge)
+
+def check_response(passkey, challenge, response):
+    '''
+    Verify the client's answer to our challenge. (Server side.)
+
+    :returns: The reply proving to the client we know the passkey.
+    :raises AuthenticationError: If the client did not know the passkey.
+    '''
+    _verify(passkey, challenge, response[:-_challenge_size])
+    return _sign(passkey, response[-_challenge_size:])
+
+def deliver_challenge(sock, passkey):
+    '''Authenticate the client connected on sock. (Server side.)'''
+    (greeting, challenge) = new_challenge()
+    sock.sendall(greeting)
+    sock.sendall(check_response(passkey, challenge,
+                                _recv_exactly(sock, response_size)))
+
+def answer_challenge(sock, passkey):
+    '''Authenticate with the server connected on sock. (Client side.)'''
+    greeting = _recv_exactly(sock, len(magic) + _challenge_size)
+    if not greeting.startswith(magic):
+        raise AuthenticationError('Not a whimsy work server.')
+    challenge = os.urandom(_challenge_size)
+    sock.sendall(_sign(passkey, greeting[len(magic):]) + challenge)
+    _verify(passkey, challenge,
+            _recv_exactly(sock, _digest().digest_size))
+
+def check_artifact_request(payload):
+    '''
+    Raise IOError if an ARTIFACT message asks for anything but a lookup or
+    a read.
+    '''
+    (method, _) = payload
+    if method not in ('lookup', 'read'):
+        raise IOError('Unexpected artifact request %s.' % method)
+
+def answer_artifact_request(artifact_store, payload):
+    '''Return the reply to an ARTIFACT message.'''
+    (method, args) = payload
+    try:
+        return (True, getattr(artifact_store, method)(*args))
+    except (IOError, OSError) as e:
+        return (False, str(e))
+
+
+class WireQueueServer(object):
+    '''
+    Accepts client connections for a :class:`whimsy.runner.parallel.WorkServer`
+    serving each from its own thread.
+
+    :param lease_timeout: See :class:`whimsy.runner.scheduler.WorkLedger`,
+        defaults to the value in the config.
+    :param max_attempts: See :class:`whimsy.runner.scheduler.WorkLedger`,
+        defaults to the value in the config.
+    :param aging: See :class:`whimsy.runner.scheduler.WorkLedger`, defaults
+        to the value in the config.
+    '''
+    join_timeout = 1.0
+    '''Seconds to wait for each connection's thread on shutdown.'''
+
+    def __init__(self, hostname, port, passkey, lease_timeout=None,
+                 max_attempts=None, aging=None):
+        if lease_timeout is None:
+            lease_timeout = config_module.config.lease_timeout
+        if max_attempts is None:
+            max_attempts = config_module.config.max_attempts
+        if aging is None:
+            aging = config_module.config.priority_aging
+
+        self.address = (hostname, port)
+        self.passkey = passkey
+        self.ledger = WorkLedger(lease_timeout=lease_timeout,
+                                 max_attempts=max_attempts,
+                                 aging=aging)
+        self.status_queue = Queue.Queue()
+        self.artifact_store = ArtifactStore()
+        self._listener = None
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def get_ledger(self):
+        return self.ledger
+
+    def get_status_queue(self):
+        return self.status_queue
+
+    def get_artifact_store(self):
+        return self.artifact_store
+
+    def start(self):
+        '''Start accepting connections.'''
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.address)
+        self._listener.listen(128)
+
+        thread = threading.Thread(target=self._accept, args=(self._listener,))
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self):
+        '''Stop accepting connections and close those open.'''
+        listener = self._listener
+        self._listener = None
+        if listener is not None:
+            try:
+                # Wake the accepting thread.
+                listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            listener.close()
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.close()
+        # Let the threads finish before the interpreter starts tearing down.
+        for connection in connections:
+            connection.join(self.join_timeout)
+
+    def _accept(self, listener):
+        while True:
+            try:
+                (sock, _) = listener.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                return
+            connection = _ServerConnection(self, sock)
+            with self._lock:
+                self._connections.add(connection)
+            connection.start()
+
+    def _closed(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def _steal(self, thief):
+        '''
+        Revoke half the items the client holding the most items it hasn't
+        started has so they can be given to the idle client of thief.
+        '''
+        holdings = self.ledger.holdings()
+        with self._lock:
+            victims = [connection for connection in self._connections
+                       if connection is not thief and connection.thief is None
+                       and connection.client is not None]
+        # Each client is running one of the items it holds.
+        surplus = lambda connection: holdings.get(connection.client, 0) - 1
+        if victims:
+            victim = max(victims, key=surplus)
+            if surplus(victim) > 0:
+                victim.revoke((surplus(victim) + 1) // 2, thief)
+
+
+class _ServerConnection(threading.Thread):
+    '''Serves the requests of a single client.'''
+    poll_interval = 0.1
+    '''Seconds between checks for work while the client is waiting on it.'''
+
+    def __init__(self, server, sock):
+        super(_ServerConnection, self).__init__()
+        self.daemon = True
+        self.server = server
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.client = None
+        # Number of items the client has asked for which it hasn't been
+        # granted.
+        self.wanted = 0
+        # The connection of the idle client we have asked our client to give
+        # items back for.
+        self.thief = None
+        # Other connections send REVOKE and GRANT messages through us.
+        self._send_lock = threading.Lock()
+        # Guards wanted, which other connections take from when granting us
+        # the items they have taken back.
+        self._grant_lock = threading.Lock()
+        # The queues submitted over the connection.
+        self.queues = set()
+        # Set once our client has retired.
+        self.retired = False
+
+    def send(self, kind, payload):
+        with self._send_lock:
+            send_frame(self.sock, kind, payload)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def grant(self, leases):
+        '''Grant our client the given leases.'''
+        if not leases:
+            return
+        with self._grant_lock:
+            if self.retired:
+                # Our client has left, give them to someone else.
+                self.server.ledger.retire(self.client)
+                return
+            self.wanted = max(self.wanted - len(leases), 0)
+            self.send(GRANT, leases)
+
+    def revoke(self, count, thief):
+        '''
+        Ask the client to give back up to count of the items it holds but
+        has not started so they can be granted to the client of thief.
+        '''
+        self.thief = thief
+        try:
+            self.send(REVOKE, count)
+        except socket.error:
+            # Our own thread will notice the connection is gone.
+            self.thief = None
+
+    def run(self):
+        try:
+            deliver_challenge(self.sock, self.server.passkey)
+            self._serve()
+        except AuthenticationError:
+            log.warn('Rejected a work client which did not know the'
+                     ' passkey.')
+        except (EOFError, IOError):
+            pass
+        finally:
+            self.sock.close()
+            # The run which submitted them is gone.
+            for queue in self.queues:
+                self.server.ledger.discard(queue)
+                self.server.status_queue.take(queue)
+            self.server._closed(self)
+
+    def _serve(self):
+        ledger = self.server.ledger
+        while True:
+            timeout = None
+            if self.wanted:
+                with self._grant_lock:
+                    grants = []
+                    while len(grants) < self.wanted:
+                        lease = ledger.acquire(self.client, 0)
+                        if lease is None:
+                            break
+                        grants.append(lease)
+                    if grants:
+                        self.wanted -= len(grants)
+                        self.send(GRANT, grants)
+                if not grants and not ledger.held(self.client):
+                    # Our client is idle and there is nothing left to give
+                    # it, take an item another client is holding on to.
+                    self.server._steal(self)
+                if self.wanted:
+                    # Don't block on the ledger, the client keeps sending us
+                    # results and heartbeats while it waits.
+                    timeout = self.poll_interval
+
+            (readable, _, _) = select.select([self.sock], [], [], timeout)
+            if readable:
+                self._handle(*recv_frame(self.sock))
+
+    def _handle(self, kind, payload):
+        ledger = self.server.ledger
+        if kind == REQUEST:
+            (self.client, count, results) = payload
+            for (item_id, result) in results:
+                ledger.complete(self.client, item_id, result)
+            self.wanted += count
+        elif kind == RETIRE:
+            (self.client, results) = payload
+            for (item_id, result) in results:
+                ledger.complete(self.client, item_id, result)
+            with self._grant_lock:
+                self.retired = True
+                self.wanted = 0
+            # Items granted which the client hadn't started.
+            ledger.retire(self.client)
+        elif kind == HEARTBEAT:
+            ledger.heartbeat(payload)
+        elif kind == REGISTER:
+            ledger.register(*payload)
+        elif kind == STATUS:
+            self.server.status_queue.put(payload)
+        elif kind == RELEASE:
+            (thief, self.thief) = (self.thief, None)
+            if thief is not None:
+                try:
+                    thief.grant(ledger.transfer(self.client, payload,
+                                                thief.client))
+                except socket.error:
+                    # The thief's leases will expire.
+                    pass
+        elif kind == ARTIFACT:
+            check_artifact_request(payload)
+            self.send(ARTIFACT, answer_artifact_request(
+                    self.server.artifact_store, payload))
+        elif kind in (SUBMIT, COLLECT, DISCARD):
+            self._handle_submission(kind, payload)
+        elif kind == CONFIG:
+            self.send(CONFIG, (config_module.config._config,
+                               config_module.config._defaults))
+        else:
+            raise IOError('Unexpected message %d from work client.' % kind)
+
+
+    def _handle_submission(self, kind, payload):
+        ledger = self.server.ledger
+        router = self.server.status_queue
+        if not isinstance(router, StatusRouter):
+            raise IOError('Work server does not take submissions.')
+        if kind == SUBMIT:
+            (queue, task, requirements, priority) = payload
+            self.queues.add(queue)
+            ledger.put(task, requirements, queue, priority)
+        elif kind == COLLECT:
+            (queue, timeout) = payload
+            result = ledger.get_result(timeout, queue)
+            # Take the events after the result so those of its item are sent
+            # with it.
+            self.send(COLLECT, (result, router.take(queue)))
+        else:
+            self.queues.discard(payload)
+            ledger.discard(payload)
+            router.take(payload)
+
+
+class WireQueueClient(object):
+    '''
+    Client side of a connection to a :class:`WireQueueServer`. Provides the
+    same ledger and status queue interface as the proxies of
+    a :class:`whimsy.runner.parallel.WorkQueueClient`.
+
+    :param prefetch: Number of items to hold ahead of the one being run.
+    '''
+    connect_timeout = 20.0
+    '''Seconds to keep retrying a refused connection for.'''
+    connect_retry_delay = 0.1
+
+    def __init__(self, hostname, port, passkey, prefetch=1):
+        self.address = (hostname, port)
+        self.passkey = passkey
+        self.prefetch = prefetch
+        self.sock = None
+        self._send_lock = threading.Lock()
+        # Answers to ARTIFACT requests, put by the thread of our ledger which
+        # reads messages from the server.
+        self.artifact_replies = Queue.Queue()
+
+    def connect(self):
+        # Local clients may be started before their server is listening.
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                self.sock = socket.create_connection(self.address)
+            except socket.error as e:
+                if e.args[0] != errno.ECONNREFUSED \
+                        or time.time() > deadline:
+                    raise
+                time.sleep(self.connect_retry_delay)
+            else:
+                break
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        answer_challenge(self.sock, self.passkey)
+
+    def send(self, kind, payload):
+        # The runner, heartbeat and receiving threads share the connection.
+        with self._send_lock:
+            send_frame(self.sock, kind, payload)
+
+    def shared_config(self):
+        '''Return the config dictionaries of the server.'''
+        self.send(CONFIG, None)
+        (kind, payload) = recv_frame(self.sock)
+        if kind != CONFIG:
+            raise IOError('Unexpected message %d from work server.' % kind)
+        return payload
+
+    def get_ledger(self):
+        return _RemoteLedger(self)
+
+    def get_status_queue(self):
+        return _RemoteStatusQueue(self)
+
+    def get_artifact_store(self):
+        return _RemoteArtifactStore(self)
+
+    def get_submission(self, queue):
+        '''
+        Return a :class:`whimsy.runner.scheduler.Submission` like object for
+        submitting items to the given queue of a work daemon.
+        '''
+        return _RemoteSubmission(self, queue)
+
+
+class _RemoteLedger(object):
+    '''
+    Stands in for the server's :class:`whimsy.runner.scheduler.WorkLedger`
+    on the client.
+
+    Messages from the server are read on a thread of our own so items the
+    server revokes can be given back while we run a test. It wakes
+    :meth:`acquire` through a socket pair rather than a condition since in
+    Python 2 a wait on a condition with a timeout polls, sleeping up to 50ms
+    at a time, which would cap the rate a client runs items at.
+
+    .. note:: Only :meth:`heartbeat` may be called from a thread other than
+        the one which called :meth:`acquire` and :meth:`complete`.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self._granted = collections.deque()
+        self._results = []
+        # Number of items asked for which haven't been granted yet.
+        self._outstanding = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        (self._wakeup, self._notifier) = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._notifier.setblocking(False)
+
+        thread = threading.Thread(target=self._receive)
+        thread.daemon = True
+        thread.start()
+
+    def _receive(self):
+        try:
+            while True:
+                (kind, payload) = recv_frame(self.connection.sock)
+                with self._lock:
+                    if kind == GRANT:
+                        self._granted.extend(payload)
+                        self._outstanding -= len(payload)
+                        self._notify()
+                    elif kind == REVOKE:
+                        self._release(payload)
+                    elif kind == ARTIFACT:
+                        self.connection.artifact_replies.put(payload)
+                    else:
+                        raise IOError('Unexpected message %d from work'
+                                      ' server.' % kind)
+        except (EOFError, IOError):
+            with self._lock:
+                self._closed = True
+                self._notify()
+            self.connection.artifact_replies.put(None)
+
+    def _notify(self):
+        try:
+            self._notifier.send('\0')
+        except socket.error:
+            # The buffer is full of wakeups already.
+            pass
+
+    def _drain(self):
+        '''Discard wakeups which are no longer needed.'''
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _release(self, count):
+        '''Give back up to count of the items we haven't started.'''
+        released = []
+        while self._granted and len(released) < count:
+            (item_id, _, _) = self._granted.pop()
+            released.append(item_id)
+        self.connection.send(RELEASE, released)
+
+    def _request(self, client, count):
+        self.connection.send(REQUEST, (client, count, self._results))
+        self._results = []
+        self._outstanding += count
+
+    def _top_up(self, client, needed):
+        '''
+        Ask for enough items to hold needed and our prefetch, sending any
+        results we hold along with the request.
+        '''
+        wanted = (needed + self.connection.prefetch - len(self._granted)
+                  - self._outstanding)
+        if wanted > 0 or self._results:
+            self._request(client, max(wanted, 0))
+
+    def acquire(self, client, timeout=None):
+        with self._lock:
+            self._drain()
+            wait = not self._granted and not self._closed
+            if not self._granted:
+                self._top_up(client, 1)
+        if wait:
+            select.select([self._wakeup], [], [], timeout)
+        with self._lock:
+            if not self._granted:
+                if self._closed:
+                    raise EOFError('Connection closed.')
+                return None
+
+            lease = self._granted.popleft()
+            # Ask for more while we run this item.
+            self._top_up(client, 0)
+            return lease
+
+    def complete(self, client, item_id, result):
+        with self._lock:
+            self._results.append((item_id, result))
+
+    def heartbeat(self, client):
+        self.connection.send(HEARTBEAT, client)
+
+    def retire(self, client):
+        with self._lock:
+            self.connection.send(RETIRE, (client, self._results))
+            self._results = []
+
+    def register(self, client, capabilities):
+        self.connection.send(REGISTER, (client, capabilities))
+
+
+class _RemoteStatusQueue(object):
+    '''Sends status events put on it to the server.'''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def put(self, event):
+        self.connection.send(STATUS, event)
+
+
+class _RemoteArtifactStore(object):
+    '''
+    Stands in for the server's :class:`whimsy.artifacts.ArtifactStore` on the
+    client.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args):
+        with self._lock:
+            self.connection.send(ARTIFACT, (method, args))
+            reply = self.connection.artifact_replies.get()
+        if reply is None:
+            raise EOFError('Connection closed.')
+        (ok, result) = reply
+        if not ok:
+            raise IOError(result)
+        return result
+
+    def lookup(self, path):
+        return self._call('lookup', path)
+
+    def read(self, digest, offset, size):
+        return self._call('read', digest, offset, size)
+
+
+class _RemoteSubmission(object):
+    '''
+    Stands in for a :class:`whimsy.runner.scheduler.Submission` on a work
+    daemon.
+
+    .. note:: The connection must not be used for anything else.
+    '''
+    def __init__(self, connection, queue):
+        self.connection = connection
+        self.queue = queue
+        self._events = collections.deque()
+
+    def put(self, task, requirements=None, priority=0):
+        self.connection.send(SUBMIT, (self.queue, task, requirements,
+                                      priority))
+
+    def get_result(self, timeout=None):
+        self.connection.send(COLLECT, (self.queue, timeout))
+        (kind, payload) = recv_frame(self.connection.sock)
+        if kind != COLLECT:
+            raise IOError('Unexpected message %d from work server.' % kind)
+        (result, events) = payload
+        self._events.extend(events)
+        return result
+
+    def get_nowait(self):
+        if not self._events:
+            raise Queue.Empty
+        return self._events.popleft()
+
+    def discard(self):
+        self.connection.send(DISCARD, self.queue)
@@ -0,0 +1,101 @@
+'''
+Records a timeline of a testing run in the Chrome trace event format. The
+output file can be opened with ``chrome://tracing`` or the Perfetto UI.
+
+Spans are recorded with the :func:`Timeline.span` context manager, which is
+a no-op until the :data:`timeline` has been enabled. (This is done by the
+``--trace-file`` flag.) Every process records its spans under its own pid so
+each worker of a parallel run shows up as its own track.
+
+Worker processes do not write the trace file themselves, instead they
+:meth:`Timeline.drain` their events and pass them back to the server along
+with their results where they are merged with :meth:`Timeline.extend`.
+'''
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+def _now_us():
+    return int(time.time() * 1000000)
+
+class Timeline(object):
+    '''
+    Collects trace events for the current process.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self._events = []
+        self._lock = threading.Lock()
+        self._named_pids = set()
+
+    def enable(self):
+        '''Start recording spans.'''
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        '''
+        Record the time spent in the body of the with statement as a single
+        span.
+
+        :param category: The category the span will be filed under.
+        :param args: Additional values to attach to the span.
+        '''
+        if not self.enabled:
+            yield
+            return
+
+        start = _now_us()
+        try:
+            yield
+        finally:
+            self._add({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': start,
+                'dur': _now_us() - start,
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': args,
+            })
+
+    def _add(self, event):
+        pid = event['pid']
+        with self._lock:
+            if pid not in self._named_pids:
+                # Name the track after the process so workers are easy to
+                # tell apart.
+                self._named_pids.add(pid)
+                self._events.append({
+                    'name': 'process_name',
+                    'ph': 'M',
+                    'pid': pid,
+                    'args': {'name': '%s:%d' % (socket.gethostname(), pid)},
+                })
+            self._events.append(event)
+
+    def drain(self):
+        '''Remove and return all events recorded so far.'''
+        with self._lock:
+            events = self._events
+            self._events = []
+            self._named_pids = set()
+        return events
+
+    def extend(self, events):
+        '''Add events recorded by another process.'''
+        with self._lock:
+            self._events.extend(events)
+
+    def dump(self, path):
+        '''Write all recorded events to the given path.'''
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': self.drain(),
+                       'displayTimeUnit': 'ms'}, trace_file)
+
+timeline = Timeline()
+'''The timeline shared by everything in this process.'''